@@ -11,6 +11,15 @@ class Arguments:
                 )
         self.init_environment()
         self.init_dataset_args()
+        self.init_ingestion_args()
+        self.init_sharding_args()
+        self.init_encoder_args()
+        self.init_index_args()
+        self.init_store_args()
+        self.init_tuning_args()
+        self.init_benchmark_args()
+        self.init_migration_args()
+        self.init_server_args()
 
     def init_environment(self) -> None:
         """Provide environment variables
@@ -51,6 +60,31 @@ class Arguments:
             help="name of table in the database",
             default=""
         )
+        self.parser.add_argument(
+            "--pool_size",
+            type=int,
+            help="maximum number of pooled database connections (PG_POOL_MAX by default)",
+            default=None
+        )
+        self.parser.add_argument(
+            "--statement_timeout_ms",
+            type=int,
+            help="statement_timeout of every session, 0 disables it (PG_STATEMENT_TIMEOUT_MS by default)",
+            default=None
+        )
+        self.parser.add_argument(
+            "--synchronous_commit",
+            type=str,
+            choices=["on", "off", "local", "remote_write", "remote_apply"],
+            help="synchronous_commit of every session (PG_SYNCHRONOUS_COMMIT by default)",
+            default=None
+        )
+        self.parser.add_argument(
+            "--ivfflat_probes",
+            type=int,
+            help="ivfflat.probes of every session, 0 keeps the server default (PG_IVFFLAT_PROBES by default)",
+            default=None
+        )
     def init_dataset_args(self):
         """Provide dataset information
         """
@@ -95,8 +129,581 @@ class Arguments:
             default=True
         )
 
+    def init_ingestion_args(self):
+        """Provide ingestion settings
+        """
+        self.parser.add_argument(
+            "--bulk_load",
+            action='store_true',
+            help="stream rows with binary COPY and commit every COMMIT_ROWS rows or COMMIT_BYTES bytes",
+        )
+        self.parser.add_argument(
+            "--unlogged_staging",
+            action='store_true',
+            help="load into an UNLOGGED staging table which is swapped in at the end",
+        )
+        self.parser.add_argument(
+            "--num_tokenizers",
+            type=int,
+            help="number of tokenizer threads in the ingestion pipeline",
+            default=1
+        )
+        self.parser.add_argument(
+            "--num_writers",
+            type=int,
+            help="number of writer threads in the ingestion pipeline, each with its own connection",
+            default=1
+        )
+        self.parser.add_argument(
+            "--max_tokens",
+            type=int,
+            help="encode length-bucketed batches of at most this many padded tokens, "
+                 "0 sizes them from the device memory",
+            default=0
+        )
+        self.parser.add_argument(
+            "--fixed_batches",
+            action='store_true',
+            help="encode BATCH rows together, padded to the longest one, instead of length-bucketed batches",
+        )
+        self.parser.add_argument(
+            "--encode_only",
+            action='store_true',
+            help="encode into Parquet + .npy part files under --artifact_dir without touching the database",
+        )
+        self.parser.add_argument(
+            "--import_only",
+            action='store_true',
+            help="bulk-load the part files under --artifact_dir into the table, --num_writers parts at a time",
+        )
+        self.parser.add_argument(
+            "--artifact_dir",
+            type=str,
+            help="directory of the encoded part files",
+            default=""
+        )
+        self.parser.add_argument(
+            "--dedup",
+            type=str,
+            choices=["none", "skip", "link"],
+            help="drop exact and near duplicate passages before encoding, "
+                 "link also records them in <table>_duplicates with their canonical source_id",
+            default="none"
+        )
+        self.parser.add_argument(
+            "--dedup_threshold",
+            type=float,
+            help="estimated Jaccard similarity of word shingles above which passages are near duplicates, "
+                 "1.0 only drops exact duplicates",
+            default=0.8
+        )
+        self.parser.add_argument(
+            "--dedup_max_entries",
+            type=int,
+            help="passages each ingestion process remembers to compare against, the oldest are forgotten first",
+            default=2000000
+        )
+        self.parser.add_argument(
+            "--sync",
+            action='store_true',
+            help="sync the client table with the csv: upsert new and changed rows (only they are encoded), "
+                 "delete the rows missing from it",
+        )
+        self.parser.add_argument(
+            "--sync_key",
+            type=str,
+            help="comma separated csv columns identifying a row across versions of the csv",
+            default="Title,Domain"
+        )
+        self.parser.add_argument(
+            "--sync_no_reindex",
+            action='store_true',
+            help="keep the vector indexes even when more than SYNC_REINDEX_FRACTION of the rows changed",
+        )
+
+    def init_sharding_args(self):
+        """Provide settings to split a load across processes and hosts
+        """
+        self.parser.add_argument(
+            "--num_workers",
+            type=int,
+            help="number of ingestion processes on this host, each with its own encoder and connection",
+            default=1
+        )
+        self.parser.add_argument(
+            "--shard_index",
+            type=int,
+            help="index of this host's shard when several hosts split one load",
+            default=0
+        )
+        self.parser.add_argument(
+            "--num_shards",
+            type=int,
+            help="number of hosts splitting one load",
+            default=1
+        )
+        self.parser.add_argument(
+            "--num_threads",
+            type=int,
+            help="torch threads per worker, 0 divides the cores evenly between workers",
+            default=0
+        )
+
+    def init_encoder_args(self):
+        """Provide context encoder settings
+        """
+        self.parser.add_argument(
+            "--encoder_backend",
+            type=str,
+            choices=["torch", "onnx", "onnx-int8"],
+            help="torch (eager fp32), onnx (ONNX Runtime fp32) or onnx-int8 (dynamically quantized)",
+            default="torch"
+        )
+        self.parser.add_argument(
+            "--intra_op_threads",
+            type=int,
+            help="threads used inside an encoder operator, 0 keeps the default",
+            default=0
+        )
+        self.parser.add_argument(
+            "--inter_op_threads",
+            type=int,
+            help="threads running independent encoder operators, 0 keeps the default",
+            default=0
+        )
+        self.parser.add_argument(
+            "--check_encoder_agreement",
+            type=int,
+            help="before inserting, compare the backend's embeddings of this many passages with fp32 PyTorch",
+            default=0
+        )
+        self.parser.add_argument(
+            "--embedding_cache_dir",
+            type=str,
+            help="directory of the on-disk embedding cache, passages already encoded by the same model are not encoded again",
+            default=""
+        )
+        self.parser.add_argument(
+            "--embedding_cache_gb",
+            type=float,
+            help="size cap of the embedding cache in GB, the oldest entries are evicted first",
+            default=20.0
+        )
+
+    def init_index_args(self):
+        """Provide vector index settings
+        """
+        self.parser.add_argument(
+            "--index_method",
+            type=str,
+            choices=["ivfflat", "hnsw"],
+            help="type of vector index to build",
+            default="ivfflat"
+        )
+        self.parser.add_argument(
+            "--hnsw_m",
+            type=int,
+            help="HNSW maximum number of connections per layer",
+            default=16
+        )
+        self.parser.add_argument(
+            "--hnsw_ef_construction",
+            type=int,
+            help="HNSW size of the candidate list while building",
+            default=64
+        )
+        self.parser.add_argument(
+            "--quantization",
+            type=str,
+            choices=["none", "halfvec", "binary"],
+            help="index a compact copy of the embeddings (halfvec or binary_quantize) "
+                 "and rerank its candidates on the float vectors",
+            default="none"
+        )
+        self.parser.add_argument(
+            "--rerank_factor",
+            type=int,
+            help="candidates read from a quantized index per requested result (RERANK_FACTOR by default)",
+            default=None
+        )
+        self.parser.add_argument(
+            "--lexical_index",
+            action='store_true',
+            help="add a generated content_tsv column to the table and a GIN index on it for hybrid search",
+        )
+        self.parser.add_argument(
+            "--partition_by",
+            type=str,
+            choices=["none", "hash", "range"],
+            help="create the table partitioned by hash of source_id or by ranges of id; "
+                 "range partitions can not skip replayed rows, so the loaders refuse them",
+            default="none"
+        )
+        self.parser.add_argument(
+            "--partitions",
+            type=int,
+            help="number of partitions of a partitioned table",
+            default=8
+        )
+        self.parser.add_argument(
+            "--partition_rows",
+            type=int,
+            help="ids per range partition, the last partition takes every id above",
+            default=5000000
+        )
+        self.parser.add_argument(
+            "--index_workers",
+            type=int,
+            help="partitions indexed at the same time, each on its own connection",
+            default=4
+        )
+        self.parser.add_argument(
+            "--index_partitions",
+            type=str,
+            help="comma separated partitions to (re)index, all of them by default",
+            default=""
+        )
+        self.parser.add_argument(
+            "--rebuild_index",
+            action='store_true',
+            help="with --just_create_index, build a new index concurrently and swap it for the current one "
+                 "once it passes a recall check",
+        )
+        self.parser.add_argument(
+            "--rebuild_min_recall",
+            type=float,
+            help="recall@10 the rebuilt index must reach to be swapped in (INDEX_MIN_RECALL by default)",
+            default=None
+        )
+        self.parser.add_argument(
+            "--rebuild_check_queries",
+            type=int,
+            help="stored passages searched by the recall check (INDEX_CHECK_QUERIES by default)",
+            default=None
+        )
+
+    def init_store_args(self):
+        """Provide vector store settings
+        """
+        self.parser.add_argument(
+            "--store",
+            type=str,
+            choices=["postgres", "numpy"],
+            help="where embeddings are written and searched: pgvector tables, or memory-mapped files "
+                 "searched in NumPy (no database needed)",
+            default="postgres"
+        )
+        self.parser.add_argument(
+            "--store_dir",
+            type=str,
+            help="directory of the numpy store, NUMPY_STORE_DIR by default",
+            default=""
+        )
+        self.parser.add_argument(
+            "--ivf_lists",
+            type=int,
+            help="IVF lists of the numpy store's index, derived from the row count if 0",
+            default=0
+        )
+        self.parser.add_argument(
+            "--pq_subvectors",
+            type=int,
+            help="product quantization subvectors of the numpy store's index (must divide the "
+                 "dimensions), 0 keeps float vectors only",
+            default=0
+        )
+
+    def init_tuning_args(self):
+        """Provide index tuning benchmark settings
+        """
+        self.parser.add_argument(
+            "--tune_queries",
+            type=int,
+            help="number of stored passages sampled as held-out queries",
+            default=100
+        )
+        self.parser.add_argument(
+            "--tune_questions_file",
+            type=str,
+            help="text file with one question per line, used as queries instead of sampled passages",
+            default=""
+        )
+        self.parser.add_argument(
+            "--tune_k",
+            type=int,
+            help="recall is measured on the top k results",
+            default=10
+        )
+        self.parser.add_argument(
+            "--tune_probes",
+            type=str,
+            help="comma separated ivfflat.probes values to try",
+            default="1,2,4,8,16,32,64"
+        )
+        self.parser.add_argument(
+            "--tune_ef_search",
+            type=str,
+            help="comma separated hnsw.ef_search values to try",
+            default="10,20,40,80,160,320"
+        )
+        self.parser.add_argument(
+            "--tune_lists",
+            type=str,
+            help="comma separated ivfflat lists values to rebuild the index with, empty keeps the current index",
+            default=""
+        )
+        self.parser.add_argument(
+            "--tune_output",
+            type=str,
+            help="write the recall/latency report to this JSON file",
+            default=""
+        )
+        self.parser.add_argument(
+            "--tune_quantizations",
+            type=str,
+            help="comma separated quantizations (none, halfvec, binary) to compare instead of sweeping the index, "
+                 "missing indexes are built with --index_method",
+            default=""
+        )
+        self.parser.add_argument(
+            "--tune_rerank",
+            type=str,
+            help="comma separated rerank factors to try with each quantization",
+            default="1,2,4,10"
+        )
+
+    def init_benchmark_args(self):
+        """Provide ingestion benchmark settings
+        """
+        self.parser.add_argument(
+            "--bench_shape",
+            type=str,
+            choices=["wiki", "client"],
+            help="synthetic rows shaped like wiki snippets or like a client knowledge csv (streamed from a temp file)",
+            default="wiki"
+        )
+        self.parser.add_argument(
+            "--bench_rows",
+            type=int,
+            help="number of synthetic rows to ingest",
+            default=10000
+        )
+        self.parser.add_argument(
+            "--bench_words",
+            type=int,
+            help="mean passage length in words, 100 for wiki and 200 for client by default",
+            default=None
+        )
+        self.parser.add_argument(
+            "--bench_words_std",
+            type=int,
+            help="standard deviation (lognormal) or half range (uniform) of the passage length in words",
+            default=None
+        )
+        self.parser.add_argument(
+            "--bench_length_distribution",
+            type=str,
+            choices=["fixed", "uniform", "lognormal"],
+            help="passage length distribution, fixed for wiki and lognormal for client by default",
+            default=None
+        )
+        self.parser.add_argument(
+            "--bench_seed",
+            type=int,
+            help="random seed of the synthetic data",
+            default=0
+        )
+        self.parser.add_argument(
+            "--bench_sink",
+            type=str,
+            choices=["null", "postgres"],
+            help="null serializes rows and discards them, postgres writes them to a new table (--tbname)",
+            default="null"
+        )
+        self.parser.add_argument(
+            "--bench_keep_table",
+            action='store_true',
+            help="keep the table written by the postgres sink instead of dropping it",
+        )
+        self.parser.add_argument(
+            "--bench_output",
+            type=str,
+            help="write the benchmark report to this JSON file",
+            default=""
+        )
+        self.parser.add_argument(
+            "--bench_baseline",
+            type=str,
+            help="JSON report of an earlier run to compare against",
+            default=""
+        )
+
+    def init_migration_args(self):
+        """Provide embedding migration settings
+        """
+        self.parser.add_argument(
+            "--migrate_step",
+            type=str,
+            choices=["status", "add", "backfill", "index", "switch", "drop", "all"],
+            help="status, add the version's column, backfill it, index it, switch readers and writers to it, "
+                 "drop a retired version, or all of add (if needed) to switch",
+            default="status"
+        )
+        self.parser.add_argument(
+            "--migrate_version",
+            type=str,
+            help="name of the embedding version (v1, ...), its column is embedd_<version>",
+            default=""
+        )
+        self.parser.add_argument(
+            "--migrate_model",
+            type=str,
+            help="DPR context encoder of the new version",
+            default=""
+        )
+        self.parser.add_argument(
+            "--migrate_question_model",
+            type=str,
+            help="DPR question encoder of the new version",
+            default=""
+        )
+        self.parser.add_argument(
+            "--migrate_page_rows",
+            type=int,
+            help="rows read per keyset page and checkpoint, MIGRATE_PAGE_ROWS by default",
+            default=None
+        )
+        self.parser.add_argument(
+            "--migrate_max_rows_per_sec",
+            type=float,
+            help="throttle of the backfill in rows/s, 0 for no limit, MIGRATE_MAX_ROWS_PER_SEC by default",
+            default=None
+        )
+        self.parser.add_argument(
+            "--migrate_catch_up",
+            action='store_true',
+            help="backfill only the rows whose new embedding is missing (written since they were backfilled)",
+        )
+
+    def init_server_args(self):
+        """Provide retrieval server settings
+        """
+        self.parser.add_argument(
+            "--server_host",
+            type=str,
+            help="address the retrieval server listens on",
+            default="0.0.0.0"
+        )
+        self.parser.add_argument(
+            "--server_port",
+            type=int,
+            help="port the retrieval server listens on",
+            default=8080
+        )
+        self.parser.add_argument(
+            "--question_model",
+            type=str,
+            help="DPR question encoder, QUESTION_MODEL_NAME by default",
+            default=""
+        )
+        self.parser.add_argument(
+            "--max_batch_size",
+            type=int,
+            help="queries encoded together in one forward pass",
+            default=32
+        )
+        self.parser.add_argument(
+            "--max_wait_ms",
+            type=float,
+            help="longest time a query waits for others to share its forward pass",
+            default=5.0
+        )
+        self.parser.add_argument(
+            "--max_inflight",
+            type=int,
+            help="requests served concurrently, later ones get 503",
+            default=256
+        )
+        self.parser.add_argument(
+            "--request_timeout",
+            type=float,
+            help="seconds before a request is answered with 504",
+            default=5.0
+        )
+        self.parser.add_argument(
+            "--fan_out",
+            action='store_true',
+            help="search the partitions of a partitioned table concurrently, one connection each, and merge the top-k",
+        )
+        self.parser.add_argument(
+            "--query_cache_entries",
+            type=int,
+            help="entries of each query cache level (embeddings, results), 0 disables the cache",
+            default=10000
+        )
+        self.parser.add_argument(
+            "--query_cache_mb",
+            type=float,
+            help="approximate memory of each query cache level in MB",
+            default=256.0
+        )
+        self.parser.add_argument(
+            "--query_cache_ttl",
+            type=float,
+            help="seconds a cached embedding or result stays valid",
+            default=300.0
+        )
+        self.parser.add_argument(
+            "--federated_tables",
+            type=str,
+            help="comma separated tables a federated request searches, the first one has priority "
+                 "(TB_CLIENT,TB_WIKI by default)",
+            default=""
+        )
+        self.parser.add_argument(
+            "--federated_weights",
+            type=str,
+            help="weight of each table's calibrated scores in the merge, e.g. client_tb=1.0,wiki_tb=0.7",
+            default=""
+        )
+        self.parser.add_argument(
+            "--federated_k",
+            type=str,
+            help="results read from each table, e.g. client_tb=20,wiki_tb=50, the request's k by default",
+            default=""
+        )
+        self.parser.add_argument(
+            "--federated_probes",
+            type=str,
+            help="ivfflat.probes of each table, e.g. client_tb=10,wiki_tb=40, the request's by default",
+            default=""
+        )
+        self.parser.add_argument(
+            "--federated_ef_search",
+            type=str,
+            help="hnsw.ef_search of each table, the request's by default",
+            default=""
+        )
+        self.parser.add_argument(
+            "--federated_confident_z",
+            type=float,
+            help="stop searching the other tables when every query has --federated_confident_hits hits "
+                 "this many standard deviations above the first table's usual scores, 0 never stops "
+                 "(FEDERATED_CONFIDENT_Z by default)",
+            default=None
+        )
+        self.parser.add_argument(
+            "--federated_confident_hits",
+            type=int,
+            help="confident hits of the first table every query needs to stop early "
+                 "(FEDERATED_CONFIDENT_HITS by default)",
+            default=None
+        )
+
     def parse(self):
         """Get arguments
         """
         args = self.parser.parse_args()
+        if args.fixed_batches:
+            args.max_tokens = None
         return args
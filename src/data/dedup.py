@@ -0,0 +1,206 @@
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import (
+        Dict,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+
+from model.embedding_cache import (
+        normalize_text
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+DEDUP_NUM_PERM=int(os.getenv("DEDUP_NUM_PERM", 64))
+DEDUP_SHINGLE=int(os.getenv("DEDUP_SHINGLE", 3))
+
+# MinHash permutations are (a * x + b) mod a Mersenne prime over 31-bit
+# shingle hashes, which keeps every product inside uint64
+_PRIME = (1 << 31) - 1
+
+
+def lsh_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """(bands, rows) splitting `num_perm` MinHash values for a threshold
+
+    Pairs with a Jaccard similarity around (1 / bands) ** (1 / rows)
+    become candidates with probability 1/2, it is picked closest to
+    `threshold`.
+    """
+    candidates = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+def shingle_hashes(text: str, size: int = DEDUP_SHINGLE) -> np.ndarray:
+    """31-bit hashes of the word `size`-grams of a normalized passage"""
+    words = text.split()
+    if len(words) <= size:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) & _PRIME for shingle in set(shingles)),
+            dtype=np.uint64
+            )
+
+
+class Deduplicator:
+    """Streaming exact and near-duplicate passage detection
+
+    A passage is an exact duplicate when its normalized, lowercased text
+    was seen before, and a near duplicate when it shares an LSH band of
+    its MinHash signature with a passage seen before and their estimated
+    Jaccard similarity (of word shingles) is at least `threshold`. The
+    first passage of a group is canonical.
+
+    Memory is bounded: at most `max_entries` passages are remembered, the
+    oldest are forgotten first, so duplicates further apart than that in
+    the stream are kept. Each ingestion process deduplicates its own
+    shard only.
+
+    Args:
+        threshold: estimated Jaccard similarity of near duplicates, 1.0
+                only drops exact duplicates
+        max_entries: passages remembered at most
+        link: report duplicates as (source_id, canonical source_id,
+                similarity) links to store, instead of only skipping them
+        num_perm: MinHash signature length
+        seed: seed of the MinHash permutations
+    """
+    def __init__(
+            self,
+            threshold: float = 0.8,
+            max_entries: int = 2000000,
+            link: bool = False,
+            num_perm: int = DEDUP_NUM_PERM,
+            seed: int = 0
+            ) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.link = link
+        self.near = threshold < 1.0
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.exact: "OrderedDict[bytes, str]" = OrderedDict()
+        self.signatures: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.buckets: List[Dict[bytes, str]] = [{} for _ in range(self.bands)]
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(("rows", "exact", "near"), 0)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingle_hashes(text)
+        return ((self.a * hashes[None, :] + self.b) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _remember(self, digest: bytes, source_id: str, signature: Optional[np.ndarray]) -> None:
+        self.exact[digest] = source_id
+        if len(self.exact) > self.max_entries:
+            self.exact.popitem(last=False)
+        if signature is None:
+            return
+        self.signatures[source_id] = signature
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(key, source_id)
+        if len(self.signatures) > self.max_entries:
+            old_id, old_signature = self.signatures.popitem(last=False)
+            for bucket, key in zip(self.buckets, self._band_keys(old_signature)):
+                if bucket.get(key) == old_id:
+                    del bucket[key]
+
+    def _near_duplicate(self, signature: np.ndarray) -> Optional[Tuple[str, float]]:
+        best = None
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            candidate = bucket.get(key)
+            if candidate is None or (best is not None and candidate == best[0]):
+                continue
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+        return best
+
+    def check(self, text: str, source_id: str) -> Optional[Tuple[str, float]]:
+        """(canonical source_id, similarity) if `text` is a duplicate
+
+        A passage that is not a duplicate is remembered as canonical.
+        """
+        normalized = normalize_text(text).lower()
+        digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            self.counts["rows"] += 1
+            canonical = self.exact.get(digest)
+            if canonical is not None:
+                self.counts["exact"] += 1
+                return canonical, 1.0
+            signature = None
+            if self.near:
+                signature = self.signature(normalized)
+                match = self._near_duplicate(signature)
+                if match is not None:
+                    self.counts["near"] += 1
+                    return match
+            self._remember(digest, source_id, signature)
+        return None
+
+    def filter(
+            self,
+            rows: Sequence[Tuple[str, ...]],
+            content_index: int,
+            id_index: int
+            ) -> Tuple[List[Tuple[str, ...]], List[Tuple[str, str, float]]]:
+        """Drop the duplicates of a batch of rows
+
+        Returns:
+            rows to keep, and (source_id, canonical source_id, similarity)
+            of the dropped ones when linking
+        """
+        kept, links = [], []
+        for row in rows:
+            match = self.check(row[content_index], row[id_index])
+            if match is None:
+                kept.append(row)
+            elif self.link:
+                links.append((row[id_index], match[0], round(match[1], 4)))
+        return kept, links
+
+    def stats(self) -> Dict[str, float]:
+        """Counters; every duplicate is one passage the encoder skipped"""
+        with self.lock:
+            stats = dict(self.counts)
+            stats["remembered"] = len(self.exact)
+        stats["encoder_calls_saved"] = stats["exact"] + stats["near"]
+        stats["duplicate_rate"] = round(stats["encoder_calls_saved"] / stats["rows"], 4) if stats["rows"] else 0.0
+        return stats
+
+
+def make_deduplicator(
+        mode: str,
+        threshold: float = 0.8,
+        max_entries: int = 2000000
+        ) -> Optional[Deduplicator]:
+    """Deduplicator of an ingestion process, None when `mode` is `none`
+
+    Args:
+        mode: `none`, `skip` or `link`
+        threshold: see `Deduplicator`
+        max_entries: see `Deduplicator`
+    """
+    if mode == "none":
+        return None
+    if mode not in ("skip", "link"):
+        raise ValueError(f"Unknown dedup mode {mode}, expected none, skip or link")
+    return Deduplicator(threshold=threshold, max_entries=max_entries, link=mode == "link")
@@ -1,5 +1,28 @@
+import bisect
+import io
+import os
+import threading
+from typing import (
+        Callable,
+        Iterator,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
 import datasets
+import numpy as np
+import pandas as pd
 from datasets import load_dataset
+from datasets.distributed import split_dataset_by_node
+
+import dotenv
+
+dotenv.load_dotenv()
+
+CSV_BLOCK_BYTES=int(os.getenv("CSV_BLOCK_BYTES", 16 * 1024 * 1024))
+CLIENT_COLUMNS = ("Title", "Domain", "Content")
 
 def download_dataset(
         dataset_name:str = "wiki_snippets",
@@ -34,3 +57,225 @@ def download_dataset(
             streaming=streaming
             )["train"]
     return wiki_snippet
+
+def shard_dataset(
+        snippets: datasets.iterable_dataset.IterableDataset,
+        shard_index: int = 0,
+        num_shards: int = 1
+        ) -> datasets.iterable_dataset.IterableDataset:
+    """Keep only one shard of a (streaming) dataset
+
+    When the dataset has a multiple of `num_shards` source files every
+    shard reads its own files, otherwise every shard reads the stream and
+    keeps one example out of `num_shards`. Either way the shards are
+    disjoint and deterministic.
+
+    Args:
+        snippets: dataset returned by `download_dataset`
+        shard_index: index of the shard to keep, in [0, num_shards)
+        num_shards: total number of shards
+    """
+    if num_shards <= 1:
+        return snippets
+    return split_dataset_by_node(snippets, rank=shard_index, world_size=num_shards)
+
+def _record_ends(data: bytes) -> np.ndarray:
+    """Offsets just past every non-empty CSV record in `data`
+
+    `data` must start at a record boundary. A newline ends a record when
+    it is preceded by an even number of quotes; escaped quotes (`""`)
+    come in pairs and keep the parity.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    quotes = np.flatnonzero(buffer == ord('"'))
+    newlines = np.flatnonzero(buffer == ord("\n"))
+    ends = newlines[(np.searchsorted(quotes, newlines) & 1) == 0] + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    # blank lines are skipped by the parser, they are not rows
+    blank = (ends - starts == 1) | ((ends - starts == 2) & (buffer[np.maximum(ends - 2, 0)] == ord("\r")))
+    return ends[~blank]
+
+def _iter_record_blocks(
+        path: str,
+        block_bytes: int = CSV_BLOCK_BYTES,
+        position: int = 0
+        ) -> Iterator[Tuple[int, bytes, np.ndarray]]:
+    """Read a CSV file in blocks of whole records
+
+    Args:
+        path: CSV file with a header row
+        block_bytes: approximate bytes per block
+        position: byte offset of a record to start at, 0 starts after
+                the header
+
+    Yields:
+        (byte offset of the block, bytes of whole records, end offset of
+        every record in them)
+    """
+    with open(path, "rb") as f:
+        if position:
+            f.seek(position)
+        else:
+            f.readline()
+        position = f.tell()
+        carry = b""
+        while True:
+            block = f.read(block_bytes)
+            data = carry + block
+            if not block:
+                if data.strip():
+                    yield position, data, np.array([len(data)])
+                return
+            ends = _record_ends(data)
+            if not len(ends):
+                carry = data
+                continue
+            cut = int(ends[-1])
+            yield position, data[:cut], ends
+            position += cut
+            carry = data[cut:]
+
+def csv_columns(path: str) -> List[str]:
+    """Column names of a CSV file, read from its header"""
+    return list(pd.read_csv(path, nrows=0).columns)
+
+def count_csv_rows(path: str, block_bytes: int = CSV_BLOCK_BYTES) -> int:
+    """Count the rows of a CSV file without parsing it
+
+    Memory stays at one block whatever the file size. Only needed to
+    split a file into row ranges.
+    """
+    return sum(len(ends) for _, _, ends in _iter_record_blocks(path, block_bytes))
+
+def read_csv_batches(
+        path: str,
+        usecols: Sequence[str] = CLIENT_COLUMNS,
+        start_row: int = 0,
+        stop_row: Optional[int] = None,
+        block_bytes: int = CSV_BLOCK_BYTES,
+        seek: Optional[Tuple[int, int]] = None,
+        on_block: Optional[Callable[[int, int], None]] = None
+        ) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Stream a CSV file as column-oriented batches
+
+    Every block of whole records is parsed by `pd.read_csv`. Blocks
+    before `start_row` are only scanned for record boundaries, not
+    parsed; with a `seek` point at or before `start_row` reading starts
+    there instead of at the top of the file. Values are read as strings,
+    empty fields as "".
+
+    Args:
+        path: CSV file with a header row
+        usecols: columns to keep
+        start_row: first row (0-based, header excluded) to yield
+        stop_row: row to stop before, the end of the file if None
+        block_bytes: approximate bytes parsed per batch
+        seek: (row number, byte offset) of a record, e.g. reported by
+                `on_block` in an earlier run over the same file
+        on_block: called with the (row number, byte offset) of the first
+                record of every block
+
+    Yields:
+        (row number of the batch's first row, DataFrame of `usecols`)
+    """
+    names = csv_columns(path)
+    row, position = seek if seek is not None and seek[0] <= start_row else (0, 0)
+    for offset, data, ends in _iter_record_blocks(path, block_bytes, position):
+        if stop_row is not None and row >= stop_row:
+            return
+        if on_block is not None:
+            on_block(row, offset)
+        first = max(start_row - row, 0)
+        last = len(ends) if stop_row is None else min(len(ends), stop_row - row)
+        if first < last:
+            begin = int(ends[first - 1]) if first else 0
+            chunk = pd.read_csv(
+                    io.BytesIO(data[begin:int(ends[last - 1])]),
+                    header=None,
+                    names=names,
+                    usecols=list(usecols),
+                    dtype=str,
+                    keep_default_na=False
+                    )
+            yield row + first, chunk
+        row += len(ends)
+
+class CsvSource:
+    """One shard of a client knowledge CSV, read in streaming batches
+
+    Rows are split into contiguous ranges, the global row number of a row
+    is its stable source id. The (row, byte offset) of every block read
+    is remembered, checkpoints store the latest one so a resumed load
+    seeks to it instead of scanning the file from the top.
+
+    Args:
+        path: client knowledge CSV
+        shard_index: index of the shard to read, in [0, num_shards)
+        num_shards: total number of shards
+        num_rows: rows in the file; only needed (and counted if not
+                given) to split it into several shards
+    """
+    def __init__(
+            self,
+            path: str,
+            shard_index: int = 0,
+            num_shards: int = 1,
+            num_rows: Optional[int] = None
+            ) -> None:
+        self.path = path
+        if num_rows is None and num_shards > 1:
+            num_rows = count_csv_rows(path)
+        self.num_rows = num_rows
+        self.start = 0 if num_rows is None else num_rows * shard_index // num_shards
+        self.stop = None if num_rows is None else num_rows * (shard_index + 1) // num_shards
+        self.seek_points: List[Tuple[int, int]] = []
+        self.lock = threading.Lock()
+
+    @property
+    def total(self) -> Optional[int]:
+        """Rows of the shard, None when the file was not counted"""
+        return None if self.stop is None else self.stop - self.start
+
+    def _record_block(self, row: int, position: int) -> None:
+        with self.lock:
+            if not self.seek_points or row > self.seek_points[-1][0]:
+                self.seek_points.append((row, position))
+
+    def seek_point(self, offset: int) -> Optional[Tuple[int, int]]:
+        """Latest (row number, byte offset) read at or before `offset` rows
+        into the shard, None if none is known"""
+        with self.lock:
+            index = bisect.bisect_right(self.seek_points, (self.start + offset, float("inf")))
+            return self.seek_points[index - 1] if index else None
+
+    def batches(
+            self,
+            offset: int = 0,
+            seek: Optional[Tuple[int, int]] = None
+            ) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """Batches of the shard starting `offset` rows into it
+
+        Args:
+            offset: rows of the shard to skip
+            seek: (row number, byte offset) to start reading at, see
+                    `seek_point`
+
+        Yields:
+            (global row number of the first row, DataFrame)
+        """
+        return read_csv_batches(
+                self.path,
+                start_row=self.start + offset,
+                stop_row=self.stop,
+                seek=seek,
+                on_block=self._record_block
+                )
+
+    def head(self, column: str, num_rows: int) -> List[str]:
+        """First values of a column, e.g. sample passages"""
+        values = []
+        for _, chunk in read_csv_batches(self.path, usecols=(column,), start_row=self.start, stop_row=self.stop):
+            values += chunk[column].head(num_rows - len(values)).tolist()
+            if len(values) >= num_rows:
+                break
+        return values
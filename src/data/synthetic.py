@@ -0,0 +1,134 @@
+import csv
+import string
+from typing import (
+        Dict,
+        Iterator,
+        Optional
+        )
+
+import numpy as np
+
+from data.make_data import (
+        CLIENT_COLUMNS
+        )
+
+LENGTH_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+def passage_lengths(
+        num_rows: int,
+        mean_words: int = 100,
+        std_words: int = 30,
+        distribution: str = "fixed",
+        seed: int = 0
+        ) -> np.ndarray:
+    """Number of words of every synthetic passage
+
+    Args:
+        num_rows: number of passages
+        mean_words: mean passage length in words
+        std_words: standard deviation of the length (`lognormal`), or half
+                    the range of lengths (`uniform`)
+        distribution: `fixed` (every passage has `mean_words`, like the
+                    100-word wiki snippets), `uniform` or `lognormal` (long
+                    tail, like client documents)
+        seed: random seed
+    """
+    rng = np.random.RandomState(seed)
+    if distribution == "fixed":
+        lengths = np.full(num_rows, mean_words)
+    elif distribution == "uniform":
+        lengths = rng.randint(max(mean_words - std_words, 1), mean_words + std_words + 1, size=num_rows)
+    elif distribution == "lognormal":
+        sigma2 = np.log(1 + (std_words / mean_words) ** 2)
+        lengths = rng.lognormal(np.log(mean_words) - sigma2 / 2, np.sqrt(sigma2), size=num_rows)
+    else:
+        raise ValueError(f"Unknown length distribution {distribution}, expected one of {LENGTH_DISTRIBUTIONS}")
+    return np.maximum(np.round(lengths), 1).astype(np.int64)
+
+
+class TextGenerator:
+    """Random text over a fixed vocabulary of made-up words
+
+    Words are drawn with Zipf-like frequencies so the tokenizer sees a
+    realistic mix of frequent short and rare long (multi-piece) words.
+
+    Args:
+        vocabulary_size: number of distinct words
+        seed: random seed
+    """
+    def __init__(self, vocabulary_size: int = 20000, seed: int = 0) -> None:
+        self.rng = np.random.RandomState(seed)
+        letters = np.array(list(string.ascii_lowercase))
+        word_lengths = np.clip(self.rng.poisson(5, size=vocabulary_size), 1, 14)
+        self.vocabulary = np.array([
+                "".join(self.rng.choice(letters, size=length))
+                for length in word_lengths
+                ])
+        weights = 1.0 / np.arange(1, vocabulary_size + 1)
+        self.weights = weights / weights.sum()
+
+    def words(self, num_words: int) -> str:
+        return " ".join(self.rng.choice(self.vocabulary, size=num_words, p=self.weights))
+
+    def title(self, num_words: int = 3) -> str:
+        return self.words(num_words).title()
+
+
+def synthetic_snippets(
+        num_rows: int,
+        mean_words: int = 100,
+        std_words: int = 30,
+        distribution: str = "fixed",
+        seed: int = 0
+        ) -> Iterator[Dict[str, str]]:
+    """Rows shaped like the `wiki_snippets` dataset
+
+    Yields:
+        dicts with `_id`, `article_title`, `section_title` and `passage_text`
+    """
+    text = TextGenerator(seed=seed)
+    lengths = passage_lengths(num_rows, mean_words, std_words, distribution, seed)
+    article = text.title()
+    for idx, length in enumerate(lengths):
+        # a few passages per article, like consecutive snippets
+        if idx % 8 == 0:
+            article = text.title()
+        yield {
+                "_id": f"synthetic:{idx}",
+                "article_title": article,
+                "section_title": text.title(2),
+                "passage_text": text.words(int(length)),
+                }
+
+
+def write_synthetic_csv(
+        path: str,
+        num_rows: int,
+        mean_words: int = 200,
+        std_words: int = 150,
+        distribution: str = "lognormal",
+        seed: int = 0,
+        num_domains: Optional[int] = 20
+        ) -> str:
+    """Write a CSV shaped like a client knowledge file
+
+    Content is quoted and contains commas and line breaks, so the
+    streaming CSV reader handles multi-line records as on real files.
+
+    Returns:
+        `path`
+    """
+    text = TextGenerator(seed=seed)
+    lengths = passage_lengths(num_rows, mean_words, std_words, distribution, seed)
+    domains = [f"{text.words(1)}.com" for _ in range(num_domains or 1)]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(CLIENT_COLUMNS)
+        for idx, length in enumerate(lengths):
+            words = text.words(int(length)).split(" ")
+            # a paragraph break and a comma every ~60 words
+            for i in range(60, len(words), 60):
+                words[i - 1] += ",\n" if i % 120 == 0 else ","
+            writer.writerow((text.title(), domains[idx % len(domains)], " ".join(words)))
+    return path
@@ -0,0 +1,354 @@
+import glob
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+        Any,
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import (
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+from model.embedding_cache import (
+        EmbeddingCache
+        )
+from data.dedup import (
+        Deduplicator
+        )
+from database.checkpoint import (
+        ImportHook,
+        OffsetTracker,
+        imported_parts
+        )
+from database.pipeline import (
+        run_pipeline
+        )
+from database.vector_codec import (
+        to_host_array
+        )
+from database.writers import (
+        CopyWriter
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+ARTIFACT_PART_ROWS=int(os.getenv("ARTIFACT_PART_ROWS", 50000))
+
+
+def artifact_table_dir(artifact_dir: str, tb_name: str) -> str:
+    return os.path.join(artifact_dir, tb_name)
+
+
+class PartRanges:
+    """Collects the source ranges of the batches of the next part"""
+    def __init__(self) -> None:
+        self.pending = []
+
+    def add(self, start: int, end: int) -> None:
+        self.pending.append((start, end))
+
+    def take(self) -> List[Tuple[int, int]]:
+        ranges, self.pending = self.pending, []
+        return ranges
+
+
+class ShardFileWriter:
+    """Write encoded rows to Parquet + `.npy` part files instead of a table
+
+    Every `part_rows` rows become one part: `<part>.parquet` with the text
+    columns, `<part>.npy` with the float32 embeddings (memory-mappable
+    with `np.load(mmap_mode="r")`) and `<part>.json` describing it. The
+    JSON is written last, a part without it is incomplete and ignored.
+
+    Has the writer interface of `database.writers`, `connection` is None.
+
+    Args:
+        table_dir: directory of the table's parts
+        tb_name: name of the table the parts are meant for
+        columns: text columns of a row
+        fingerprint: identifies the source, see `dataset_fingerprint`
+        shard_index: index of the shard being encoded
+        num_shards: total number of shards
+        part_rows: rows per part
+        hook: `PartRanges` receiving the source range of every batch
+    """
+    def __init__(
+            self,
+            table_dir: str,
+            tb_name: str,
+            columns: Sequence[str],
+            fingerprint: str,
+            shard_index: int = 0,
+            num_shards: int = 1,
+            part_rows: int = ARTIFACT_PART_ROWS,
+            hook: Optional[PartRanges] = None
+            ) -> None:
+        self.connection = None
+        self.table_dir = table_dir
+        self.tb_name = tb_name
+        self.columns = tuple(columns)
+        self.fingerprint = fingerprint
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.part_rows = part_rows
+        self.hook = hook
+        self.rows = []
+        self.embeddings = []
+        self.pending_rows = 0
+        os.makedirs(table_dir, exist_ok=True)
+
+    def write(
+            self,
+            rows: Sequence[Sequence[str]],
+            embeddings
+            ) -> None:
+        """Buffer a batch of rows, write a part once `part_rows` are pending"""
+        self.rows.extend(rows)
+        self.embeddings.append(to_host_array(embeddings))
+        self.pending_rows += len(rows)
+        if self.pending_rows >= self.part_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write pending rows as one part"""
+        if self.pending_rows == 0:
+            return
+        ranges = self.hook.take() if self.hook is not None else []
+        first = min(start for start, _ in ranges) if ranges else 0
+        name = f"part-{self.shard_index:05d}-of-{self.num_shards:05d}-{first:012d}"
+        base = os.path.join(self.table_dir, name)
+        embeddings = np.concatenate(self.embeddings)
+
+        pd.DataFrame(self.rows, columns=self.columns).to_parquet(base + ".parquet.tmp", index=False)
+        with open(base + ".npy.tmp", "wb") as f:
+            np.save(f, embeddings)
+        os.replace(base + ".parquet.tmp", base + ".parquet")
+        os.replace(base + ".npy.tmp", base + ".npy")
+        part = {
+                "part": name,
+                "tb_name": self.tb_name,
+                "columns": list(self.columns),
+                "rows": self.pending_rows,
+                "dim": int(embeddings.shape[1]),
+                "shard_index": self.shard_index,
+                "num_shards": self.num_shards,
+                "fingerprint": self.fingerprint,
+                "ranges": ranges,
+                }
+        with open(base + ".json.tmp", "w") as f:
+            json.dump(part, f)
+        os.replace(base + ".json.tmp", base + ".json")
+        logger.debug(f"Wrote {self.pending_rows} rows to {base}")
+        self.rows = []
+        self.embeddings = []
+        self.pending_rows = 0
+
+    def close(self) -> None:
+        self.flush()
+
+
+def list_parts(table_dir: str) -> List[Dict[str, Any]]:
+    """Descriptions of the complete parts of a table, ordered by name"""
+    parts = []
+    for path in sorted(glob.glob(os.path.join(table_dir, "part-*.json"))):
+        with open(path) as f:
+            parts.append(json.load(f))
+    return parts
+
+
+def write_manifest(table_dir: str) -> Dict[str, Any]:
+    """Summarize the complete parts of a table in `manifest.json`"""
+    parts = list_parts(table_dir)
+    manifest = {
+            "tb_name": parts[0]["tb_name"] if parts else None,
+            "columns": parts[0]["columns"] if parts else None,
+            "dim": parts[0]["dim"] if parts else None,
+            "rows": sum(part["rows"] for part in parts),
+            "parts": [{key: part[key] for key in ("part", "rows", "shard_index", "num_shards")} for part in parts],
+            }
+    tmp_path = os.path.join(table_dir, f"manifest.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(table_dir, "manifest.json"))
+    return manifest
+
+
+def remove_part(table_dir: str, name: str) -> None:
+    """Delete a part, its description first so it is never half listed"""
+    for extension in (".json", ".parquet", ".npy"):
+        try:
+            os.remove(os.path.join(table_dir, name + extension))
+        except FileNotFoundError:
+            pass
+
+
+def artifact_resume_offset(
+        table_dir: str,
+        shard_index: int,
+        num_shards: int,
+        fingerprint: str
+        ) -> int:
+    """Source offset up to which a shard's parts are complete
+
+    Parts are written out of order, a stopped run may leave parts after a
+    gap. The resumed run encodes their rows again into parts named after
+    its own batches, so these parts of the shard are deleted: they would
+    be counted and imported twice.
+    """
+    parts = [
+            part for part in list_parts(table_dir)
+            if (part["shard_index"], part["num_shards"], part["fingerprint"]) == (shard_index, num_shards, fingerprint)
+            ]
+    while True:
+        tracker = OffsetTracker(0)
+        for part in parts:
+            tracker.complete([tuple(r) for r in part["ranges"]])
+        beyond = [part for part in parts if any(end > tracker.watermark for _, end in part["ranges"])]
+        if not beyond:
+            return tracker.watermark
+        for part in beyond:
+            logger.warning(f"Removing {part['part']}, it is encoded again after offset {tracker.watermark}")
+            remove_part(table_dir, part["part"])
+        parts = [part for part in parts if part not in beyond]
+
+
+def encode_to_artifacts(
+        tb_name: str,
+        columns: Tuple[str, ...],
+        read_rows: Callable[[int], Iterable[Tuple[str, ...]]],
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        artifact_dir: str,
+        fingerprint: str,
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        shard_index: int = 0,
+        num_shards: int = 1,
+        max_tokens: Optional[int] = None,
+        cache: Optional[EmbeddingCache] = None,
+        dedup: Optional[Deduplicator] = None,
+        ) -> None:
+    """Run the ingestion pipeline into part files, without a database
+
+    A restarted shard resumes after its longest prefix of complete parts.
+    """
+    table_dir = artifact_table_dir(artifact_dir, tb_name)
+    start_offset = artifact_resume_offset(table_dir, shard_index, num_shards, fingerprint)
+    if start_offset:
+        logger.info(f"Resuming encoding of shard {shard_index}/{num_shards} of {tb_name} at offset {start_offset}")
+
+    def _open_writer(hook):
+        return ShardFileWriter(
+                table_dir=table_dir,
+                tb_name=tb_name,
+                columns=columns,
+                fingerprint=fingerprint,
+                shard_index=shard_index,
+                num_shards=num_shards,
+                hook=hook
+                )
+
+    run_pipeline(
+            rows=read_rows(start_offset),
+            content_index=2,
+            context_encoder=context_encoder,
+            context_tokenizer=context_tokenizer,
+            device=device,
+            open_writer=_open_writer,
+            start_offset=start_offset,
+            make_hook=PartRanges,
+            max_tokens=max_tokens,
+            num_tokenizers=num_tokenizers,
+            num_writers=num_writers,
+            cache=cache,
+            dedup=dedup
+            )
+    manifest = write_manifest(table_dir)
+    logger.info(f"{table_dir} holds {manifest['rows']} encoded rows in {len(manifest['parts'])} parts")
+
+
+def import_parts(
+        open_connection: Callable[[], Any],
+        tb_name: str,
+        artifact_dir: str,
+        num_writers: int = 1,
+        shard_index: int = 0,
+        num_shards: int = 1
+        ) -> int:
+    """Bulk-load encoded parts into a table, `num_writers` parts at a time
+
+    Every part is sent in one binary COPY and committed together with its
+    name in the import table, so re-running an import skips the parts
+    already loaded. With `num_shards` > 1 this host only loads every
+    `num_shards`-th part, starting at `shard_index`.
+
+    Args:
+        open_connection: returns a new psycopg2 connection
+        tb_name: table to load
+        artifact_dir: directory given to `--encode_only`
+        num_writers: number of parts loaded concurrently, each over its
+                    own connection
+
+    Returns:
+        number of rows inserted, rows of a part already in the table
+        (by `source_id`) are not
+    """
+    table_dir = artifact_table_dir(artifact_dir, tb_name)
+    parts = list_parts(table_dir)[shard_index::num_shards]
+    connection = open_connection()
+    done = imported_parts(connection, tb_name)
+    connection.close()
+    todo = [part for part in parts if part["part"] not in done]
+    logger.info(f"Importing {len(todo)} of {len(parts)} parts from {table_dir} into {tb_name}")
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def _load(part: Dict[str, Any]) -> int:
+        if not hasattr(local, "connection"):
+            local.connection = open_connection()
+            with lock:
+                connections.append(local.connection)
+        base = os.path.join(table_dir, part["part"])
+        frame = pd.read_parquet(base + ".parquet", columns=part["columns"])
+        embeddings = np.load(base + ".npy", mmap_mode="r")
+        writer = CopyWriter(
+                connection=local.connection,
+                tb_name=tb_name,
+                columns=part["columns"],
+                commit_rows=part["rows"] + 1,
+                commit_bytes=2 ** 62,
+                hook=ImportHook(tb_name, part["part"])
+                )
+        rows = zip(*(frame[column].tolist() for column in part["columns"]))
+        writer.write(rows=list(rows), embeddings=embeddings)
+        writer.close()
+        return writer.written_rows
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, num_writers), thread_name_prefix="import") as pool:
+            loaded = sum(pool.map(_load, todo))
+    finally:
+        for conn in connections:
+            conn.close()
+    logger.info(f"Imported {loaded} new rows from {len(todo)} parts into {tb_name}")
+    return loaded
@@ -0,0 +1,195 @@
+import asyncio
+import re
+from typing import (
+        Any,
+        Dict,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+from database.connection import (
+        DatabaseConfig
+        )
+from database.embedding_versions import (
+        ACTIVE_VERSIONS_SQL,
+        TB_EMBEDDING_VERSIONS,
+        EmbeddingVersion
+        )
+from database.partitions import (
+        PARTITIONS_SQL,
+        merge_top_k
+        )
+from database.query_cache import (
+        SEARCH_CACHE_CHANNEL,
+        QueryCache
+        )
+from database.search import (
+        RERANK_FACTOR,
+        SearchResult,
+        collect_results,
+        hybrid_or_vector_sql,
+        search_settings
+        )
+from database.vector_codec import (
+        decode_vector,
+        encode_vector,
+        to_host_array
+        )
+
+import logging
+logger = logging.getLogger(__name__)
+
+_NAMED_PARAM = re.compile(r"%\((\w+)\)s")
+
+
+def to_positional(sql: str, params: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """Rewrite psycopg2 `%(name)s` placeholders as asyncpg `$n` ones"""
+    names = []
+
+    def _replace(match) -> str:
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    return _NAMED_PARAM.sub(_replace, sql), [params[name] for name in names]
+
+
+async def _init_connection(connection) -> None:
+    """Exchange `vector` values in pgvector's binary format"""
+    await connection.set_type_codec(
+            "vector",
+            encoder=encode_vector,
+            decoder=decode_vector,
+            format="binary"
+            )
+
+
+async def create_async_pool(config: DatabaseConfig):
+    """asyncpg pool with the session settings of `config`"""
+    import asyncpg
+
+    server_settings = {
+            "statement_timeout": str(int(config.statement_timeout_ms)),
+            "synchronous_commit": config.synchronous_commit,
+            }
+    if config.ivfflat_probes > 0:
+        server_settings["ivfflat.probes"] = str(int(config.ivfflat_probes))
+    return await asyncpg.create_pool(
+            database=config.dbname,
+            host=config.host,
+            port=int(config.port),
+            user=config.user,
+            password=config.password,
+            min_size=min(config.pool_min, config.pool_max),
+            max_size=config.pool_max,
+            server_settings=server_settings,
+            init=_init_connection
+            )
+
+
+async def fetch_partitions(pool, tb_name: str) -> List[str]:
+    """Partitions of `tb_name`, empty when it is not partitioned"""
+    async with pool.acquire() as connection:
+        rows = await connection.fetch(PARTITIONS_SQL.format(param="$1"), tb_name)
+    return [row[0] for row in rows]
+
+
+async def fetch_active_versions(pool, tables: Sequence[str]) -> Dict[str, EmbeddingVersion]:
+    """Active embedding version of each of `tables` that was ever migrated"""
+    async with pool.acquire() as connection:
+        if not await connection.fetchval("SELECT to_regclass($1) IS NOT NULL", TB_EMBEDDING_VERSIONS):
+            return {}
+        rows = await connection.fetch(ACTIVE_VERSIONS_SQL.format(param="$1::text[]"), list(tables))
+    return {row["tb_name"]: EmbeddingVersion(*row) for row in rows}
+
+
+async def listen_table_changes(config: DatabaseConfig, cache: QueryCache):
+    """Invalidate `cache` on the table change notifications of writers
+
+    Runs on a dedicated connection, outside the pool. If the connection
+    is lost every cached result is dropped; later changes are only
+    caught by the cache's TTL.
+
+    Returns:
+        the listening connection, to close on shutdown
+    """
+    import asyncpg
+
+    def _on_notify(connection, pid, channel, payload) -> None:
+        cache.invalidate(payload)
+
+    def _on_terminate(connection) -> None:
+        logger.warning("Lost the table change listener, cached results expire by TTL only")
+        cache.invalidate()
+
+    connection = await asyncpg.connect(
+            database=config.dbname,
+            host=config.host,
+            port=int(config.port),
+            user=config.user,
+            password=config.password
+            )
+    await connection.add_listener(SEARCH_CACHE_CHANNEL, _on_notify)
+    connection.add_termination_listener(_on_terminate)
+    return connection
+
+
+async def search_embeddings_async(
+        pool,
+        embeddings,
+        tb_name: str,
+        k: int = 10,
+        probes: Optional[int] = None,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        ef_search: Optional[int] = None,
+        acquire_timeout: Optional[float] = None,
+        quantization: str = "none",
+        rerank: int = RERANK_FACTOR,
+        texts: Optional[Sequence[str]] = None,
+        partitions: Optional[Sequence[str]] = None,
+        column: str = "embedd"
+        ) -> SearchResult:
+    """asyncio counterpart of `search.search_embeddings`
+
+    Same SQL (one LATERAL top-k per query, one round-trip), sent over an
+    asyncpg pool so waiting on Postgres does not hold a thread.
+
+    With `partitions`, every partition is searched concurrently on its
+    own connection and the per-partition top-k are merged, instead of
+    Postgres scanning them one after the other under a Merge Append.
+    Hybrid searches are not fanned out: fused ranks of partitions do not
+    merge into the ranks of the whole table. `column` is the embedding
+    column of the table's active version, see `fetch_active_versions`.
+    """
+    if partitions and texts is None:
+        results = await asyncio.gather(*(
+                search_embeddings_async(
+                    pool,
+                    embeddings,
+                    tb_name=partition,
+                    k=k,
+                    probes=probes,
+                    filters=filters,
+                    ef_search=ef_search,
+                    acquire_timeout=acquire_timeout,
+                    quantization=quantization,
+                    rerank=rerank,
+                    column=column
+                    )
+                for partition in partitions
+                ))
+        ids, scores = merge_top_k([r.ids for r in results], [r.scores for r in results], k)
+        return SearchResult(ids=ids, scores=scores)
+    queries = to_host_array(embeddings)
+    sql, params = hybrid_or_vector_sql(tb_name, filters, quantization, texts, column=column, dim=queries.shape[1])
+    params.update(queries=list(queries), k=k, candidates=k * rerank)
+    sql, args = to_positional(sql, params)
+    async with pool.acquire(timeout=acquire_timeout) as connection:
+        async with connection.transaction():
+            for name, value in search_settings(probes=probes, ef_search=ef_search):
+                await connection.execute("SELECT set_config($1, $2, true)", name, value)
+            rows = await connection.fetch(sql, *args)
+    return collect_results([tuple(row) for row in rows], num_queries=len(queries), k=k)
@@ -0,0 +1,264 @@
+import os
+import platform
+import shutil
+import tempfile
+import time
+from typing import (
+        Any,
+        Dict,
+        List,
+        Optional
+        )
+
+import torch
+from transformers import (
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+from data.make_data import (
+        CsvSource
+        )
+from data.synthetic import (
+        synthetic_snippets,
+        write_synthetic_csv
+        )
+from database import make_database
+from database.pipeline import (
+        BATCH,
+        run_pipeline
+        )
+from database.writers import (
+        COMMIT_BYTES,
+        COMMIT_ROWS,
+        NullWriter,
+        make_writer
+        )
+
+import logging
+logger = logging.getLogger(__name__)
+
+BENCHMARK_SHAPES = ("wiki", "client")
+BENCHMARK_SINKS = ("null", "postgres")
+# time per row is reported for these, in pipeline order
+BREAKDOWN = ("read", "tokenize", "encode", "serialize", "send", "commit")
+# (mean words, std words, length distribution) of each data shape
+SHAPE_LENGTHS = {
+        "wiki": (100, 0, "fixed"),
+        "client": (200, 150, "lognormal"),
+        }
+
+
+def _table_exists(tb_name: str) -> bool:
+    connection = make_database.connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (tb_name,))
+            exists = cursor.fetchone()[0]
+        connection.commit()
+        return exists
+    finally:
+        connection.close()
+
+
+def _drop_table(tb_name: str) -> None:
+    connection = make_database.connect()
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {tb_name}")
+    connection.autocommit = False
+    connection.close()
+
+
+def breakdown(stages: List[Dict[str, float]]) -> Dict[str, float]:
+    """Busy seconds of every step in `BREAKDOWN`
+
+    The write stage is split into its writers' serialize, send and
+    commit time; writer threads overlap, so these are summed over them.
+    """
+    times = {}
+    for summary in stages:
+        if summary["stage"] in BREAKDOWN:
+            times[summary["stage"]] = summary["busy_sec"]
+        for phase in BREAKDOWN:
+            if f"{phase}_sec" in summary:
+                times[phase] = summary[f"{phase}_sec"]
+    return {step: times[step] for step in BREAKDOWN if step in times}
+
+
+def run_ingestion_benchmark(
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        shape: str = "wiki",
+        num_rows: int = 10000,
+        mean_words: Optional[int] = None,
+        std_words: Optional[int] = None,
+        distribution: Optional[str] = None,
+        seed: int = 0,
+        sink: str = "null",
+        tb_name: str = "ingest_bench",
+        bulk_load: bool = False,
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        max_tokens: Optional[int] = None,
+        keep_table: bool = False
+        ) -> Dict[str, Any]:
+    """Time the ingestion pipeline on synthetic data
+
+    The rows go through the same reading code as `insert_knowledges` /
+    `insert_client_knowledges` (a synthetic CSV is written and streamed
+    back for the `client` shape) and the same pipeline, without
+    checkpoints, cache or deduplication. With the `null` sink rows are
+    serialized as for COPY and discarded, with `postgres` they are
+    written to a new table `tb_name`, dropped afterwards unless
+    `keep_table`.
+
+    Args:
+        context_encoder: a model that encodes data to embedding
+        context_tokenizer: a tokenizer that creates input for `context_encoder`
+        device: device the encoder runs on
+        shape: `wiki` (snippets) or `client` (csv knowledge)
+        num_rows: number of synthetic rows
+        mean_words, std_words, distribution: passage lengths, see
+                    `data.synthetic.passage_lengths`; `SHAPE_LENGTHS` of
+                    the shape by default
+        seed: random seed of the synthetic data
+        sink: `null` or `postgres`
+        tb_name: table written by the `postgres` sink, must not exist
+        bulk_load: write with binary COPY instead of INSERT
+        num_tokenizers: number of tokenizer threads
+        num_writers: number of writer threads
+        max_tokens: encode length-bucketed batches, see `IngestionPipeline`
+        keep_table: keep the table written by the `postgres` sink
+
+    Returns:
+        a JSON serializable report: configuration, environment, rows/s
+        and the per-stage breakdown
+    """
+    if shape not in BENCHMARK_SHAPES:
+        raise ValueError(f"Unknown data shape {shape}, expected one of {BENCHMARK_SHAPES}")
+    if sink not in BENCHMARK_SINKS:
+        raise ValueError(f"Unknown sink {sink}, expected one of {BENCHMARK_SINKS}")
+    default_mean, default_std, default_distribution = SHAPE_LENGTHS[shape]
+    mean_words = mean_words or default_mean
+    std_words = default_std if std_words is None else std_words
+    distribution = distribution or default_distribution
+
+    if shape == "wiki":
+        columns = make_database.WIKI_TEXT_COLUMNS + ("source_id",)
+    else:
+        columns = make_database.CLIENT_TEXT_COLUMNS + ("source_id",)
+
+    work_dir = tempfile.mkdtemp(prefix="ingest_bench_")
+    if shape == "wiki":
+        rows = make_database.wiki_rows(synthetic_snippets(num_rows, mean_words, std_words, distribution, seed))
+    else:
+        path = write_synthetic_csv(
+                os.path.join(work_dir, "knowledge.csv"),
+                num_rows,
+                mean_words,
+                std_words,
+                distribution,
+                seed
+                )
+        rows = make_database.client_rows(CsvSource(path, num_rows=num_rows))
+
+    if sink == "postgres":
+        if _table_exists(tb_name):
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise ValueError(f"{tb_name} already exists, benchmark into a new table")
+        if shape == "wiki":
+            make_database.create_wiki_table(tb_name=tb_name)
+        else:
+            make_database.create_client_table(tb_name=tb_name)
+
+    def _open_writer(hook):
+        if sink == "null":
+            return NullWriter(columns=columns)
+        return make_writer(
+                connection=make_database.connect(),
+                tb_name=tb_name,
+                columns=columns,
+                bulk_load=bulk_load,
+                hook=hook
+                )
+
+    logger.info(f"Benchmarking {num_rows} {shape} rows into the {sink} sink")
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    try:
+        started = time.perf_counter()
+        stages = run_pipeline(
+                rows=rows,
+                content_index=2,
+                context_encoder=context_encoder,
+                context_tokenizer=context_tokenizer,
+                device=device,
+                open_writer=_open_writer,
+                max_tokens=max_tokens,
+                num_tokenizers=num_tokenizers,
+                num_writers=num_writers
+                )
+        elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if sink == "postgres" and not keep_table:
+            _drop_table(tb_name)
+
+    written = next(summary["rows"] for summary in stages if summary["stage"] == "write")
+    times = breakdown(stages)
+    return {
+            "config": {
+                    "shape": shape,
+                    "rows": num_rows,
+                    "mean_words": mean_words,
+                    "std_words": std_words,
+                    "distribution": distribution,
+                    "seed": seed,
+                    "sink": sink,
+                    "bulk_load": bulk_load,
+                    "num_tokenizers": num_tokenizers,
+                    "num_writers": num_writers,
+                    "max_tokens": max_tokens,
+                    "batch": BATCH,
+                    "commit_rows": COMMIT_ROWS,
+                    "commit_bytes": COMMIT_BYTES,
+                    },
+            "environment": {
+                    "device": str(device),
+                    "torch": torch.__version__,
+                    "python": platform.python_version(),
+                    "cpus": os.cpu_count(),
+                    "host": platform.node(),
+                    },
+            "started": started_at,
+            "elapsed_sec": round(elapsed, 3),
+            "rows_per_sec": round(written / elapsed, 1) if elapsed else 0.0,
+            "breakdown_sec": times,
+            "breakdown_ms_per_row": {
+                    step: round(1000 * seconds / written, 4) if written else 0.0
+                    for step, seconds in times.items()
+                    },
+            "stages": stages,
+            }
+
+
+def compare_reports(baseline: Dict[str, Any], report: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Throughput and per-step times of a run against a baseline run
+
+    `change` is relative, positive is better (more rows/s, less time).
+    """
+    rows = []
+
+    def _row(metric: str, before: float, after: float, higher_is_better: bool) -> None:
+        change = ""
+        if before:
+            change = (after - before) / before * (1 if higher_is_better else -1)
+            change = f"{change:+.1%}"
+        rows.append({"metric": metric, "baseline": before, "current": after, "change": change})
+
+    _row("rows_per_sec", baseline.get("rows_per_sec", 0.0), report["rows_per_sec"], True)
+    before = baseline.get("breakdown_ms_per_row", {})
+    for step, after in report["breakdown_ms_per_row"].items():
+        _row(f"{step}_ms_per_row", before.get(step, 0.0), after, False)
+    return rows
@@ -0,0 +1,335 @@
+import hashlib
+import os
+import threading
+from typing import (
+        Callable,
+        List,
+        Optional,
+        Tuple
+        )
+
+from psycopg2.extras import execute_values
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+TB_CHECKPOINT=os.getenv("TB_CHECKPOINT", "ingest_checkpoint")
+TB_IMPORT=os.getenv("TB_IMPORT", "artifact_import")
+
+
+# a checkpoint keeps its seek point unless the new one is further into the
+# same source
+_KEEP_SEEK = ("c.fingerprint = EXCLUDED.fingerprint "
+              "AND (EXCLUDED.seek_row IS NULL OR EXCLUDED.seek_row <= c.seek_row)")
+
+
+def dataset_fingerprint(*parts) -> str:
+    """Identify the source a checkpoint offset refers to
+
+    Args:
+        parts: anything that changes the order or content of the source
+                stream (dataset name and version, file path, size, ...)
+    """
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def create_checkpoint_table(cursor) -> None:
+    """Create the table holding one ingestion checkpoint per shard
+
+    `seek_row`/`seek_position` optionally locate a record at or before
+    the offset in the source file (row number, byte offset), a resumed
+    load starts reading there.
+    """
+    cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {TB_CHECKPOINT} (
+            tb_name TEXT NOT NULL,
+            shard_index INT NOT NULL,
+            num_shards INT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            source_offset BIGINT NOT NULL DEFAULT 0,
+            seek_row BIGINT,
+            seek_position BIGINT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (tb_name, shard_index, num_shards));
+            ALTER TABLE {TB_CHECKPOINT}
+            ADD COLUMN IF NOT EXISTS seek_row BIGINT,
+            ADD COLUMN IF NOT EXISTS seek_position BIGINT;
+            ''')
+
+
+def load_checkpoint(
+        connection,
+        tb_name: str,
+        shard_index: int,
+        num_shards: int,
+        fingerprint: str
+        ) -> int:
+    """Get the source offset a shard can resume from
+
+    Returns 0 when the shard has no checkpoint yet, or when it was written
+    for a different source (its offset would point to other rows).
+    """
+    return load_checkpoint_seek(connection, tb_name, shard_index, num_shards, fingerprint)[0]
+
+
+def load_checkpoint_seek(
+        connection,
+        tb_name: str,
+        shard_index: int,
+        num_shards: int,
+        fingerprint: str
+        ) -> Tuple[int, Optional[Tuple[int, int]]]:
+    """Get the source offset a shard can resume from and its seek point
+
+    Returns:
+        (offset, (row number, byte offset) to start reading at or None),
+        see `load_checkpoint`
+    """
+    with connection.cursor() as cursor:
+        create_checkpoint_table(cursor)
+        cursor.execute(f'''
+                SELECT fingerprint, source_offset, seek_row, seek_position FROM {TB_CHECKPOINT}
+                WHERE tb_name = %s AND shard_index = %s AND num_shards = %s
+                ''', (tb_name, shard_index, num_shards))
+        result = cursor.fetchone()
+    connection.commit()
+    if result is None:
+        return 0, None
+    if result[0] != fingerprint:
+        logger.warning(f"Checkpoint of {tb_name} shard {shard_index}/{num_shards} "
+                       "was written for another source, starting from the beginning")
+        return 0, None
+    return result[1], (result[2], result[3]) if result[2] is not None else None
+
+
+def save_checkpoint(
+        cursor,
+        tb_name: str,
+        shard_index: int,
+        num_shards: int,
+        fingerprint: str,
+        source_offset: int,
+        seek: Optional[Tuple[int, int]] = None
+        ) -> None:
+    """Record a shard's committed source offset
+
+    Meant to run inside the transaction that commits the rows, so the
+    checkpoint never gets ahead of the data. The offset only moves
+    forward for a given source, and so does the seek point.
+    """
+    seek_row, seek_position = seek if seek is not None else (None, None)
+    cursor.execute(f'''
+            INSERT INTO {TB_CHECKPOINT} AS c
+            (tb_name, shard_index, num_shards, fingerprint, source_offset, seek_row, seek_position)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (tb_name, shard_index, num_shards) DO UPDATE SET
+            source_offset = CASE WHEN c.fingerprint = EXCLUDED.fingerprint
+                THEN GREATEST(c.source_offset, EXCLUDED.source_offset)
+                ELSE EXCLUDED.source_offset END,
+            seek_row = CASE WHEN {_KEEP_SEEK} THEN c.seek_row ELSE EXCLUDED.seek_row END,
+            seek_position = CASE WHEN {_KEEP_SEEK} THEN c.seek_position ELSE EXCLUDED.seek_position END,
+            fingerprint = EXCLUDED.fingerprint,
+            updated_at = now()
+            ''', (tb_name, shard_index, num_shards, fingerprint, source_offset, seek_row, seek_position))
+
+
+def move_checkpoints(cursor, from_tb: str, to_tb: str) -> None:
+    """Carry the checkpoints of `from_tb` over to `to_tb`
+
+    Used when a staging table is swapped into its target table.
+    """
+    create_checkpoint_table(cursor)
+    cursor.execute(f'''
+            INSERT INTO {TB_CHECKPOINT} AS c
+            (tb_name, shard_index, num_shards, fingerprint, source_offset, seek_row, seek_position)
+            SELECT %s, shard_index, num_shards, fingerprint, source_offset, seek_row, seek_position
+            FROM {TB_CHECKPOINT} WHERE tb_name = %s
+            ON CONFLICT (tb_name, shard_index, num_shards) DO UPDATE SET
+            source_offset = CASE WHEN c.fingerprint = EXCLUDED.fingerprint
+                THEN GREATEST(c.source_offset, EXCLUDED.source_offset)
+                ELSE EXCLUDED.source_offset END,
+            seek_row = CASE WHEN {_KEEP_SEEK} THEN c.seek_row ELSE EXCLUDED.seek_row END,
+            seek_position = CASE WHEN {_KEEP_SEEK} THEN c.seek_position ELSE EXCLUDED.seek_position END,
+            fingerprint = EXCLUDED.fingerprint,
+            updated_at = now();
+            DELETE FROM {TB_CHECKPOINT} WHERE tb_name = %s;
+            ''', (to_tb, from_tb, from_tb))
+
+
+class OffsetTracker:
+    """Low watermark of committed source offsets
+
+    Batches may be committed out of order by several writers, the
+    watermark is the end of the longest committed prefix of the stream.
+    Everything before it is durable; rows after it may be replayed on
+    resume and are skipped by their unique `source_id`.
+    """
+    def __init__(self, start_offset: int = 0) -> None:
+        self.watermark = start_offset
+        self.committed = {}
+        self.lock = threading.Lock()
+
+    def _advance(self, watermark: int, committed: dict) -> int:
+        while watermark in committed:
+            watermark = committed[watermark]
+        return watermark
+
+    def watermark_with(self, ranges: List[Tuple[int, int]]) -> int:
+        """Watermark as it would be once `ranges` are committed"""
+        with self.lock:
+            committed = dict(self.committed)
+            committed.update(ranges)
+            return self._advance(self.watermark, committed)
+
+    def complete(self, ranges: List[Tuple[int, int]]) -> int:
+        """Mark `ranges` as committed and return the new watermark"""
+        with self.lock:
+            self.committed.update(ranges)
+            watermark = self._advance(self.watermark, self.committed)
+            for start in [s for s in self.committed if s < watermark]:
+                del self.committed[start]
+            self.watermark = watermark
+            return watermark
+
+
+class CheckpointHook:
+    """Writes a shard checkpoint in the same transaction as a writer's rows
+
+    One hook belongs to one writer: `add` registers the source range of
+    every batch handed to the writer, and the writer calls
+    `before_commit`/`after_commit` around each commit.
+
+    Args:
+        seek_point: returns the (row number, byte offset) of a record at or
+                before a source offset, if the source can seek to one
+    """
+    def __init__(
+            self,
+            tracker: OffsetTracker,
+            tb_name: str,
+            shard_index: int,
+            num_shards: int,
+            fingerprint: str,
+            seek_point: Optional[Callable[[int], Optional[Tuple[int, int]]]] = None
+            ) -> None:
+        self.tracker = tracker
+        self.tb_name = tb_name
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.fingerprint = fingerprint
+        self.seek_point = seek_point
+        self.pending = []
+
+    def add(self, start: int, end: int) -> None:
+        self.pending.append((start, end))
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self.pending)
+
+    def before_commit(self, cursor) -> None:
+        watermark = self.tracker.watermark_with(self.pending)
+        save_checkpoint(
+                cursor,
+                tb_name=self.tb_name,
+                shard_index=self.shard_index,
+                num_shards=self.num_shards,
+                fingerprint=self.fingerprint,
+                source_offset=watermark,
+                seek=self.seek_point(watermark) if self.seek_point is not None else None
+                )
+
+    def after_commit(self) -> None:
+        self.tracker.complete(self.pending)
+        self.pending = []
+
+
+def create_import_table(cursor) -> None:
+    """Create the table listing the artifact parts loaded into each table"""
+    cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {TB_IMPORT} (
+            tb_name TEXT NOT NULL,
+            part TEXT NOT NULL,
+            imported_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (tb_name, part));
+            ''')
+
+
+def imported_parts(connection, tb_name: str) -> set:
+    """Names of the artifact parts already loaded into `tb_name`"""
+    with connection.cursor() as cursor:
+        create_import_table(cursor)
+        cursor.execute(f"SELECT part FROM {TB_IMPORT} WHERE tb_name = %s", (tb_name,))
+        result = {row[0] for row in cursor.fetchall()}
+    connection.commit()
+    return result
+
+
+class ImportHook:
+    """Records an artifact part as loaded in the transaction of its rows"""
+    def __init__(self, tb_name: str, part: str) -> None:
+        self.tb_name = tb_name
+        self.part = part
+        self.has_pending = True
+
+    def before_commit(self, cursor) -> None:
+        cursor.execute(f'''
+                INSERT INTO {TB_IMPORT} (tb_name, part) VALUES (%s, %s)
+                ON CONFLICT DO NOTHING
+                ''', (self.tb_name, self.part))
+
+    def after_commit(self) -> None:
+        self.has_pending = False
+
+
+def duplicates_table_name(tb_name: str) -> str:
+    return f"{tb_name}_duplicates"
+
+
+def create_duplicates_table(cursor, tb_name: str) -> None:
+    """Create the table linking skipped duplicate passages to canonical rows"""
+    cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {duplicates_table_name(tb_name)} (
+            source_id TEXT PRIMARY KEY,
+            canonical_source_id TEXT NOT NULL,
+            similarity REAL NOT NULL);
+            ''')
+
+
+class LinkHook:
+    """Adds duplicate links to the transaction of a writer's rows
+
+    Wraps the writer's `CheckpointHook`, so links and rows are committed
+    together with the checkpoint that skips them on resume.
+    """
+    def __init__(self, hook: CheckpointHook, tb_name: str) -> None:
+        self.hook = hook
+        self.table = duplicates_table_name(tb_name)
+        self.links = []
+
+    def add(self, start: int, end: int) -> None:
+        self.hook.add(start, end)
+
+    def add_links(self, links: List[Tuple[str, str, float]]) -> None:
+        self.links.extend(links)
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self.links) or self.hook.has_pending
+
+    def before_commit(self, cursor) -> None:
+        if self.links:
+            execute_values(
+                    cursor,
+                    f"INSERT INTO {self.table} (source_id, canonical_source_id, similarity) "
+                    "VALUES %s ON CONFLICT DO NOTHING",
+                    self.links
+                    )
+        self.hook.before_commit(cursor)
+
+    def after_commit(self) -> None:
+        self.links = []
+        self.hook.after_commit()
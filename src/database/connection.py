@@ -0,0 +1,276 @@
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import (
+        Any,
+        Callable,
+        Dict,
+        Optional
+        )
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+PGDBNAME=os.getenv("PGDBNAME", "wiki_pgvector")
+PGHOST=os.getenv("PGHOST", "localhost")
+PGPORT=os.getenv("PGPORT", "5432")
+PGUSER=os.getenv("PGUSER", "wiki_ad")
+PGPWD=os.getenv("PGPWD", "55235")
+PG_POOL_MIN=int(os.getenv("PG_POOL_MIN", 1))
+PG_POOL_MAX=int(os.getenv("PG_POOL_MAX", 16))
+PG_POOL_TIMEOUT=float(os.getenv("PG_POOL_TIMEOUT", 60))
+PG_STATEMENT_TIMEOUT_MS=int(os.getenv("PG_STATEMENT_TIMEOUT_MS", 0))
+PG_SYNCHRONOUS_COMMIT=os.getenv("PG_SYNCHRONOUS_COMMIT", "on")
+PG_IVFFLAT_PROBES=int(os.getenv("PG_IVFFLAT_PROBES", 0))
+PG_RETRIES=int(os.getenv("PG_RETRIES", 5))
+PG_RETRY_BACKOFF=float(os.getenv("PG_RETRY_BACKOFF", 0.5))
+
+# connection lost / server shutting down / too many connections /
+# serialization failure / deadlock: worth another attempt
+TRANSIENT_PGCODES = {"08000", "08003", "08006", "53300", "57P01", "57P02", "57P03", "40001", "40P01"}
+
+
+def is_transient(err: BaseException) -> bool:
+    """Whether an error may go away by retrying"""
+    if isinstance(err, psycopg2.errors.QueryCanceled):
+        return False
+    if getattr(err, "pgcode", None) in TRANSIENT_PGCODES:
+        return True
+    return isinstance(err, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def retry(
+        func: Callable[..., Any],
+        *args,
+        retries: int = PG_RETRIES,
+        backoff: float = PG_RETRY_BACKOFF,
+        **kwargs
+        ) -> Any:
+    """Call `func`, retrying transient database errors with exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except (psycopg2.Error, psycopg2.pool.PoolError) as err:
+            if attempt == retries or not is_transient(err):
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.warning(f"Transient database error ({err}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def retry_transient(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Decorator form of `retry` for idempotent database operations"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return retry(func, *args, **kwargs)
+    return wrapper
+
+
+def _or_default(value, default):
+    return default if value is None else value
+
+
+class DatabaseConfig:
+    """Where to connect and the session settings of every connection
+
+    Args:
+        dbname, host, port, user, password: connection parameters
+        statement_timeout_ms: `statement_timeout` of a session, 0 disables it
+        synchronous_commit: `synchronous_commit` of a session, `off` trades
+                    the durability of the last commits for commit latency
+        ivfflat_probes: `ivfflat.probes` of a session, 0 keeps the default
+        pool_min: connections opened up front
+        pool_max: connections open at most, callers wait for a free one
+    """
+    def __init__(
+            self,
+            dbname: str = PGDBNAME,
+            host: str = PGHOST,
+            port: str = PGPORT,
+            user: str = PGUSER,
+            password: str = PGPWD,
+            statement_timeout_ms: int = PG_STATEMENT_TIMEOUT_MS,
+            synchronous_commit: str = PG_SYNCHRONOUS_COMMIT,
+            ivfflat_probes: int = PG_IVFFLAT_PROBES,
+            pool_min: int = PG_POOL_MIN,
+            pool_max: int = PG_POOL_MAX
+            ) -> None:
+        self.dbname = dbname
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.statement_timeout_ms = statement_timeout_ms
+        self.synchronous_commit = synchronous_commit
+        self.ivfflat_probes = ivfflat_probes
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+
+    @classmethod
+    def from_args(cls, args) -> "DatabaseConfig":
+        """Command line options, falling back to the environment when unset"""
+        return cls(
+                dbname=args.dbname or PGDBNAME,
+                host=args.host or PGHOST,
+                port=args.port or PGPORT,
+                user=args.user or PGUSER,
+                password=args.pwd or PGPWD,
+                statement_timeout_ms=_or_default(args.statement_timeout_ms, PG_STATEMENT_TIMEOUT_MS),
+                synchronous_commit=args.synchronous_commit or PG_SYNCHRONOUS_COMMIT,
+                ivfflat_probes=_or_default(args.ivfflat_probes, PG_IVFFLAT_PROBES),
+                pool_min=PG_POOL_MIN,
+                pool_max=_or_default(args.pool_size, PG_POOL_MAX)
+                )
+
+    def connect_kwargs(self, **overrides) -> Dict[str, Any]:
+        kwargs = {
+                "dbname": self.dbname,
+                "host": self.host,
+                "port": self.port,
+                "user": self.user,
+                "password": self.password,
+                }
+        kwargs.update(overrides)
+        return kwargs
+
+    def session_sql(self) -> str:
+        """Statements run on every checkout, they also reset what the
+        previous user of the connection changed"""
+        statements = [
+                "RESET ALL",
+                f"SET statement_timeout = {int(self.statement_timeout_ms)}",
+                f"SET synchronous_commit = {self.synchronous_commit}",
+                ]
+        if self.ivfflat_probes > 0:
+            statements.append(f"SET ivfflat.probes = {int(self.ivfflat_probes)}")
+        return "; ".join(statements)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection whose `close` hands it back to its pool
+
+    Code written against plain connections (`connect()` ... `close()`)
+    reuses warm connections without changes.
+    """
+    pool: Optional["ConnectionPool"] = None
+
+    def close(self) -> None:
+        pool = self.pool
+        if pool is None or pool.closed or self.closed:
+            super().close()
+        else:
+            pool.putconn(self)
+
+
+class ConnectionPool:
+    """Thread-safe pool of configured, health-checked connections
+
+    `getconn` blocks while all `pool_max` connections are in use. Every
+    checkout runs the session settings in one round-trip, which is also
+    the health check: a connection that fails it is discarded and a new
+    one is opened, with backoff on transient errors.
+
+    Args:
+        config: connection parameters and session settings
+    """
+    def __init__(self, config: DatabaseConfig) -> None:
+        self.config = config
+        self.closed = False
+        self.slots = threading.BoundedSemaphore(config.pool_max)
+        self.pool = retry(
+                ThreadedConnectionPool,
+                min(config.pool_min, config.pool_max),
+                config.pool_max,
+                connection_factory=PooledConnection,
+                **config.connect_kwargs()
+                )
+
+    def _checkout(self) -> PooledConnection:
+        connection = self.pool.getconn()
+        try:
+            connection.autocommit = False
+            with connection.cursor() as cursor:
+                cursor.execute(self.config.session_sql())
+            connection.commit()
+        except psycopg2.Error:
+            connection.pool = None
+            self.pool.putconn(connection, close=True)
+            raise
+        connection.pool = self
+        return connection
+
+    def getconn(self, timeout: float = PG_POOL_TIMEOUT) -> PooledConnection:
+        """Check a connection out, close it (or `putconn`) to return it"""
+        if not self.slots.acquire(timeout=timeout):
+            raise psycopg2.pool.PoolError(f"No free connection after {timeout}s")
+        try:
+            return retry(self._checkout)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, connection: PooledConnection) -> None:
+        """Return a connection, rolling back an unfinished transaction"""
+        connection.pool = None
+        broken = connection.closed or connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        try:
+            self.pool.putconn(connection, close=broken)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """`with pool.connection() as connection:` checks out and returns"""
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def closeall(self) -> None:
+        self.closed = True
+        self.pool.closeall()
+
+
+_pool: Optional[ConnectionPool] = None
+_config: Optional[DatabaseConfig] = None
+_pool_lock = threading.Lock()
+
+
+def configure(config: DatabaseConfig) -> None:
+    """Use `config` for every later connection of this process"""
+    global _pool, _config
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+        _config = config
+
+
+def get_config() -> DatabaseConfig:
+    return _config or DatabaseConfig()
+
+
+def get_pool() -> ConnectionPool:
+    """The process-wide pool, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(get_config())
+        return _pool
+
+
+def connect_admin() -> psycopg2.extensions.connection:
+    """Unpooled connection to the `postgres` maintenance database"""
+    return retry(psycopg2.connect, **get_config().connect_kwargs(dbname="postgres"))
@@ -0,0 +1,589 @@
+import os
+import re
+import time
+from typing import (
+        Dict,
+        Iterator,
+        List,
+        Optional,
+        Tuple
+        )
+
+import torch
+from psycopg2.extras import execute_values
+from transformers import (
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+from database import make_database
+from database.partitions import (
+        list_partitions
+        )
+from database.pipeline import (
+        BATCH,
+        run_pipeline
+        )
+from database.query_cache import (
+        notify_table_changed
+        )
+from database.search import (
+        EMBEDD_DIM,
+        QUESTION_MODEL_NAME
+        )
+from database.vector_codec import (
+        register_vector_adapter,
+        to_host_array
+        )
+from database.writers import (
+        EmbeddingColumnWriter
+        )
+from model.retriever_model import (
+        get_ctx_embd
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+TB_EMBEDDING_VERSIONS=os.getenv("TB_EMBEDDING_VERSIONS", "embedding_versions")
+CONTEXT_MODEL_NAME=os.getenv("CONTEXT_MODEL_NAME", "vblagoje/dpr-ctx_encoder-single-lfqa-wiki")
+MIGRATE_PAGE_ROWS=int(os.getenv("MIGRATE_PAGE_ROWS", 5000))
+MIGRATE_MAX_ROWS_PER_SEC=float(os.getenv("MIGRATE_MAX_ROWS_PER_SEC", 0))
+# rows left to encode under the switch's lock, and catch-up passes run
+# outside of it to get below that
+MIGRATE_SWITCH_MAX_PENDING=int(os.getenv("MIGRATE_SWITCH_MAX_PENDING", 500))
+MIGRATE_SWITCH_CATCH_UP_PASSES=int(os.getenv("MIGRATE_SWITCH_CATCH_UP_PASSES", 5))
+
+# a version is added `backfilling`, `ready` once its index is built,
+# `active` while readers and writers use it, then `retired`
+VERSION_STATUSES = ("backfilling", "ready", "active", "retired")
+# the `embedd` column tables are created with
+LEGACY_VERSION = "v0"
+# version names end up in column, trigger and index names
+_VERSION_NAME = re.compile(r"^[a-z][a-z0-9_]{0,30}$")
+_VERSION_COLUMNS = "tb_name, version, column_name, model, question_model, dim, status, last_id"
+# active version of each table of `{param}` (a text[])
+ACTIVE_VERSIONS_SQL = f'''
+        SELECT {_VERSION_COLUMNS} FROM {TB_EMBEDDING_VERSIONS}
+        WHERE status = 'active' AND tb_name = ANY({{param}})
+        '''
+
+
+class EmbeddingVersion:
+    """An embedding column of a table and the encoders that fill and query it
+
+    Args:
+        tb_name: table
+        version: name of the version, `v0` is the original `embedd` column
+        column: vector column holding the version's embeddings
+        model: DPR context encoder the passages are encoded with
+        question_model: DPR question encoder of the queries
+        dim: dimensions of the embeddings
+        status: one of `VERSION_STATUSES`
+        last_id: rows up to this id are backfilled
+    """
+    __slots__ = ("tb_name", "version", "column", "model", "question_model", "dim", "status", "last_id")
+
+    def __init__(
+            self,
+            tb_name: str,
+            version: str,
+            column: str,
+            model: str,
+            question_model: str,
+            dim: int,
+            status: str = "active",
+            last_id: int = 0
+            ) -> None:
+        self.tb_name = tb_name
+        self.version = version
+        self.column = column
+        self.model = model
+        self.question_model = question_model
+        self.dim = dim
+        self.status = status
+        self.last_id = last_id
+
+    @classmethod
+    def legacy(cls, tb_name: str) -> "EmbeddingVersion":
+        """Version of a table that was never migrated"""
+        return cls(tb_name, LEGACY_VERSION, "embedd", CONTEXT_MODEL_NAME, QUESTION_MODEL_NAME, EMBEDD_DIM)
+
+    def __repr__(self) -> str:
+        return f"EmbeddingVersion({self.tb_name}.{self.column}, {self.version}, {self.model}, {self.status})"
+
+
+def version_column(version: str) -> str:
+    if not _VERSION_NAME.match(version):
+        raise ValueError(f"Invalid version name {version}, expected lowercase letters, digits and _")
+    return f"embedd_{version}"
+
+
+def create_versions_table(cursor) -> None:
+    """Create the table registering the embedding versions of every table"""
+    cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {TB_EMBEDDING_VERSIONS} (
+            tb_name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            column_name TEXT NOT NULL,
+            model TEXT NOT NULL,
+            question_model TEXT NOT NULL,
+            dim INT NOT NULL,
+            status TEXT NOT NULL,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (tb_name, version));
+            CREATE UNIQUE INDEX IF NOT EXISTS {TB_EMBEDDING_VERSIONS}_active
+            ON {TB_EMBEDDING_VERSIONS} (tb_name) WHERE status = 'active';
+            ''')
+
+
+def _registered(cursor) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (TB_EMBEDDING_VERSIONS,))
+    return cursor.fetchone()[0]
+
+
+def list_versions(tb_name: str) -> List[EmbeddingVersion]:
+    """Every version of a table, the legacy one only if it was never migrated"""
+    connection = make_database.connect()
+    try:
+        with connection.cursor() as cursor:
+            rows = []
+            if _registered(cursor):
+                cursor.execute(f'''
+                        SELECT {_VERSION_COLUMNS} FROM {TB_EMBEDDING_VERSIONS}
+                        WHERE tb_name = %s ORDER BY version
+                        ''', (tb_name,))
+                rows = cursor.fetchall()
+        connection.commit()
+    finally:
+        connection.close()
+    return [EmbeddingVersion(*row) for row in rows] or [EmbeddingVersion.legacy(tb_name)]
+
+
+def active_version(tb_name: str) -> EmbeddingVersion:
+    """Version ingestion writes and searches read"""
+    return next(
+            (version for version in list_versions(tb_name) if version.status == "active"),
+            EmbeddingVersion.legacy(tb_name)
+            )
+
+
+def get_version(tb_name: str, version: str) -> EmbeddingVersion:
+    for candidate in list_versions(tb_name):
+        if candidate.version == version:
+            return candidate
+    raise ValueError(f"{tb_name} has no embedding version {version}")
+
+
+def _set_status(cursor, tb_name: str, version: str, status: str) -> None:
+    cursor.execute(f'''
+            UPDATE {TB_EMBEDDING_VERSIONS} SET status = %s, updated_at = now()
+            WHERE tb_name = %s AND version = %s
+            ''', (status, tb_name, version))
+
+
+def _stale_trigger(tb_name: str, column: str) -> str:
+    return f"{tb_name}_{column}_stale"
+
+
+def add_version(
+        tb_name: str,
+        version: str,
+        model: str,
+        question_model: str,
+        dim: int
+        ) -> EmbeddingVersion:
+    """Add a nullable vector column for a new encoder, to be backfilled
+
+    Adding a nullable column without default only changes the catalog,
+    the table is not rewritten. Until the switch, a trigger resets the
+    new embedding of a row whose content is updated (ingestion and sync
+    keep writing the active column), so the catch-up pass encodes it
+    again. The current version is registered as well, as `v0` for a
+    table that was never migrated.
+
+    Args:
+        tb_name: table to migrate
+        version: name of the new version (`v1`, `mpnet`, ...)
+        model: DPR context encoder of the new version
+        question_model: DPR question encoder matching `model`
+        dim: dimensions of `model`'s embeddings
+    """
+    column = version_column(version)
+    current = active_version(tb_name)
+    trigger = _stale_trigger(tb_name, column)
+    connection = make_database.connect()
+    try:
+        with connection.cursor() as cursor:
+            create_versions_table(cursor)
+            cursor.execute(f'''
+                    INSERT INTO {TB_EMBEDDING_VERSIONS} ({_VERSION_COLUMNS})
+                    VALUES (%s, %s, %s, %s, %s, %s, 'active', 0)
+                    ON CONFLICT DO NOTHING
+                    ''', (tb_name, current.version, current.column, current.model,
+                          current.question_model, current.dim))
+            cursor.execute(f'''
+                    INSERT INTO {TB_EMBEDDING_VERSIONS} ({_VERSION_COLUMNS})
+                    VALUES (%s, %s, %s, %s, %s, %s, 'backfilling', 0)
+                    ''', (tb_name, version, column, model, question_model, dim))
+            cursor.execute(f'''
+                    ALTER TABLE {tb_name} ADD COLUMN IF NOT EXISTS {column} vector({dim});
+
+                    CREATE OR REPLACE FUNCTION {trigger}() RETURNS trigger
+                    LANGUAGE plpgsql AS $$
+                    BEGIN
+                        NEW.{column} := NULL;
+                        RETURN NEW;
+                    END $$;
+
+                    DROP TRIGGER IF EXISTS {trigger} ON {tb_name};
+                    CREATE TRIGGER {trigger} BEFORE UPDATE OF content ON {tb_name}
+                    FOR EACH ROW WHEN (OLD.content IS DISTINCT FROM NEW.content)
+                    EXECUTE FUNCTION {trigger}();
+                    ''')
+        connection.commit()
+    finally:
+        connection.close()
+    logger.info(f"Added {column} vector({dim}) to {tb_name} for {model}")
+    return get_version(tb_name, version)
+
+
+def _page_rows(
+        connection,
+        tb_name: str,
+        column: str,
+        after_id: int,
+        limit: int,
+        pending_only: bool,
+        last_id: List[int]
+        ) -> Iterator[Tuple[int, str, str]]:
+    """`(id, md5 of content, content)` of the next page of rows by id
+
+    Read with a server-side cursor; the last id read is left in `last_id`.
+    """
+    pending = f"AND {column} IS NULL" if pending_only else ""
+    with connection.cursor(name=f"migrate_{column}") as cursor:
+        cursor.itersize = BATCH * 64
+        cursor.execute(f'''
+                SELECT id, md5(coalesce(content, '')), coalesce(content, '') FROM {tb_name}
+                WHERE id > %s {pending}
+                ORDER BY id
+                LIMIT %s
+                ''', (after_id, limit))
+        for row in cursor:
+            last_id[0] = row[0]
+            yield row
+    connection.commit()
+
+
+def _save_progress(connection, tb_name: str, version: str, last_id: int) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+                UPDATE {TB_EMBEDDING_VERSIONS} SET last_id = %s, updated_at = now()
+                WHERE tb_name = %s AND version = %s
+                ''', (last_id, tb_name, version))
+    connection.commit()
+
+
+def _count_pending(connection, tb_name: str, column: str) -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM {tb_name} WHERE {column} IS NULL")
+        result = cursor.fetchone()[0]
+    connection.commit()
+    return result
+
+
+def backfill(
+        version: EmbeddingVersion,
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        page_rows: int = MIGRATE_PAGE_ROWS,
+        max_rows_per_sec: float = MIGRATE_MAX_ROWS_PER_SEC,
+        max_tokens: Optional[int] = None,
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        pending_only: bool = False
+        ) -> int:
+    """Encode the content of a table into a version's column
+
+    The table is read back in pages of `page_rows` rows with keyset
+    pagination on `id` (`WHERE id > last ORDER BY id LIMIT n`, an index
+    range scan however far the backfill got), each page streamed from a
+    server-side cursor through the ingestion pipeline. The last id of
+    every finished page is checkpointed in the registry, a restarted
+    backfill resumes after it. Searches keep reading the active column.
+
+    Args:
+        version: the version to fill, `backfilling`
+        context_encoder: `version.model`
+        context_tokenizer: its tokenizer
+        device: device the encoder runs on
+        page_rows: rows per page (and per checkpoint)
+        max_rows_per_sec: throttle, pages are spaced out so that the
+                    backfill encodes at most this many rows per second on
+                    average, 0 for no limit
+        max_tokens: encode length-bucketed batches, see `IngestionPipeline`
+        num_tokenizers: number of tokenizer threads
+        num_writers: number of writer threads
+        pending_only: catch-up pass over the rows whose embedding is
+                    still NULL (inserted or updated since they were
+                    backfilled), from the first row and not checkpointed
+
+    Returns:
+        number of rows encoded
+    """
+    if version.status in ("active", "retired"):
+        raise ValueError(f"{version} is {version.status}, only new versions are backfilled")
+    connection = make_database.connect()
+    after_id = 0 if pending_only else version.last_id
+    encoded = 0
+    started = time.perf_counter()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT coalesce(max(id), 0) FROM {version.tb_name}")
+            max_id = cursor.fetchone()[0]
+        connection.commit()
+        if after_id:
+            logger.info(f"Resuming the backfill of {version.column} after id {after_id} of {max_id}")
+
+        def _open_writer(hook):
+            return EmbeddingColumnWriter(
+                    connection=make_database.connect(),
+                    tb_name=version.tb_name,
+                    column=version.column
+                    )
+
+        while True:
+            page_started = time.perf_counter()
+            last_id = [after_id]
+            stages = run_pipeline(
+                    rows=_page_rows(
+                        connection, version.tb_name, version.column, after_id, page_rows, pending_only, last_id),
+                    content_index=2,
+                    context_encoder=context_encoder,
+                    context_tokenizer=context_tokenizer,
+                    device=device,
+                    open_writer=_open_writer,
+                    max_tokens=max_tokens,
+                    num_tokenizers=num_tokenizers,
+                    num_writers=num_writers
+                    )
+            rows = next(summary["rows"] for summary in stages if summary["stage"] == "read")
+            if rows == 0:
+                break
+            after_id = last_id[0]
+            encoded += rows
+            if not pending_only:
+                _save_progress(connection, version.tb_name, version.version, after_id)
+            elapsed = time.perf_counter() - started
+            logger.info(f"Backfilled {version.column} of {version.tb_name} up to id {after_id}/{max_id} "
+                        f"({encoded} rows, {encoded / max(elapsed, 1e-9):.1f} rows/s)")
+            if max_rows_per_sec > 0:
+                time.sleep(max(0.0, rows / max_rows_per_sec - (time.perf_counter() - page_started)))
+            if rows < page_rows:
+                break
+        pending = _count_pending(connection, version.tb_name, version.column)
+    finally:
+        connection.close()
+    logger.info(f"{pending} rows of {version.tb_name} still have no {version.column}")
+    return encoded
+
+
+def _vector_indexes(cursor, tb_name: str, column: str) -> Tuple[int, bool]:
+    """Number of ANN indexes on `column` of a table (or its partitions),
+    and whether they are all valid"""
+    cursor.execute('''
+            SELECT count(DISTINCT i.indexrelid), coalesce(bool_and(i.indisvalid), false) FROM pg_index i
+            JOIN pg_class ic ON ic.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = ic.relam
+            JOIN pg_depend d ON d.classid = 'pg_class'::regclass AND d.objid = i.indexrelid
+                AND d.refobjid = i.indrelid
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = d.refobjsubid
+            WHERE am.amname IN ('ivfflat', 'hnsw') AND a.attname = %s
+            AND (i.indrelid = to_regclass(%s)
+                 OR i.indrelid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%s)))
+            ''', (column, tb_name, tb_name))
+    return cursor.fetchone()
+
+
+def build_version_index(
+        version: EmbeddingVersion,
+        method: str = "ivfflat",
+        m: int = 16,
+        ef_construction: int = 64,
+        quantization: str = "none",
+        num_workers: int = 4
+        ) -> None:
+    """Build the ANN index of a backfilled version with `CREATE INDEX CONCURRENTLY`
+
+    Ingestion and searches go on meanwhile. The version is `ready` once
+    every index on its column is valid.
+    """
+    make_database.create_index(
+            tb_name=version.tb_name,
+            method=method,
+            m=m,
+            ef_construction=ef_construction,
+            quantization=quantization,
+            num_workers=num_workers,
+            column=version.column,
+            dim=version.dim,
+            concurrently=True
+            )
+    connection = make_database.connect()
+    try:
+        with connection.cursor() as cursor:
+            num_indexes, valid = _vector_indexes(cursor, version.tb_name, version.column)
+            if not num_indexes or not valid:
+                raise RuntimeError(f"The index of {version.column} on {version.tb_name} was not built, "
+                                   "see the log, drop invalid indexes before building again")
+            if version.status == "backfilling":
+                _set_status(cursor, version.tb_name, version.version, "ready")
+        connection.commit()
+    finally:
+        connection.close()
+    logger.info(f"{version.column} of {version.tb_name} is indexed")
+
+
+def switch(
+        version: EmbeddingVersion,
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        max_pending: int = MIGRATE_SWITCH_MAX_PENDING,
+        max_tokens: Optional[int] = None
+        ) -> None:
+    """Make a `ready` version the active one
+
+    Rows written since the backfill are caught up first, outside of any
+    lock, in up to `MIGRATE_SWITCH_CATCH_UP_PASSES` passes (each one
+    catching up the rows written during the previous one) until at most
+    `max_pending` are left. Those are then encoded in the switching
+    transaction, which holds a SHARE ROW EXCLUSIVE lock: writers wait for
+    it, searches do not. The registry update commits together with the table change
+    notification, servers pick the new column (and question encoder) up
+    on their next poll and drop their cached results of the table.
+
+    Ingestion or sync runs started before the switch keep writing the
+    old column, run them again (or `backfill(pending_only=True)`) after.
+
+    Args:
+        version: the version to activate
+        context_encoder: `version.model`
+        context_tokenizer: its tokenizer
+        device: device the encoder runs on
+        max_pending: rows left to encode under the lock above which the
+                    switch is refused
+        max_tokens: encode length-bucketed batches, see `get_ctx_embd`
+    """
+    if version.status != "ready":
+        raise ValueError(f"{version} is {version.status}, build its index before switching")
+    tb_name, column = version.tb_name, version.column
+    connection = make_database.connect()
+    try:
+        pending = _count_pending(connection, tb_name, column)
+        passes = 0
+        while pending > max_pending and passes < MIGRATE_SWITCH_CATCH_UP_PASSES:
+            backfill(version, context_encoder, context_tokenizer, device, max_tokens=max_tokens, pending_only=True)
+            pending = _count_pending(connection, tb_name, column)
+            passes += 1
+        if pending > max_pending:
+            raise RuntimeError(f"{pending} rows of {tb_name} still have no {column}, "
+                               "pause the writers or raise MIGRATE_SWITCH_CATCH_UP_PASSES")
+
+        register_vector_adapter()
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {tb_name} IN SHARE ROW EXCLUSIVE MODE")
+            cursor.execute(f"SELECT id, coalesce(content, '') FROM {tb_name} WHERE {column} IS NULL")
+            rows = cursor.fetchall()
+            for i in range(0, len(rows), BATCH):
+                batch = rows[i:i + BATCH]
+                embeddings = to_host_array(get_ctx_embd(
+                        model_encoder=context_encoder,
+                        tokenizer=context_tokenizer,
+                        text=[content for _, content in batch],
+                        device=device,
+                        max_tokens=max_tokens
+                        ))
+                execute_values(
+                        cursor,
+                        f"UPDATE {tb_name} t SET {column} = v.embedd FROM (VALUES %s) AS v(id, embedd) WHERE t.id = v.id",
+                        [(row_id, embedding) for (row_id, _), embedding in zip(batch, embeddings)]
+                        )
+            cursor.execute(f'''
+                    UPDATE {TB_EMBEDDING_VERSIONS} SET status = 'retired', updated_at = now()
+                    WHERE tb_name = %s AND status = 'active'
+                    ''', (tb_name,))
+            _set_status(cursor, tb_name, version.version, "active")
+            trigger = _stale_trigger(tb_name, column)
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {tb_name}; DROP FUNCTION IF EXISTS {trigger}();")
+            notify_table_changed(cursor, tb_name)
+        connection.commit()
+    finally:
+        connection.close()
+    logger.info(f"{tb_name} switched to {column} ({version.model}), {len(rows)} rows encoded during the switch")
+
+
+def drop_version(version: EmbeddingVersion) -> None:
+    """Free the storage of a retired version
+
+    The column (and its indexes) of a migrated version is dropped. The
+    original `embedd` column is kept, the rest of the code writes it by
+    default, only its ANN indexes are dropped.
+    """
+    if version.status != "retired":
+        raise ValueError(f"{version} is {version.status}, only retired versions are dropped")
+    connection = make_database.connect()
+    # the index of a partitioned table can not be dropped concurrently
+    concurrently = "" if list_partitions(connection, version.tb_name) else " CONCURRENTLY"
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            if version.column != "embedd":
+                cursor.execute(f"ALTER TABLE {version.tb_name} DROP COLUMN IF EXISTS {version.column}")
+            else:
+                cursor.execute('''
+                        SELECT DISTINCT ic.relname FROM pg_index i
+                        JOIN pg_class ic ON ic.oid = i.indexrelid
+                        JOIN pg_am am ON am.oid = ic.relam
+                        JOIN pg_depend d ON d.classid = 'pg_class'::regclass AND d.objid = i.indexrelid
+                            AND d.refobjid = i.indrelid
+                        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = d.refobjsubid
+                        WHERE am.amname IN ('ivfflat', 'hnsw') AND a.attname = 'embedd'
+                        AND i.indrelid = to_regclass(%s)
+                        ''', (version.tb_name,))
+                for (index,) in cursor.fetchall():
+                    cursor.execute(f"DROP INDEX{concurrently} IF EXISTS {index}")
+                    logger.info(f"Dropped {index}")
+            cursor.execute(
+                    f"DELETE FROM {TB_EMBEDDING_VERSIONS} WHERE tb_name = %s AND version = %s",
+                    (version.tb_name, version.version))
+    finally:
+        connection.close()
+    logger.info(f"Dropped embedding version {version.version} of {version.tb_name}")
+
+
+def version_report(tb_name: str) -> List[Dict[str, object]]:
+    """Versions of a table with the rows each one still misses"""
+    report = []
+    connection = make_database.connect()
+    try:
+        for version in list_versions(tb_name):
+            report.append({
+                    "version": version.version,
+                    "column": version.column,
+                    "model": version.model,
+                    "question_model": version.question_model,
+                    "dim": version.dim,
+                    "status": version.status,
+                    "last_id": version.last_id,
+                    "pending_rows": _count_pending(connection, tb_name, version.column),
+                    })
+    finally:
+        connection.close()
+    return report
@@ -0,0 +1,299 @@
+import asyncio
+import os
+import threading
+from typing import (
+        Any,
+        Callable,
+        Dict,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+
+from database.async_search import (
+        search_embeddings_async
+        )
+from database.search import (
+        RERANK_FACTOR,
+        SearchResult
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+# the first source stops the others once every query has this many hits
+# at least this many standard deviations above its usual scores, 0 never
+FEDERATED_CONFIDENT_Z=float(os.getenv("FEDERATED_CONFIDENT_Z", 2.0))
+FEDERATED_CONFIDENT_HITS=int(os.getenv("FEDERATED_CONFIDENT_HITS", 3))
+# scores a source's statistics need before they are used, and the number
+# of scores they are averaged over
+FEDERATED_MIN_SAMPLES=int(os.getenv("FEDERATED_MIN_SAMPLES", 200))
+FEDERATED_STATS_WINDOW=int(os.getenv("FEDERATED_STATS_WINDOW", 10000))
+
+
+def parse_source_options(value: str, cast: Callable[[str], Any] = float) -> Dict[str, Any]:
+    """Parse per-table options ("client_tb=1.0,wiki_tb=0.7")"""
+    options = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        table, _, option = item.partition("=")
+        if not option:
+            raise ValueError(f"Expected table=value, got {item}")
+        options[table.strip()] = cast(option.strip())
+    return options
+
+
+class FederatedSource:
+    """A table searched by a federated search and its budget
+
+    Args:
+        tb_name: table
+        weight: factor of the table's normalized scores in the merge
+        k: results read from the table, the request's k if None
+        probes: `ivfflat.probes` of the table, the request's if None
+        ef_search: `hnsw.ef_search` of the table, the request's if None
+    """
+    __slots__ = ("tb_name", "weight", "k", "probes", "ef_search")
+
+    def __init__(
+            self,
+            tb_name: str,
+            weight: float = 1.0,
+            k: Optional[int] = None,
+            probes: Optional[int] = None,
+            ef_search: Optional[int] = None
+            ) -> None:
+        self.tb_name = tb_name
+        self.weight = weight
+        self.k = k
+        self.probes = probes
+        self.ef_search = ef_search
+
+    def __repr__(self) -> str:
+        return f"FederatedSource({self.tb_name}, weight={self.weight}, k={self.k}, probes={self.probes})"
+
+
+class ScoreCalibrator:
+    """Running mean and deviation of the scores a source returns
+
+    Inner products of different corpora (and encoders) live on different
+    scales; scores are compared as z-scores against their own source's
+    distribution instead. The statistics follow the latest `window`
+    scores. Until `min_samples` scores were seen, each query's scores
+    are normalized by their own mean and deviation.
+
+    Args:
+        min_samples: scores needed before the running statistics are used
+        window: scores the statistics are averaged over
+    """
+    def __init__(self, min_samples: int = FEDERATED_MIN_SAMPLES, window: int = FEDERATED_STATS_WINDOW) -> None:
+        self.min_samples = min_samples
+        self.window = window
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def calibrated(self) -> bool:
+        return self.count >= self.min_samples
+
+    def update(self, scores: np.ndarray) -> None:
+        """Add the scores of a search, padding (-inf) is skipped"""
+        scores = scores[np.isfinite(scores)].astype(np.float64)
+        if not len(scores):
+            return
+        with self.lock:
+            # Chan's parallel update, older scores weigh at most `window`
+            count = min(self.count, max(self.window - len(scores), 0))
+            m2 = self.m2 * count / self.count if self.count else 0.0
+            total = count + len(scores)
+            delta = scores.mean() - self.mean
+            self.mean += delta * len(scores) / total
+            self.m2 = m2 + ((scores - scores.mean()) ** 2).sum() + delta ** 2 * count * len(scores) / total
+            self.count = total
+
+    def normalize(self, scores: np.ndarray) -> np.ndarray:
+        """z-scores of a (num_queries, k) score array, -inf stays -inf"""
+        finite = np.isfinite(scores)
+        with self.lock:
+            calibrated = self.calibrated
+            mean, std = self.mean, np.sqrt(self.m2 / max(self.count - 1, 1))
+        if calibrated:
+            mean, std = np.float64(mean), np.full((len(scores), 1), std)
+        else:
+            counts = np.maximum(finite.sum(axis=1, keepdims=True), 1)
+            values = np.where(finite, scores, 0.0)
+            mean = values.sum(axis=1, keepdims=True) / counts
+            std = np.sqrt(np.where(finite, (values - mean) ** 2, 0.0).sum(axis=1, keepdims=True) / counts)
+        return np.where(finite, (scores - mean) / np.maximum(std, 1e-6), -np.inf).astype(np.float32)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                    "scores": self.count,
+                    "mean": round(self.mean, 4),
+                    "std": round(float(np.sqrt(self.m2 / max(self.count - 1, 1))), 4),
+                    }
+
+
+class FederatedResult:
+    """Merged top-k of several tables
+
+    Args:
+        ids: (num_queries, k) passage ids, -1 padded
+        scores: weighted calibrated scores in (0, weight), -inf padded
+        sources: index into `tables` of the table of each id, -1 padded
+        tables: searched tables, in source order
+        stopped_early: the first table's hits were confident enough, the
+                    other tables were not waited for
+    """
+    __slots__ = ("ids", "scores", "sources", "tables", "stopped_early")
+
+    def __init__(
+            self,
+            ids: np.ndarray,
+            scores: np.ndarray,
+            sources: np.ndarray,
+            tables: Sequence[str],
+            stopped_early: bool = False
+            ) -> None:
+        self.ids = ids
+        self.scores = scores
+        self.sources = sources
+        self.tables = list(tables)
+        self.stopped_early = stopped_early
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def is_confident(normalized: np.ndarray, hits: int, z: float) -> bool:
+    """Every query has `hits` results of z-score `z` or more"""
+    return bool(((normalized >= z).sum(axis=1) >= hits).all())
+
+
+def merge_sources(
+        results: Sequence[Optional[SearchResult]],
+        normalized: Sequence[Optional[np.ndarray]],
+        weights: Sequence[float],
+        k: int
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge the normalized, weighted top-k of each source into one top-k
+
+    z-scores are mapped to (0, 1) with the logistic approximation of the
+    normal CDF before they are weighted, so a weight scales bad and good
+    hits alike. Sources not searched (None) are skipped.
+
+    Returns:
+        (ids, scores, sources) of shape (num_queries, k), best score first
+    """
+    ids, scores, sources = [], [], []
+    for index, (result, values, weight) in enumerate(zip(results, normalized, weights)):
+        if result is None:
+            continue
+        ids.append(result.ids)
+        scores.append(np.where(np.isfinite(values), weight / (1 + np.exp(-1.702 * values)), -np.inf))
+        sources.append(np.where(result.ids >= 0, index, -1))
+    all_ids = np.concatenate(ids, axis=1)
+    all_scores = np.concatenate(scores, axis=1)
+    all_sources = np.concatenate(sources, axis=1)
+    order = np.argsort(-all_scores, axis=1, kind="stable")[:, :k]
+    return tuple(np.take_along_axis(array, order, axis=1) for array in (all_ids, all_scores, all_sources))
+
+
+async def federated_search_async(
+        pool,
+        embeddings: Dict[str, np.ndarray],
+        sources: Sequence[FederatedSource],
+        calibrators: Dict[str, ScoreCalibrator],
+        k: int = 10,
+        probes: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        columns: Optional[Dict[str, str]] = None,
+        partitions: Optional[Dict[str, Sequence[str]]] = None,
+        quantization: str = "none",
+        rerank: int = RERANK_FACTOR,
+        acquire_timeout: Optional[float] = None,
+        confident_z: float = FEDERATED_CONFIDENT_Z,
+        confident_hits: int = FEDERATED_CONFIDENT_HITS
+        ) -> FederatedResult:
+    """Search several tables concurrently and merge their top-k
+
+    Every source is searched on its own pooled connection with its own
+    `k`, `probes` and `ef_search`. Scores are normalized per source
+    (`ScoreCalibrator`, updated with the scores of this search) and
+    multiplied by the source's weight before the merge.
+
+    The first source has priority: once its calibration is settled, if
+    every query has `confident_hits` hits at `confident_z` or more, the
+    searches of the other sources are cancelled (asyncpg cancels the
+    running query on the server) and the result holds the first
+    source's hits only.
+
+    Args:
+        pool: asyncpg pool, see `async_search.create_async_pool`
+        embeddings: query embeddings of each source's table, tables of
+                    the same question encoder share one array
+        sources: tables to search, the first one has priority
+        calibrators: score statistics of each table
+        k: merged results per query
+        probes, ef_search: index settings of sources that set none
+        columns: embedding column of each table, `embedd` by default
+        partitions: partitions to fan out over, of each table
+        quantization, rerank: see `search.search_embeddings`
+        acquire_timeout: seconds to wait for a pooled connection
+        confident_z: z-score of a confident hit, 0 never stops early
+        confident_hits: confident hits every query needs to stop early
+    """
+    columns = columns or {}
+    partitions = partitions or {}
+
+    def _search(source: FederatedSource):
+        return asyncio.ensure_future(search_embeddings_async(
+                pool,
+                embeddings[source.tb_name],
+                tb_name=source.tb_name,
+                k=source.k or k,
+                probes=probes if source.probes is None else source.probes,
+                ef_search=ef_search if source.ef_search is None else source.ef_search,
+                acquire_timeout=acquire_timeout,
+                quantization=quantization,
+                rerank=rerank,
+                partitions=partitions.get(source.tb_name),
+                column=columns.get(source.tb_name, "embedd")
+                ))
+
+    tasks = [_search(source) for source in sources]
+    results: List[Optional[SearchResult]] = [None] * len(sources)
+    stopped_early = False
+    try:
+        first = calibrators[sources[0].tb_name]
+        if confident_z > 0 and len(sources) > 1 and first.calibrated:
+            results[0] = await tasks[0]
+            stopped_early = is_confident(first.normalize(results[0].scores), confident_hits, confident_z)
+        if not stopped_early:
+            for i, result in enumerate(await asyncio.gather(*tasks)):
+                results[i] = result
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    normalized = []
+    for source, result in zip(sources, results):
+        if result is None:
+            normalized.append(None)
+            continue
+        calibrator = calibrators[source.tb_name]
+        normalized.append(calibrator.normalize(result.scores))
+        calibrator.update(result.scores)
+    ids, scores, origins = merge_sources(results, normalized, [source.weight for source in sources], k)
+    return FederatedResult(ids, scores, origins, [source.tb_name for source in sources], stopped_early)
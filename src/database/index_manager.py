@@ -0,0 +1,211 @@
+import os
+import re
+import time
+from typing import (
+        Any,
+        Dict,
+        Optional
+        )
+
+import numpy as np
+import psycopg2
+import psycopg2.errors
+
+from database import make_database
+from database import tuning
+from database.partitions import (
+        list_partitions
+        )
+from database.search import (
+        EMBEDD_DIM,
+        RERANK_FACTOR,
+        build_search_sql,
+        collect_results,
+        set_search_options
+        )
+from database.vector_codec import (
+        register_vector_adapter
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+# recall@k of the rebuilt index, against exact search, below which the
+# swap is rolled back, and the number of stored passages it is checked on
+INDEX_MIN_RECALL=float(os.getenv("INDEX_MIN_RECALL", 0.8))
+INDEX_CHECK_QUERIES=int(os.getenv("INDEX_CHECK_QUERIES", 50))
+# how long the swap waits for the table lock per attempt, and attempts
+INDEX_SWAP_LOCK_TIMEOUT_MS=int(os.getenv("INDEX_SWAP_LOCK_TIMEOUT_MS", 2000))
+INDEX_SWAP_RETRIES=int(os.getenv("INDEX_SWAP_RETRIES", 5))
+
+
+def index_generation(name: str, base: str) -> int:
+    """Generation of an index named `base` followed by a number, 0 for
+    `base` itself and for indexes named otherwise"""
+    match = re.fullmatch(re.escape(base) + r"(\d*)", name)
+    return int(match.group(1) or 0) if match else 0
+
+
+def _drop_index(cursor, name: str, partitioned: bool) -> None:
+    # indexes of partitioned tables can not be dropped concurrently
+    cursor.execute(f"DROP INDEX {'' if partitioned else 'CONCURRENTLY '}IF EXISTS {name}")
+
+
+def _check_recall(
+        cursor,
+        tb_name: str,
+        vectors: np.ndarray,
+        truth: np.ndarray,
+        k: int,
+        quantization: str,
+        column: str,
+        dim: int,
+        probes: Optional[int]
+        ) -> float:
+    """Recall@k of the batch searched in the current transaction"""
+    sql, params = build_search_sql(tb_name=tb_name, column=column, quantization=quantization, dim=dim)
+    params.update(queries=vectors, k=k, candidates=k * RERANK_FACTOR)
+    set_search_options(cursor, probes=probes)
+    cursor.execute(sql, params)
+    found = collect_results(cursor.fetchall(), num_queries=len(vectors), k=k)
+    return tuning.recall_at_k(found.ids, truth)
+
+
+def rebuild_index(
+        tb_name: str,
+        method: str = "ivfflat",
+        m: int = 16,
+        ef_construction: int = 64,
+        quantization: str = "none",
+        num_workers: int = 4,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM,
+        k: int = 10,
+        num_queries: int = INDEX_CHECK_QUERIES,
+        min_recall: float = INDEX_MIN_RECALL
+        ) -> Dict[str, Any]:
+    """Rebuild the vector index of a table without taking it offline
+
+    The new index is built next to the current one with `CREATE INDEX
+    CONCURRENTLY` under the next generation's name (`make_database.
+    index_name`), searches and writes go on meanwhile. Then, in one
+    transaction, the current index (and any invalid leftover of an
+    earlier build) is dropped and `num_queries` stored passages are
+    searched through the new one; the drop is committed only if their
+    recall@k, against an exact search computed beforehand, reaches
+    `min_recall`. Otherwise it is rolled back and the new index dropped,
+    the table keeps its current index.
+
+    The transaction holds the table's exclusive lock for the duration of
+    one batched search. It waits `INDEX_SWAP_LOCK_TIMEOUT_MS` at most for
+    the lock, so a long running query does not queue searches behind the
+    swap, and is retried `INDEX_SWAP_RETRIES` times.
+
+    Args:
+        tb_name: table (partitioned or not)
+        method: `ivfflat` or `hnsw`
+        m: HNSW maximum number of connections per layer
+        ef_construction: HNSW size of the candidate list while building
+        quantization: `none`, `halfvec` or `binary`
+        num_workers: partitions indexed at the same time
+        column: embedding column of the index, see `embedding_versions`
+        dim: dimensions of `column`
+        k: size of the result list recall is checked on
+        num_queries: number of stored passages searched by the check
+        min_recall: recall@k the new index must reach
+
+    Returns:
+        the table, the dropped and the new index, the recall and whether
+        the new index was swapped in
+    """
+    connection = make_database.connect()
+    connection.autocommit = True
+    try:
+        partitioned = bool(list_partitions(connection, tb_name))
+        current = [name for name, _ in make_database.vector_index_names(
+                connection, tb_name, method, quantization, column=column)]
+    finally:
+        connection.close()
+    base = make_database.index_name(tb_name, method, quantization, column=column)
+    generation = 1 + max((index_generation(name, base) for name in current), default=-1)
+    new_index = make_database.index_name(tb_name, method, quantization, column=column, generation=generation)
+    report = {"table": tb_name, "dropped": ",".join(current), "index": new_index, "recall": "", "swapped": False}
+    logger.info(f"Rebuilding {current or 'the missing index'} of {tb_name} as {new_index}")
+
+    build_error = None
+    try:
+        make_database.create_index(
+                tb_name=tb_name,
+                method=method,
+                m=m,
+                ef_construction=ef_construction,
+                quantization=quantization,
+                num_workers=num_workers,
+                column=column,
+                dim=dim,
+                concurrently=True,
+                generation=generation
+                )
+    except (Exception, psycopg2.Error) as err:
+        # the invalid index a failed concurrent build leaves is dropped below
+        build_error = err
+    connection = make_database.connect()
+    connection.autocommit = True
+    try:
+        built = dict(make_database.vector_index_names(connection, tb_name, method, quantization, column=column))
+        if not built.get(new_index):
+            if new_index in built:
+                with connection.cursor() as cursor:
+                    _drop_index(cursor, new_index, partitioned)
+            raise RuntimeError(f"{new_index} was not built, {tb_name} keeps {current}") from build_error
+        if not current:
+            report["swapped"] = True
+            return report
+
+        # ground truth is computed before the swap takes any lock
+        connection.autocommit = False
+        _, vectors = tuning.sample_query_vectors(connection, tb_name, num_queries, column=column)
+        truth = tuning.exact_top_k(connection, tb_name, vectors, k, column=column)
+        probes = None
+        if method == "ivfflat":
+            probes = make_database.ivfflat_probes(make_database.ivfflat_lists(tuning.estimate_rows(connection, tb_name)))
+        register_vector_adapter()
+
+        recall = None
+        for attempt in range(INDEX_SWAP_RETRIES):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"SET LOCAL lock_timeout = {INDEX_SWAP_LOCK_TIMEOUT_MS}")
+                    for name in current:
+                        cursor.execute(f"DROP INDEX {name}")
+                    recall = _check_recall(cursor, tb_name, vectors, truth, k, quantization, column, dim, probes)
+                    if recall >= min_recall:
+                        connection.commit()
+                    else:
+                        connection.rollback()
+                break
+            except psycopg2.errors.LockNotAvailable:
+                connection.rollback()
+                logger.warning(f"{tb_name} is busy, swap attempt {attempt + 1}/{INDEX_SWAP_RETRIES} gave up the lock")
+                time.sleep(min(30, 2 ** attempt))
+        report["recall"] = "" if recall is None else round(recall, 4)
+        report["swapped"] = recall is not None and recall >= min_recall
+
+        if not report["swapped"]:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                _drop_index(cursor, new_index, partitioned)
+            if recall is None:
+                logger.error(f"Could not lock {tb_name} to swap {current} for {new_index}, the new index is dropped")
+            else:
+                logger.error(f"{new_index} reached recall@{k} {recall:.3f} < {min_recall}, "
+                             f"it is dropped and {tb_name} keeps {current}")
+        else:
+            logger.info(f"Swapped {current} for {new_index} on {tb_name}, recall@{k} {recall:.3f}")
+    finally:
+        connection.close()
+    return report
+
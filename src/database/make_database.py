@@ -1,7 +1,8 @@
 import os
 import sys
+import threading
+import time
 from tqdm.auto import tqdm
-import pandas as pd
 import psycopg2
 from psycopg2 import Error
 import math
@@ -12,7 +13,18 @@ from transformers import (
         )
 import datasets
 from typing import (
-        List
+        Any,
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+from concurrent.futures import (
+        ThreadPoolExecutor,
+        as_completed
         )
 
 import torch
@@ -21,9 +33,50 @@ current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 
-from model.retriever_model import (
-         get_ctx_embd
-         )
+from database.connection import (
+        connect_admin,
+        get_config,
+        get_pool,
+        retry_transient
+        )
+from database.writers import (
+        create_staging_table,
+        swap_staging_table
+        )
+from database.pipeline import (
+        run_pipeline
+        )
+from database.partitions import (
+        create_partitions_sql,
+        is_range_partitioned,
+        list_partitions,
+        partition_keys
+        )
+from database.search import (
+        EMBEDD_DIM,
+        TS_CONFIG,
+        index_spec
+        )
+from database.artifacts import (
+        encode_to_artifacts,
+        import_parts
+        )
+from data.make_data import (
+        CsvSource
+        )
+from model.embedding_cache import (
+        EmbeddingCache
+        )
+from data.dedup import (
+        Deduplicator
+        )
+from database.checkpoint import (
+        CheckpointHook,
+        LinkHook,
+        OffsetTracker,
+        create_duplicates_table,
+        load_checkpoint_seek
+        )
 
 import logging
 import dotenv
@@ -32,32 +85,32 @@ logger = logging.getLogger(__name__)
 
 dotenv.load_dotenv()
 
-PGDBNAME=os.getenv("PGDBNAME", "wiki_pgvector")
-PGHOST=os.getenv("PGHOST", "localhost")
-PGPORT=os.getenv("PGPORT", "5432")
-PGUSER=os.getenv("PGUSER", "wiki_ad")
-PGPWD=os.getenv("PGPWD", "55235")
 TB_WIKI=os.getenv("TB_WIKI", "wiki_tb")
 TB_CLIENT=os.getenv("TB_CLIENT", "client_tb")
 BATCH=int(os.getenv("BATCH", 16))
+# index builds: cap of `maintenance_work_mem` (0 derives it from the
+# server), share of the server's memory they may use, parallel workers
+# (-1 uses the server's `max_parallel_workers`) and progress log interval
+MAX_MAINTENANCE_WORK_MEM_MB=int(os.getenv("MAX_MAINTENANCE_WORK_MEM_MB", 0))
+INDEX_MEMORY_FRACTION=float(os.getenv("INDEX_MEMORY_FRACTION", 0.5))
+INDEX_PARALLEL_WORKERS=int(os.getenv("INDEX_PARALLEL_WORKERS", -1))
+INDEX_PROGRESS_INTERVAL=float(os.getenv("INDEX_PROGRESS_INTERVAL", 30))
+# text columns of each table's `content_tsv`, most important first
+WIKI_TEXT_COLUMNS = ("title", "name", "content")
+CLIENT_TEXT_COLUMNS = ("title", "domain", "content")
 
 def create_postgres_db() -> None:
     """Create a database to contain a data table
     """
     try:
-        connection = psycopg2.connect(
-                host=PGHOST,
-                port=PGPORT,
-                dbname="postgres",
-                user=PGUSER,
-                password=PGPWD
-                )
+        dbname = get_config().dbname
+        connection = connect_admin()
         connection.autocommit = True
         cursor = connection.cursor()
-        sql = '''CREATE DATABASE {};'''.format(PGDBNAME)
+        sql = '''CREATE DATABASE {};'''.format(dbname)
         cursor.execute(sql)
 
-        logger.info(f"Database {PGDBNAME} is created successfully.")
+        logger.info(f"Database {dbname} is created successfully.")
 
         if connection:
             cursor.close()
@@ -66,72 +119,147 @@ def create_postgres_db() -> None:
     except (Exception, Error) as e:
         logger.error(f"Error while connecting to PostgreSQL: {e}")
 
-def create_wiki_table() -> None:
+def create_wiki_table(
+        tb_name: str = TB_WIKI,
+        lexical: bool = False,
+        partition_by: str = "none",
+        partitions: int = 8,
+        partition_rows: int = 5000000
+        ) -> None:
     """Create a table contains wiki snippets passages
+
+    Args:
+        tb_name: name of table
+        lexical: add the generated `content_tsv` column of hybrid search
+        partition_by: `none`, `hash` (on `source_id`) or `range` (on `id`)
+        partitions: number of partitions
+        partition_rows: ids per range partition
     """
     try:
-        connection = psycopg2.connect(dbname=PGDBNAME,
-                                      host=PGHOST,
-                                      port=PGPORT,
-                                      user=PGUSER,
-                                      password=PGPWD)
+        connection = connect()
         connection.autocommit = True
 
         cursor = connection.cursor()
+        key_columns, constraints, partition_clause = partition_keys(partition_by)
         sql = f'''
                 CREATE EXTENSION IF NOT EXISTS vector;
-                CREATE TABLE {TB_WIKI} (
-                id SERIAL PRIMARY KEY,
+                CREATE TABLE {tb_name} (
+                {key_columns}
                 title TEXT,
                 name TEXT,
                 content TEXT,
-                embedd vector(128));
+                embedd vector(128){lexical_column(WIKI_TEXT_COLUMNS) if lexical else ""}{constraints})
+                {partition_clause};
                 '''
+        if partition_by != "none":
+            sql += create_partitions_sql(tb_name, partition_by, partitions, partition_rows)
 
         cursor.execute(sql)
-        logger.info(f"{TB_WIKI} is created successfully.")
+        logger.info(f"{tb_name} is created successfully.")
 
         if connection:
             cursor.close()
             connection.close()
-            logger.info("PostgreSQL connection is closed.")
+            logger.info("PostgreSQL connection is released.")
 
     except (Exception, Error) as err:
         logger.error(f"Error while connecting to PostgreSQL: {err}")
 
-def create_client_table() -> None:
+def create_client_table(
+        tb_name: str = TB_CLIENT,
+        lexical: bool = False,
+        partition_by: str = "none",
+        partitions: int = 8,
+        partition_rows: int = 5000000
+        ) -> None:
     """Create a table contains client's knowledges
+
+    Args:
+        tb_name: name of table
+        lexical: add the generated `content_tsv` column of hybrid search
+        partition_by: `none`, `hash` (on `source_id`) or `range` (on `id`)
+        partitions: number of partitions
+        partition_rows: ids per range partition
     """
     try:
-        connection = psycopg2.connect(dbname=PGDBNAME,
-                                      host=PGHOST,
-                                      port=PGPORT,
-                                      user=PGUSER,
-                                      password=PGPWD)
+        connection = connect()
         connection.autocommit = True
 
         cursor = connection.cursor()
+        key_columns, constraints, partition_clause = partition_keys(partition_by)
         sql = f'''
                 CREATE EXTENSION IF NOT EXISTS vector;
-                CREATE TABLE {TB_CLIENT} (
-                id SERIAL PRIMARY KEY,
+                CREATE TABLE {tb_name} (
+                {key_columns}
                 title TEXT,
                 domain TEXT,
                 content TEXT,
-                embedd vector(128));
+                embedd vector(128){lexical_column(CLIENT_TEXT_COLUMNS) if lexical else ""}{constraints})
+                {partition_clause};
                 '''
+        if partition_by != "none":
+            sql += create_partitions_sql(tb_name, partition_by, partitions, partition_rows)
 
         cursor.execute(sql)
-        logger.info(f"{TB_CLIENT} is created successfully.")
+        logger.info(f"{tb_name} is created successfully.")
 
         if connection:
             cursor.close()
             connection.close()
-            logger.info("PostgreSQL connection is closed.")
+            logger.info("PostgreSQL connection is released.")
 
     except (Exception, Error) as err:
         logger.error(f"Error while connecting to PostgreSQL: {err}")
 
+def tsvector_expression(columns: Tuple[str, ...]) -> str:
+    """Weighted `tsvector` of text columns, A for the first, B, C, D next"""
+    return " || ".join(
+            f"setweight(to_tsvector('{TS_CONFIG}'::regconfig, coalesce({column}, '')), '{weight}')"
+            for column, weight in zip(columns, "ABCD")
+            )
+
+def lexical_column(columns: Tuple[str, ...]) -> str:
+    """Column definition of `content_tsv`, filled by Postgres on insert"""
+    return f",\n                content_tsv tsvector GENERATED ALWAYS AS ({tsvector_expression(columns)}) STORED"
+
+def create_lexical_index(tb_name: str, columns: Tuple[str, ...]) -> None:
+    """Create the GIN index of hybrid search
+
+    Tables created without `content_tsv` get the column first, which
+    rewrites the table once.
+
+    Args:
+        tb_name: name of table
+        columns: text columns of the `tsvector`, most important first
+    """
+    try:
+        connection = connect()
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                    ALTER TABLE {tb_name}
+                    ADD COLUMN IF NOT EXISTS content_tsv tsvector
+                    GENERATED ALWAYS AS ({tsvector_expression(columns)}) STORED;
+                    ''')
+            logger.info(f"Creating GIN index on {tb_name}.content_tsv")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {tb_name}_content_tsv_idx ON {tb_name} USING gin (content_tsv)")
+        connection.close()
+        logger.info("Create lexical index successfully")
+    except (Exception, psycopg2.Error) as err:
+        logger.error(f"Error while creating lexical index on {tb_name}: {err}")
+
+@retry_transient
+def _count_row(tb_name: str) -> int:
+    connection = connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {tb_name}")
+            result = cursor.fetchone()[0]
+        connection.commit()
+        return result
+    finally:
+        connection.close()
+
 def count_row(tb_name: str) -> int:
     """Count the number of row in a table
 
@@ -141,259 +269,1003 @@ def count_row(tb_name: str) -> int:
         tb_name: name of table
     """
     try:
-        connection = psycopg2.connect(dbname=PGDBNAME,
-                                      host=PGHOST,
-                                      port=PGPORT,
-                                      user=PGUSER,
-                                      password=PGPWD)
-        connection.autocommit = True
+        return _count_row(tb_name)
+    except (Exception, psycopg2.Error) as err:
+        logger.error(f"Error while connecting to PostgreSQL: {err}")
+        return -1
 
-        cursor = connection.cursor()
-        sql = f'''
-                SELECT count(*) FROM {tb_name}
-                '''
+def connect():
+    """Check a connection to the knowledge database out of the pool
 
-        cursor.execute(sql)
+    Closing it returns it to the pool (see `database.connection`).
+    """
+    return get_pool().getconn()
+
+@retry_transient
+def ensure_source_id(tb_name: str) -> None:
+    """Add the unique `source_id` column to tables created before it existed
+
+    Partitioned tables are always created with it. Range partitioned ones
+    are refused: their `source_id` is only unique together with `id`, so
+    replayed rows would be inserted again.
+
+    Args:
+        tb_name: name of table
+
+    Raises:
+        ValueError: if `tb_name` is range partitioned
+    """
+    connection = connect()
+    connection.autocommit = True
+    if list_partitions(connection, tb_name):
+        range_partitioned = is_range_partitioned(connection, tb_name)
+        connection.close()
+        if range_partitioned:
+            raise ValueError(f"{tb_name} is range partitioned, its source_id is not unique on its own")
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+                ALTER TABLE {tb_name} ADD COLUMN IF NOT EXISTS source_id TEXT;
+                CREATE UNIQUE INDEX IF NOT EXISTS {tb_name}_source_id_key
+                ON {tb_name} (source_id);
+                ''')
+    connection.close()
+
+def finish_staging_load(tb_name: str) -> None:
+    """Swap the staging table of a sharded load into `tb_name`
+
+    Args:
+        tb_name: name of table
+    """
+    connection = connect()
+    swap_staging_table(connection, tb_name)
+    connection.close()
+
+def _is_synced(connection, tb_name: str) -> bool:
+    """Whether `tb_name` was loaded by `sync.sync_client_knowledges`
+
+    Synced rows are keyed by the hash of their natural key, not by row
+    number, so a plain load would insert every row of the file again.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('''
+                SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                WHERE table_name = %s AND column_name = 'content_hash')
+                ''', (tb_name,))
+        synced = cursor.fetchone()[0]
+    connection.commit()
+    return synced
+
+def _refuse_synced(tb_name: str) -> None:
+    connection = connect()
+    try:
+        synced = _is_synced(connection, tb_name)
+    finally:
+        connection.close()
+    if synced:
+        raise ValueError(f"{tb_name} is kept in sync with its csv by source key, load it with --sync")
+
+def _count_legacy_rows(connection, tb_name: str) -> int:
+    """Rows of a table loaded before `source_id` existed"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM {tb_name} WHERE source_id IS NULL")
         result = cursor.fetchone()[0]
+    connection.commit()
+    return result
 
-        if connection:
-            cursor.close()
+def _resume_offset(
+        connection,
+        tb_name: str,
+        tb_target: str,
+        shard_index: int,
+        num_shards: int,
+        fingerprint: str
+        ) -> Tuple[int, Optional[Tuple[int, int]]]:
+    """Source offset a shard resumes from, and the seek point stored with it
+
+    A staging table's checkpoint is only trusted while the (unlogged)
+    staging table still holds rows, it is emptied by a server crash.
+
+    Rows loaded before checkpoints existed have no `source_id`, replaying
+    them would insert them again. Without a checkpoint, a single-shard
+    load then resumes after them, like loads did before (by row count);
+    a sharded load can not tell which shard they came from and is refused.
+    """
+    offset, seek = load_checkpoint_seek(connection, tb_name, shard_index, num_shards, fingerprint)
+    if tb_target != tb_name:
+        staged, staged_seek = load_checkpoint_seek(connection, tb_target, shard_index, num_shards, fingerprint)
+        if staged > offset and count_row(tb_name=tb_target) > 0:
+            offset, seek = staged, staged_seek
+    if offset == 0:
+        legacy = _count_legacy_rows(connection, tb_name)
+        if legacy and num_shards > 1:
+            raise ValueError(f"{tb_name} holds {legacy} rows loaded without source_id, "
+                             "resume it with a single-shard load or reload it into an empty table")
+        if legacy:
+            logger.warning(f"{tb_name} holds {legacy} rows loaded without source_id and no checkpoint, "
+                           f"resuming at offset {legacy}")
+            offset = legacy
+    return offset, seek
+
+def _ingest(
+        tb_name: str,
+        columns: Tuple[str, ...],
+        read_rows: Callable[..., Iterable[Tuple[str, ...]]],
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        fingerprint: str,
+        bulk_load: bool,
+        unlogged_staging: bool,
+        num_tokenizers: int,
+        num_writers: int,
+        shard_index: int,
+        num_shards: int,
+        max_tokens: Optional[int],
+        cache: Optional[EmbeddingCache],
+        artifact_dir: str = "",
+        dedup: Optional[Deduplicator] = None,
+        embedding_column: str = "embedd",
+        store=None,
+        seek_point: Optional[Callable[[int], Optional[Tuple[int, int]]]] = None,
+        ) -> None:
+    """Resume a shard from its checkpoint and run the ingestion pipeline
+
+    Args:
+        tb_name: name of table to fill
+        columns: text columns of a row, the passage is the third one
+        read_rows: returns the shard's rows starting at a source offset,
+                    given the seek point stored with it (or None)
+        artifact_dir: encode into part files under this directory instead
+                    of writing to the database
+        dedup: skips duplicate passages, linking them to their canonical
+                    row in `{tb_name}_duplicates` if it links
+        embedding_column: vector column written, see `embedding_versions`
+        store: the `stores.VectorStore` written through, a
+                    `PostgresStore` of the arguments above by default;
+                    a store without checkpoints (`NumpyStore`) reads rows
+                    from the start and skips the ones it already holds
+        seek_point: seek point of a source offset, stored in checkpoints,
+                    see `CsvSource.seek_point`
+    """
+    if store is not None and not store.checkpoints:
+        if dedup is not None and dedup.link:
+            logger.warning("Duplicates are skipped but not linked when writing to a store")
+            dedup.link = False
+        run_pipeline(
+                rows=read_rows(0),
+                content_index=2,
+                context_encoder=context_encoder,
+                context_tokenizer=context_tokenizer,
+                device=device,
+                open_writer=lambda hook: store.open_writer(tb_name, columns, hook=hook),
+                max_tokens=max_tokens,
+                num_tokenizers=num_tokenizers,
+                num_writers=num_writers,
+                cache=cache,
+                dedup=dedup
+                )
+        return
+
+    if artifact_dir:
+        if dedup is not None and dedup.link:
+            logger.warning("Duplicates are skipped but not linked when encoding into part files")
+            dedup.link = False
+        encode_to_artifacts(
+                tb_name=tb_name,
+                columns=columns,
+                read_rows=read_rows,
+                context_encoder=context_encoder,
+                context_tokenizer=context_tokenizer,
+                device=device,
+                artifact_dir=artifact_dir,
+                fingerprint=fingerprint,
+                num_tokenizers=num_tokenizers,
+                num_writers=num_writers,
+                shard_index=shard_index,
+                num_shards=num_shards,
+                max_tokens=max_tokens,
+                cache=cache,
+                dedup=dedup
+                )
+        return
+
+    if store is None:
+        # the store module builds on this one
+        from database.stores import PostgresStore
+        store = PostgresStore(
+                bulk_load=bulk_load,
+                embedding_column=embedding_column,
+                idempotent=not unlogged_staging
+                )
+    # the staging table copies the table's columns, `source_id` included
+    ensure_source_id(tb_name=tb_name)
+    connection = connect()
+    if dedup is not None and dedup.link:
+        with connection.cursor() as cursor:
+            create_duplicates_table(cursor, tb_name)
+        connection.commit()
+
+    tb_target = tb_name
+    if unlogged_staging:
+        if list_partitions(connection, tb_name):
             connection.close()
-            logger.info("PostgreSQL connection is closed.")
-        return result
+            raise ValueError(f"{tb_name} is partitioned, reload single partitions instead of using a staging table")
+        tb_target = create_staging_table(connection, tb_name)
+    start_offset, seek = _resume_offset(
+            connection,
+            tb_name=tb_name,
+            tb_target=tb_target,
+            shard_index=shard_index,
+            num_shards=num_shards,
+            fingerprint=fingerprint
+            )
+    if start_offset:
+        logger.info(f"Resuming shard {shard_index}/{num_shards} of {tb_name} at offset {start_offset}")
+    tracker = OffsetTracker(start_offset)
 
-    except (Exception, psycopg2.Error) as err:
-        logger.error(f"Error while connecting to PostgreSQL: {err}")
-        return -1
+    def _make_hook():
+        hook = CheckpointHook(
+                tracker=tracker,
+                tb_name=tb_target,
+                shard_index=shard_index,
+                num_shards=num_shards,
+                fingerprint=fingerprint,
+                seek_point=seek_point
+                )
+        if dedup is not None and dedup.link:
+            return LinkHook(hook, tb_name=tb_name)
+        return hook
+
+    run_pipeline(
+            rows=read_rows(start_offset, seek),
+            content_index=2,
+            context_encoder=context_encoder,
+            context_tokenizer=context_tokenizer,
+            device=device,
+            open_writer=lambda hook: store.open_writer(tb_target, columns, hook=hook),
+            start_offset=start_offset,
+            make_hook=_make_hook,
+            max_tokens=max_tokens,
+            num_tokenizers=num_tokenizers,
+            num_writers=num_writers,
+            cache=cache,
+            dedup=dedup
+            )
+
+    if unlogged_staging and num_shards == 1:
+        swap_staging_table(connection, tb_name)
+    connection.close()
+
+def wiki_rows(
+        snippets: Iterable[dict],
+        offset: int = 0,
+        shard_index: int = 0,
+        num_shards: int = 1
+        ) -> Iterable[Tuple[str, ...]]:
+    """Rows (`WIKI_TEXT_COLUMNS` + `source_id`) of wiki snippets from `offset`"""
+    stream = snippets.skip(offset) if offset else snippets
+    for idx, article in tqdm(enumerate(iter(stream), start=offset), initial=offset):
+        source_id = article.get("_id") or f"{shard_index}/{num_shards}:{idx}"
+        yield (
+                str(article["section_title"]),
+                str(article["article_title"]),
+                str(article["passage_text"]),
+                str(source_id)
+                )
+
+def client_rows(
+        snippets: CsvSource,
+        offset: int = 0,
+        seek: Optional[Tuple[int, int]] = None
+        ) -> Iterable[Tuple[str, ...]]:
+    """Rows (`CLIENT_TEXT_COLUMNS` + `source_id`) of a client csv shard from `offset`"""
+    with tqdm(initial=offset, total=snippets.total) as progress:
+        for first_row, chunk in snippets.batches(offset, seek=seek):
+            source_ids = range(first_row, first_row + len(chunk))
+            yield from zip(
+                    chunk["Title"].tolist(),
+                    chunk["Domain"].tolist(),
+                    chunk["Content"].tolist(),
+                    map(str, source_ids)
+                    )
+            progress.update(len(chunk))
 
 def insert_knowledges(
         context_encoder: DPRContextEncoder,
         context_tokenizer: DPRContextEncoderTokenizer,
         snippets: datasets.iterable_dataset.IterableDataset,
         device: torch.device,
+        fingerprint: str = "",
+        bulk_load: bool = False,
+        unlogged_staging: bool = False,
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        shard_index: int = 0,
+        num_shards: int = 1,
+        max_tokens: Optional[int] = None,
+        cache: Optional[EmbeddingCache] = None,
+        artifact_dir: str = "",
+        tb_name: str = TB_WIKI,
+        dedup: Optional[Deduplicator] = None,
+        embedding_column: str = "embedd",
+        store=None,
         )->None:
     """Insert wiki snippets or knowledge to wiki table
 
+    Reading, tokenization, encoding and writing run as separate pipeline
+    stages (see `database.pipeline`), so the encoder keeps working while
+    batches are written to the database. Every commit also records the
+    shard's source offset, a restarted load skips straight to it.
+
     Args:
         context_encoder: a model that encodes data to embedding
         context_tokenizer: a tokenizer that creates input for `context_encoder`
         snippets: dataset object that contains wikipedia snippet passages
+        fingerprint: identifies the dataset, see `dataset_fingerprint`
+        bulk_load: stream rows with binary COPY and commit every
+                    `COMMIT_ROWS` rows / `COMMIT_BYTES` bytes
+        unlogged_staging: load into an UNLOGGED staging table which is
+                    swapped into the wiki table at the end (by
+                    `finish_staging_load` for a sharded load)
+        num_tokenizers: number of tokenizer threads
+        num_writers: number of writer threads, each with its own connection
+        shard_index: index of the shard `snippets` holds
+        num_shards: total number of shards the dataset is split into
+        max_tokens: encode length-bucketed batches of at most `max_tokens`
+                    padded tokens (0 sizes them from the device memory)
+                    instead of `BATCH` rows
+        cache: embedding cache, passages it already holds (or seen earlier
+                    in this load) are not encoded again
+        artifact_dir: only encode, into Parquet/.npy part files under this
+                    directory, see `import_artifacts`
+        tb_name: name of table to fill
+        dedup: skip exact and near duplicate passages (or link them to
+                    their canonical row), before they are encoded
+        embedding_column: vector column of the active embedding version,
+                    `context_encoder` must be its model
+        store: write to this `stores.VectorStore` (e.g. a `NumpyStore`),
+                    the table's `PostgresStore` by default
     """
-    logger.info(f"Starting inserting knowledge to {TB_WIKI}")
+    logger.info(f"Starting inserting knowledge to {tb_name} (shard {shard_index}/{num_shards})")
 
-    try:
-        connection = psycopg2.connect(dbname=PGDBNAME,
-                                      host=PGHOST,
-                                      port=PGPORT,
-                                      user=PGUSER,
-                                      password=PGPWD)
+    def _read_rows(offset: int, seek=None):
+        return wiki_rows(snippets, offset, shard_index=shard_index, num_shards=num_shards)
 
-        cursor = connection.cursor()
-        def _insert(
-                batch_titles: List[str],
-                batch_names: List[str],
-                batch_contents: List[str],
-                device: torch.device
-                ) -> None:
-
-            passage_embd = get_ctx_embd(
-                    model_encoder=context_encoder,
-                    tokenizer=context_tokenizer,
-                    text=batch_contents,
-                    device=device
-                    )
-            embd = [str(list(passage_embd[i, :].cpu().detach().numpy().reshape(-1)))
-                    for i in range(passage_embd.size(0))
-                    ]
-            values =  list(zip(batch_titles, batch_names, batch_contents, embd))
-            args = ','.join(cursor.mogrify("(%s,%s,%s,%s)", i).decode('utf-8') for i in values)
-            sql_insert_query = f"""
-                    INSERT INTO {TB_WIKI} (title, name, content, embedd)
-                    VALUES"""
-            cursor.execute(sql_insert_query + (args))
-            connection.commit()
-        current_id = count_row(tb_name=TB_WIKI)
-        batch_titles = []
-        batch_names = []
-        batch_contents = []
-        for idx, article in tqdm(enumerate(iter(snippets))):
-            if idx < current_id:
-                continue
-            batch_titles.append(str(article["section_title"]))
-            batch_names.append(str(article["article_title"]))
-            batch_contents.append(str(article["passage_text"]))
-            if len(batch_contents) == BATCH:
-                assert len(batch_titles) == len(batch_names) == len(batch_contents), \
-                        f"len(batch_titles): {len(batch_titles)} "\
-                        f"len(batch_names): {len(batch_names)}"\
-                        f"len(batch_contents): {len(batch_contents)}"
-                _insert(
-                        batch_titles=batch_titles,
-                        batch_names=batch_names,
-                        batch_contents=batch_contents,
-                        device=device
+    try:
+        _ingest(
+                tb_name=tb_name,
+                columns=("title", "name", "content", "source_id"),
+                read_rows=_read_rows,
+                context_encoder=context_encoder,
+                context_tokenizer=context_tokenizer,
+                device=device,
+                fingerprint=fingerprint,
+                bulk_load=bulk_load,
+                unlogged_staging=unlogged_staging,
+                num_tokenizers=num_tokenizers,
+                num_writers=num_writers,
+                shard_index=shard_index,
+                num_shards=num_shards,
+                max_tokens=max_tokens,
+                cache=cache,
+                artifact_dir=artifact_dir,
+                dedup=dedup,
+                embedding_column=embedding_column,
+                store=store
                 )
-                batch_titles.clear()
-                batch_names.clear()
-                batch_contents.clear()
-
-        if batch_contents:
-            assert len(batch_titles) == len(batch_names) == len(batch_contents), \
-                    f"len(batch_titles): {len(batch_titles)} "\
-                    f"len(batch_names): {len(batch_names)}"\
-                    f"len(batch_contents): {len(batch_contents)}"
-
-            _insert(
-                    batch_titles=batch_titles,
-                    batch_names=batch_names,
-                    batch_contents=batch_contents,
-                    device=device
-            )
-
-
-        logger.info(f"Insert knowledges to {TB_WIKI} successfully")
-
-        if connection:
-            cursor.close()
-            connection.close()
+        logger.info(f"Insert knowledges to {tb_name} successfully")
     except (Exception, Error) as e:
-        logger.error(f"Failed inserting knowledge into {TB_WIKI}: {e}")
+        logger.error(f"Failed inserting knowledge into {tb_name}: {e}")
+        raise
 
 
 def insert_client_knowledges(
         context_encoder: DPRContextEncoder,
         context_tokenizer: DPRContextEncoderTokenizer,
-        snippets: pd.DataFrame,
+        snippets: CsvSource,
         device: torch.device,
+        fingerprint: str = "",
+        bulk_load: bool = False,
+        unlogged_staging: bool = False,
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        shard_index: int = 0,
+        num_shards: int = 1,
+        max_tokens: Optional[int] = None,
+        cache: Optional[EmbeddingCache] = None,
+        artifact_dir: str = "",
+        tb_name: str = TB_CLIENT,
+        dedup: Optional[Deduplicator] = None,
+        embedding_column: str = "embedd",
+        store=None,
         )->None:
     """Insert client's knowledge to table
 
+    The knowledge file is streamed in column-oriented batches, memory
+    stays flat whatever its size.
+
     Args:
         context_encoder: a model that encodes data to embedding
         context_tokenizer: a tokenizer that creates input for `context_encoder`
-        snippets: dataset object that contains wikipedia snippet passages
+        snippets: the shard of the client knowledge csv to insert
+        fingerprint: identifies the knowledge file, see `dataset_fingerprint`
+        bulk_load: stream rows with binary COPY and commit every
+                    `COMMIT_ROWS` rows / `COMMIT_BYTES` bytes
+        unlogged_staging: load into an UNLOGGED staging table which is
+                    swapped into the client table at the end (by
+                    `finish_staging_load` for a sharded load)
+        num_tokenizers: number of tokenizer threads
+        num_writers: number of writer threads, each with its own connection
+        shard_index: index of the shard `snippets` holds
+        num_shards: total number of shards the knowledges are split into
+        max_tokens: encode length-bucketed batches of at most `max_tokens`
+                    padded tokens (0 sizes them from the device memory)
+                    instead of `BATCH` rows
+        cache: embedding cache, passages it already holds (or seen earlier
+                    in this load) are not encoded again
+        artifact_dir: only encode, into Parquet/.npy part files under this
+                    directory, see `import_artifacts`
+        tb_name: name of table to fill
+        dedup: skip exact and near duplicate passages (or link them to
+                    their canonical row), before they are encoded
+        embedding_column: vector column of the active embedding version,
+                    `context_encoder` must be its model
+        store: write to this `stores.VectorStore` (e.g. a `NumpyStore`),
+                    the table's `PostgresStore` by default
     """
-    logger.info(f"Starting inserting knowledge to {TB_CLIENT}")
+    logger.info(f"Starting inserting knowledge to {tb_name} (shard {shard_index}/{num_shards})")
+
+    def _read_rows(offset: int, seek=None):
+        return client_rows(snippets, offset, seek=seek)
 
     try:
-        connection = psycopg2.connect(dbname=PGDBNAME,
-                                      host=PGHOST,
-                                      port=PGPORT,
-                                      user=PGUSER,
-                                      password=PGPWD)
+        if store is None and not artifact_dir:
+            _refuse_synced(tb_name)
+        _ingest(
+                tb_name=tb_name,
+                columns=("title", "domain", "content", "source_id"),
+                read_rows=_read_rows,
+                context_encoder=context_encoder,
+                context_tokenizer=context_tokenizer,
+                device=device,
+                fingerprint=fingerprint,
+                bulk_load=bulk_load,
+                unlogged_staging=unlogged_staging,
+                num_tokenizers=num_tokenizers,
+                num_writers=num_writers,
+                shard_index=shard_index,
+                num_shards=num_shards,
+                max_tokens=max_tokens,
+                cache=cache,
+                artifact_dir=artifact_dir,
+                dedup=dedup,
+                embedding_column=embedding_column,
+                store=store,
+                seek_point=snippets.seek_point
+                )
+        logger.info(f"Insert knowledges to {tb_name} successfully")
+    except (Exception, Error) as e:
+        logger.error(f"Failed inserting knowledge into {tb_name}: {e}")
+        raise
 
-        cursor = connection.cursor()
-        def _insert(
-                batch_titles: List[str],
-                batch_domains: List[str],
-                batch_contents: List[str],
-                device: torch.device
-                ) -> None:
-
-            passage_embd = get_ctx_embd(
-                    model_encoder=context_encoder,
-                    tokenizer=context_tokenizer,
-                    text=batch_contents,
-                    device=device
-                    )
-            embd = [str(list(passage_embd[i, :].cpu().detach().numpy().reshape(-1)))
-                    for i in range(passage_embd.size(0))
-                    ]
-            values =  list(zip(batch_titles, batch_domains, batch_contents, embd))
-            args = ','.join(cursor.mogrify("(%s,%s,%s,%s)", i).decode('utf-8') for i in values)
-            sql_insert_query = f"""
-                    INSERT INTO {TB_CLIENT} (title, domain, content, embedd)
-                    VALUES"""
-            cursor.execute(sql_insert_query + (args))
-            connection.commit()
-        current_id = count_row(tb_name=TB_CLIENT)
-        batch_titles = []
-        batch_domains = []
-        batch_contents = []
-        for idx, article in tqdm(enumerate(snippets.iterrows())):
-            if idx < current_id:
-                continue
-            batch_titles.append(str(article[1]["Title"]))
-            batch_domains.append(str(article[1]["Domain"]))
-            batch_contents.append(str(article[1]["Content"]))
-            if len(batch_contents) == BATCH:
-                assert len(batch_titles) == len(batch_domains) == len(batch_contents), \
-                        f"len(batch_titles): {len(batch_titles)} "\
-                        f"len(batch_domains): {len(batch_domains)}"\
-                        f"len(batch_contents): {len(batch_contents)}"
-                _insert(
-                        batch_titles=batch_titles,
-                        batch_domains=batch_domains,
-                        batch_contents=batch_contents,
-                        device=device
+
+def import_artifacts(
+        tb_name: str,
+        artifact_dir: str,
+        num_writers: int = 1,
+        shard_index: int = 0,
+        num_shards: int = 1
+        ) -> None:
+    """Bulk-load the parts written by an `--encode_only` run into a table
+
+    Args:
+        tb_name: name of table to fill
+        artifact_dir: directory of the encoded parts
+        num_writers: number of parts loaded concurrently
+        shard_index: index of this host when several hosts share the import
+        num_shards: number of hosts sharing the import
+    """
+    try:
+        _refuse_synced(tb_name)
+        ensure_source_id(tb_name=tb_name)
+        import_parts(
+                open_connection=connect,
+                tb_name=tb_name,
+                artifact_dir=artifact_dir,
+                num_writers=num_writers,
+                shard_index=shard_index,
+                num_shards=num_shards
                 )
-                batch_titles.clear()
-                batch_domains.clear()
-                batch_contents.clear()
-
-        if batch_contents:
-            assert len(batch_titles) == len(batch_domains) == len(batch_contents), \
-                    f"len(batch_titles): {len(batch_titles)} "\
-                    f"len(batch_names): {len(batch_domains)}"\
-                    f"len(batch_contents): {len(batch_contents)}"
-
-            _insert(
-                    batch_titles=batch_titles,
-                    batch_domains=batch_domains,
-                    batch_contents=batch_contents,
-                    device=device
-            )
+    except (Exception, Error) as e:
+        logger.error(f"Failed importing {artifact_dir} into {tb_name}: {e}")
+        raise
 
+def ivfflat_lists(num_data: int) -> int:
+    """Number of IVFFlat lists for a table size
 
-        logger.info(f"Insert knowledges to {TB_CLIENT} successfully")
+    pgvector's guideline: rows / 1000 up to 1M rows, sqrt(rows) above.
+    """
+    if num_data <= 1000000:
+        return max(1, num_data // 1000)
+    return int(round(math.sqrt(num_data)))
 
-        if connection:
-            cursor.close()
+def ivfflat_probes(lists: int) -> int:
+    """Starting point for `ivfflat.probes`, sqrt(lists)"""
+    return max(1, int(round(math.sqrt(lists))))
+
+def index_memory_mb(
+        method: str,
+        num_data: int,
+        lists: int = 0,
+        m: int = 16,
+        vector_bytes: int = EMBEDD_DIM * 4
+        ) -> int:
+    """Estimate `maintenance_work_mem` an in-memory index build needs
+
+    IVFFlat runs k-means over a sample of 50 rows per list (at least
+    10000), HNSW keeps every vector and its neighbour lists in memory.
+    Includes 25% headroom.
+    """
+    if method == "ivfflat":
+        samples = min(num_data, max(10000, 50 * lists))
+        needed = (samples + lists) * vector_bytes
+    else:
+        needed = num_data * (vector_bytes + 2 * m * 16 + 64)
+    return max(64, int(needed * 1.25 / (1024 * 1024)))
+
+def index_name(
+        tb_name: str,
+        method: str,
+        quantization: str = "none",
+        column: str = "embedd",
+        generation: int = 0
+        ) -> str:
+    """Name of the vector index of a table, or of a partition
+
+    A rebuild names the new index with the next `generation`, it lives
+    next to the current one until they are swapped, see `index_manager`.
+    Indexes of the original `embedd` column keep their names.
+    """
+    variant = quantization if column == "embedd" else f"{column}_{quantization}"
+    name = f"{tb_name}_{variant}_{method}_idx"
+    return f"{name}{generation}" if generation else name
+
+def vector_index_names(
+        connection,
+        tb_name: str,
+        method: str,
+        quantization: str = "none",
+        column: str = "embedd"
+        ) -> List[Tuple[str, bool]]:
+    """(name, valid) of the ANN indexes of a table matching a build
+
+    Matches on the access method, the operator class of `quantization`
+    and the indexed column, whatever the index is named, so indexes
+    created unnamed by earlier versions are found too. The connection
+    must be in autocommit mode.
+    """
+    _, opclass, _ = index_spec(quantization, column=column)
+    with connection.cursor() as cursor:
+        cursor.execute('''
+                SELECT ic.relname, i.indisvalid FROM pg_index i
+                JOIN pg_class ic ON ic.oid = i.indexrelid
+                JOIN pg_am am ON am.oid = ic.relam
+                JOIN pg_opclass oc ON oc.oid = i.indclass[0]
+                WHERE i.indrelid = to_regclass(%s) AND am.amname = %s AND oc.opcname = %s
+                AND EXISTS (
+                    SELECT 1 FROM pg_depend d
+                    JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+                    WHERE d.classid = 'pg_class'::regclass AND d.objid = i.indexrelid
+                    AND d.refobjid = i.indrelid AND a.attname = %s
+                )
+                ORDER BY ic.relname
+                ''', (tb_name, method, opclass, column))
+        return cursor.fetchall()
+
+def server_build_budget(connection, num_builds: int = 1) -> Tuple[int, int]:
+    """`maintenance_work_mem` (MB) and parallel workers of each of
+    `num_builds` index builds running at the same time
+
+    Postgres does not report the host's memory, `effective_cache_size`
+    (or four times `shared_buffers` when larger) stands for what it may
+    use. Builds share `INDEX_MEMORY_FRACTION` of it, capped at
+    `MAX_MAINTENANCE_WORK_MEM_MB` when set, and `INDEX_PARALLEL_WORKERS`
+    workers, the server's `max_parallel_workers` by default. The
+    connection must be in autocommit mode.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('''
+                SELECT (pg_size_bytes(current_setting('effective_cache_size')) / 1048576)::bigint,
+                       (pg_size_bytes(current_setting('shared_buffers')) / 1048576)::bigint,
+                       current_setting('max_parallel_workers')::int
+                ''')
+        cache_mb, shared_buffers_mb, max_workers = cursor.fetchone()
+    memory_mb = int(INDEX_MEMORY_FRACTION * max(cache_mb, 4 * shared_buffers_mb))
+    if MAX_MAINTENANCE_WORK_MEM_MB > 0:
+        memory_mb = min(memory_mb, MAX_MAINTENANCE_WORK_MEM_MB)
+    workers = INDEX_PARALLEL_WORKERS if INDEX_PARALLEL_WORKERS >= 0 else max_workers
+    num_builds = max(1, num_builds)
+    return max(64, memory_mb // num_builds), workers // num_builds
+
+def set_build_options(cursor, work_mem_mb: int, workers: int) -> None:
+    """Session settings of an index build
+
+    The session's `statement_timeout` is lifted, a build may take hours.
+    """
+    cursor.execute(f"SET maintenance_work_mem TO '{int(work_mem_mb)} MB'")
+    cursor.execute(f"SET max_parallel_maintenance_workers TO {int(workers)}")
+    cursor.execute("SET statement_timeout TO 0")
+
+class IndexBuildMonitor:
+    """Log the progress of running index builds every `interval` seconds
+
+    Polls `pg_stat_progress_create_index` on a connection of its own for
+    the backends registered with `watch`, and logs each build's phase,
+    share of the phase done and the time left in the phase, extrapolated
+    from the time spent in it so far. Use it as a context manager; an
+    `interval` of 0 disables it.
+
+    Args:
+        interval: seconds between two progress lines
+    """
+    def __init__(self, interval: float = INDEX_PROGRESS_INTERVAL) -> None:
+        self.interval = interval
+        self.builds: Dict[int, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, connection, label: str) -> int:
+        """Report the builds run on `connection` as `label`, returns the
+        backend to `unwatch` once they are done"""
+        pid = connection.get_backend_pid()
+        with self.lock:
+            self.builds[pid] = {
+                    "label": label,
+                    "phase": None,
+                    "phase_started": time.monotonic(),
+                    "started": time.monotonic(),
+                    }
+        return pid
+
+    def unwatch(self, pid: int) -> None:
+        with self.lock:
+            build = self.builds.pop(pid, None)
+        if build is not None:
+            logger.info(f"{build['label']}: built in {time.monotonic() - build['started']:.0f}s")
+
+    def _report(self, cursor) -> None:
+        with self.lock:
+            pids = list(self.builds)
+        if not pids:
+            return
+        cursor.execute('''
+                SELECT pid, phase, blocks_total, blocks_done, tuples_total, tuples_done,
+                       partitions_total, partitions_done
+                FROM pg_stat_progress_create_index WHERE pid = ANY(%s)
+                ''', (pids,))
+        now = time.monotonic()
+        for pid, phase, blocks_total, blocks_done, tuples_total, tuples_done, \
+                partitions_total, partitions_done in cursor.fetchall():
+            with self.lock:
+                build = self.builds.get(pid)
+                if build is None:
+                    continue
+                if build["phase"] != phase:
+                    build["phase"], build["phase_started"] = phase, now
+                elapsed = now - build["phase_started"]
+            line = f"{build['label']}: {phase}"
+            if partitions_total:
+                line += f", partition {partitions_done}/{partitions_total}"
+            done = None
+            if blocks_total:
+                done = blocks_done / blocks_total
+            elif tuples_total:
+                done = tuples_done / tuples_total
+            if done is not None:
+                line += f", {done:.1%}"
+                if 0 < done < 1:
+                    line += f", about {elapsed * (1 - done) / done:.0f}s left in this phase"
+            logger.info(line)
+
+    def _poll(self) -> None:
+        connection = connect()
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                while not self.stopped.wait(self.interval):
+                    self._report(cursor)
+        except psycopg2.Error as err:
+            logger.warning(f"Index build progress is not reported anymore: {err}")
+        finally:
             connection.close()
-    except (Exception, Error) as e:
-        logger.error(f"Failed inserting knowledge into {TB_CLIENT}: {e}")
 
+    def __enter__(self) -> "IndexBuildMonitor":
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._poll, name="index-progress", daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def _index_build(
+        num_data: int,
+        method: str,
+        m: int,
+        ef_construction: int,
+        quantization: str,
+        max_work_mem_mb: int,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> Tuple[str, str, int, int]:
+    """Column spec, WITH options, lists and `maintenance_work_mem` of a build"""
+    lists = 0
+    if method == "ivfflat":
+        lists = ivfflat_lists(num_data)
+        options = f"lists = {lists}"
+    elif method == "hnsw":
+        options = f"m = {m}, ef_construction = {ef_construction}"
+    else:
+        raise ValueError(f"Unknown index method {method}, expected ivfflat or hnsw")
+    expression, opclass, vector_bytes = index_spec(quantization, column=column, dim=dim)
+    work_mem = min(
+            index_memory_mb(method, num_data, lists=lists, m=m, vector_bytes=vector_bytes),
+            max_work_mem_mb
+            )
+    return f"{expression} {opclass}", options, lists, work_mem
 
 def create_index(
         tb_name: str,
-        num_data: int,
+        num_data: Optional[int] = None,
+        method: str = "ivfflat",
+        m: int = 16,
+        ef_construction: int = 64,
+        quantization: str = "none",
+        num_workers: int = 4,
+        partitions: Optional[Sequence[str]] = None,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM,
+        concurrently: bool = False,
+        generation: int = 0,
     ) -> None:
     """Create index for embedding column
 
+    IVFFlat lists and HNSW build memory are derived from the number of
+    rows; `maintenance_work_mem` is set to what the build needs, within
+    the server's budget (see `server_build_budget`), and the build's
+    progress is logged every `INDEX_PROGRESS_INTERVAL` seconds.
+
+    The index is named after the table, column, quantization and method
+    (`index_name`). When an index of the same kind exists, under any name,
+    nothing is built: a second run does not add a duplicate, rebuild it
+    with `index_manager.rebuild_index`.
+
+    With a `quantization` the index is built on a compact expression of
+    `embedd` (`embedd::halfvec(128)` or `binary_quantize(embedd)`), the
+    table keeps the float vectors the candidates are reranked with. Rows
+    need no extra column, Postgres computes the expression on insert.
+
+    Partitioned tables are indexed partition by partition, see
+    `create_partitioned_index`.
+
     Args:
-        num_data: number of data or number of rows in the table
+        tb_name: name of table
+        num_data: number of data or number of rows in the table, counted
+                when not given
+        method: `ivfflat` or `hnsw`
+        m: HNSW maximum number of connections per layer
+        ef_construction: HNSW size of the candidate list while building
+        quantization: `none`, `halfvec` or `binary`, see `search.QUANTIZATIONS`
+        num_workers: partitions indexed at the same time
+        partitions: partitions to (re)index, all of them if None
+        column: embedding column to index, see `embedding_versions`
+        dim: dimensions of `column`
+        concurrently: build with `CREATE INDEX CONCURRENTLY`, writes to
+                the table (or partition) go on during the build
+        generation: build the index of this generation next to the
+                current one, only skipped if it exists itself
+
+    Raises:
+        psycopg2.Error, RuntimeError: if the build failed, after logging it
     """
+    logger.info("Creating index")
+    connection = connect()
     try:
-        print("Creating index")
-        connection = psycopg2.connect(dbname=PGDBNAME,
-                                      host=PGHOST,
-                                      port=PGPORT,
-                                      user=PGUSER,
-                                      password=PGPWD)
-        connection.autocommit = True
+        table_partitions = list_partitions(connection, tb_name)
+        if not table_partitions:
+            _create_table_index(
+                    connection,
+                    tb_name=tb_name,
+                    num_data=num_data,
+                    method=method,
+                    m=m,
+                    ef_construction=ef_construction,
+                    quantization=quantization,
+                    column=column,
+                    dim=dim,
+                    concurrently=concurrently,
+                    generation=generation
+                    )
+    except (Exception, psycopg2.Error) as err:
+        logger.error(f"Error while creating index on {tb_name}: {err}")
+        raise
+    finally:
+        connection.close()
+        logger.info("PostgreSQL connection is closed")
+    if table_partitions:
+        create_partitioned_index(
+                tb_name=tb_name,
+                partitions=partitions or table_partitions,
+                method=method,
+                m=m,
+                ef_construction=ef_construction,
+                quantization=quantization,
+                num_workers=num_workers,
+                column=column,
+                dim=dim,
+                concurrently=concurrently,
+                generation=generation
+                )
 
-        cursor = connection.cursor()
-        nlist =  round(2*math.sqrt(num_data))
+def _create_table_index(
+        connection,
+        tb_name: str,
+        num_data: Optional[int],
+        method: str,
+        m: int,
+        ef_construction: int,
+        quantization: str,
+        column: str,
+        dim: int,
+        concurrently: bool,
+        generation: int
+    ) -> None:
+    """Build the vector index of an unpartitioned table, see `create_index`"""
+    connection.autocommit = True
+    name = index_name(tb_name, method, quantization, column=column, generation=generation)
+    existing = vector_index_names(connection, tb_name, method, quantization, column=column)
+    if generation:
+        existing = [index for index in existing if index[0] == name]
+    if existing:
+        invalid = [index for index, valid in existing if not valid]
+        if invalid:
+            logger.warning(f"{tb_name} has invalid {method} indexes {invalid} left by a failed build, "
+                           "rebuild with --rebuild_index")
+        else:
+            logger.warning(f"{tb_name} already has the {method} index {existing[0][0]}, "
+                           "rebuild it with --rebuild_index")
+        return
+    if not num_data or num_data < 0:
+        num_data = count_row(tb_name=tb_name)
 
-        create_index_cluster_cmd = f'''
-                SET maintenance_work_mem TO '14 GB';
-                CREATE INDEX ON {tb_name} USING ivfflat (embedd vector_ip_ops) WITH (lists = {nlist});
-                '''
-        create_index_default_cmd = f'''
-                CREATE INDEX ON {tb_name} USING ivfflat (embedd vector_ip_ops);
-                '''
-        try:
-            logger.info(f"Creating index with {nlist} cluster")
-            cursor.execute(create_index_cluster_cmd)
-        except:
-            logger.error(f"Created index clustering on {tb_name} was failed, try default settings")
-            cursor.execute(create_index_default_cmd)
+    budget_mb, workers = server_build_budget(connection)
+    spec, options, lists, work_mem = _index_build(
+            num_data, method, m, ef_construction, quantization, budget_mb, column=column, dim=dim)
+    create = "CREATE INDEX CONCURRENTLY" if concurrently else "CREATE INDEX"
+
+    create_index_cmd = f'''
+            {create} {name} ON {tb_name} USING {method} ({spec}) WITH ({options});
+            '''
+    create_index_default_cmd = f'''
+            {create} {name} ON {tb_name} USING ivfflat ({spec});
+            '''
+    with connection.cursor() as cursor:
+        set_build_options(cursor, work_mem, workers)
+        with IndexBuildMonitor() as monitor:
+            pid = monitor.watch(connection, name)
+            try:
+                logger.info(f"Creating {method} index {name} on {quantization} {spec} of {num_data} rows "
+                            f"({options}, maintenance_work_mem={work_mem} MB, {workers} parallel workers)")
+                cursor.execute(create_index_cmd)
+            except psycopg2.Error as err:
+                if method != "ivfflat":
+                    raise
+                logger.error(f"Created index clustering on {tb_name} was failed ({err}), try default settings")
+                # a failed concurrent build leaves an invalid index behind
+                cursor.execute(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {name}")
+                cursor.execute(create_index_default_cmd)
+            finally:
+                monitor.unwatch(pid)
+    if method == "ivfflat":
+        logger.info(f"Create index successfully, start tuning from ivfflat.probes = {ivfflat_probes(lists)}")
+    else:
         logger.info("Create index successfully")
-        if connection:
-            cursor.close()
-            connection.close()
-            logger.info("PostgreSQL connection is closed")
 
-    except (Exception, psycopg2.Error) as err:
-        logger.error("Error while connecting to PostgreSQL", err)
+def create_partitioned_index(
+        tb_name: str,
+        partitions: Sequence[str],
+        method: str = "ivfflat",
+        m: int = 16,
+        ef_construction: int = 64,
+        quantization: str = "none",
+        num_workers: int = 4,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM,
+        concurrently: bool = False,
+        generation: int = 0,
+    ) -> None:
+    """Build the vector index of a partitioned table one partition at a time
+
+    The parent gets an index on itself only; each partition builds its
+    own, sized from its own row count, on its own connection, and it is
+    attached to the parent's. `num_workers` partitions are built at once,
+    sharing the server's build budget (`server_build_budget`), one
+    monitor logs the progress of all of them. A partition whose index
+    exists is reindexed (IVFFlat lists re-sized first), so reloading a
+    partition only rebuilds its own index.
+
+    Args:
+        tb_name: name of the partitioned table
+        partitions: partitions to index
+        method: `ivfflat` or `hnsw`
+        m: HNSW maximum number of connections per layer
+        ef_construction: HNSW size of the candidate list while building
+        quantization: `none`, `halfvec` or `binary`
+        num_workers: partitions indexed at the same time
+        column: embedding column to index, see `embedding_versions`
+        dim: dimensions of `column`
+        concurrently: build (and reindex) partitions concurrently, writes
+                to them go on during the build
+        generation: generation of the parent and partition indexes, see
+                `index_name`
+
+    Raises:
+        RuntimeError: if a partition failed, once the others are built
+    """
+    num_workers = max(1, min(num_workers, len(partitions)))
+    parent_index = index_name(tb_name, method, quantization, column=column, generation=generation)
+    connection = connect()
+    connection.autocommit = True
+    budget_mb, workers = server_build_budget(connection, num_builds=num_workers)
+    spec, _, _, _ = _index_build(0, method, m, ef_construction, quantization, budget_mb, column=column, dim=dim)
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {parent_index} ON ONLY {tb_name} USING {method} ({spec})")
+    connection.close()
+    concurrent = " CONCURRENTLY" if concurrently else ""
+
+    def _build(partition: str, monitor: IndexBuildMonitor) -> None:
+        num_data = count_row(tb_name=partition)
+        spec, options, _, work_mem = _index_build(
+                num_data, method, m, ef_construction, quantization, budget_mb, column=column, dim=dim)
+        partition_index = index_name(partition, method, quantization, column=column, generation=generation)
+        connection = connect()
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                set_build_options(cursor, work_mem, workers)
+                cursor.execute("SELECT to_regclass(%s)", (partition_index,))
+                pid = monitor.watch(connection, partition_index)
+                try:
+                    if cursor.fetchone()[0] is not None:
+                        logger.info(f"Reindexing {partition_index} on {num_data} rows ({options})")
+                        cursor.execute(f"ALTER INDEX {partition_index} SET ({options})")
+                        cursor.execute(f"REINDEX INDEX{concurrent} {partition_index}")
+                    else:
+                        logger.info(f"Creating {method} index on {partition} of {num_data} rows ({options}, "
+                                    f"maintenance_work_mem={work_mem} MB, {workers} parallel workers)")
+                        cursor.execute(f'''
+                                CREATE INDEX{concurrent} {partition_index} ON {partition}
+                                USING {method} ({spec}) WITH ({options});
+                                ''')
+                        cursor.execute(f"ALTER INDEX {parent_index} ATTACH PARTITION {partition_index}")
+                finally:
+                    monitor.unwatch(pid)
+        finally:
+            connection.close()
 
+    failed = []
+    with IndexBuildMonitor() as monitor, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(_build, partition, monitor): partition for partition in partitions}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (Exception, psycopg2.Error) as err:
+                logger.error(f"Error while indexing {futures[future]}: {err}")
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"{parent_index} is not valid until {sorted(failed)} are indexed")
+    logger.info(f"Create index {parent_index} successfully on {len(partitions)} partitions")
@@ -0,0 +1,547 @@
+import glob
+import json
+import os
+import threading
+import time
+from typing import (
+        Any,
+        Dict,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+import pandas as pd
+
+from database.make_database import (
+        ivfflat_lists,
+        ivfflat_probes
+        )
+from database.partitions import (
+        merge_top_k
+        )
+from database.search import (
+        RERANK_FACTOR,
+        SearchResult
+        )
+from database.stores import (
+        VectorStore
+        )
+from database.vector_codec import (
+        to_host_array
+        )
+from database.writers import (
+        COMMIT_ROWS,
+        WRITE_PHASES
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+NUMPY_STORE_DIR=os.getenv("NUMPY_STORE_DIR", "numpy_store")
+# rows k-means is trained on, its iterations, and rows scored per block
+# of a scan (bounds the memory of a search)
+IVF_TRAIN_SAMPLE=int(os.getenv("IVF_TRAIN_SAMPLE", 100000))
+KMEANS_ITERATIONS=int(os.getenv("KMEANS_ITERATIONS", 20))
+SCAN_CHUNK_ROWS=int(os.getenv("SCAN_CHUNK_ROWS", 65536))
+# codewords of each product quantization subspace, codes are one byte
+PQ_CENTROIDS = 256
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, metric: str = "ip") -> np.ndarray:
+    """Index of the closest centroid of each vector"""
+    scores = vectors @ centroids.T
+    if metric == "l2":
+        # argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+        scores -= 0.5 * (centroids ** 2).sum(axis=1)
+    return scores.argmax(axis=1)
+
+
+def assign_chunked(vectors: np.ndarray, centroids: np.ndarray, metric: str = "ip") -> np.ndarray:
+    """`_assign` over blocks of `SCAN_CHUNK_ROWS` rows of a (memory-mapped) array"""
+    return np.concatenate([
+            _assign(np.asarray(vectors[start:start + SCAN_CHUNK_ROWS], dtype=np.float32), centroids, metric)
+            for start in range(0, len(vectors), SCAN_CHUNK_ROWS)
+            ]).astype(np.int32)
+
+
+def kmeans(
+        sample: np.ndarray,
+        num_clusters: int,
+        iterations: int = KMEANS_ITERATIONS,
+        metric: str = "ip",
+        seed: int = 0
+        ) -> np.ndarray:
+    """Lloyd's k-means of the rows of `sample`
+
+    With `ip` rows join the centroid of largest inner product, as in
+    pgvector's IVFFlat with `vector_ip_ops`; `l2` is the usual k-means,
+    used for the product quantization codebooks. Empty clusters are
+    reseeded with random rows.
+
+    Returns:
+        centroids of shape (min(num_clusters, len(sample)), dim)
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(sample, dtype=np.float32)
+    num_clusters = min(num_clusters, len(sample))
+    centroids = sample[rng.choice(len(sample), num_clusters, replace=False)]
+    for _ in range(iterations):
+        labels = assign_chunked(sample, centroids, metric)
+        counts = np.bincount(labels, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def train_pq(sample: np.ndarray, num_subvectors: int, seed: int = 0) -> np.ndarray:
+    """Product quantization codebooks, (num_subvectors, codewords, dim / num_subvectors)"""
+    dim = sample.shape[1]
+    if dim % num_subvectors:
+        raise ValueError(f"{num_subvectors} subvectors do not split {dim} dimensions evenly")
+    width = dim // num_subvectors
+    return np.stack([
+            kmeans(sample[:, j * width:(j + 1) * width], PQ_CENTROIDS, metric="l2", seed=seed + j)
+            for j in range(num_subvectors)
+            ])
+
+
+def pq_encode(vectors: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+    """One byte per subspace of each vector, (len(vectors), num_subvectors)"""
+    num_subvectors, _, width = codebooks.shape
+    return np.stack([
+            _assign(vectors[:, j * width:(j + 1) * width], codebooks[j], "l2")
+            for j in range(num_subvectors)
+            ], axis=1).astype(np.uint8)
+
+
+def pq_tables(queries: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+    """Inner product of each query subvector with each codeword,
+    (num_queries, num_subvectors, codewords)"""
+    num_subvectors, _, width = codebooks.shape
+    return np.einsum("qmd,mcd->qmc", queries.reshape(len(queries), num_subvectors, width), codebooks)
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """Columns of the `k` best scores of each row, unordered"""
+    if scores.shape[1] <= k:
+        return np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def exact_scan(
+        vectors: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        start: int = 0
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact top-k rows (from `start`) of a batch, one matrix product per block
+
+    Returns:
+        (rows, scores) of shape (num_queries, k), -1 / -inf padded
+    """
+    rows = [np.full((len(queries), k), -1, dtype=np.int64)]
+    scores = [np.full((len(queries), k), -np.inf, dtype=np.float32)]
+    for first in range(start, len(vectors), SCAN_CHUNK_ROWS):
+        block = queries @ np.asarray(vectors[first:first + SCAN_CHUNK_ROWS], dtype=np.float32).T
+        top = _top(block, k)
+        rows.append(first + top)
+        scores.append(np.take_along_axis(block, top, axis=1))
+    return merge_top_k(rows, scores, k)
+
+
+class IvfIndex:
+    """Inverted lists over the rows of a table, optionally product quantized
+
+    `order` holds row numbers grouped by list, list `l` being
+    `order[offsets[l]:offsets[l + 1]]`; `codes` are the PQ codes of the
+    rows in the same order. Rows appended after the build (from `rows`
+    on) are not in the lists, searches scan them exactly.
+    """
+    FILES = ("centroids", "order", "offsets", "codebooks", "codes")
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            order: np.ndarray,
+            offsets: np.ndarray,
+            codebooks: Optional[np.ndarray] = None,
+            codes: Optional[np.ndarray] = None
+            ) -> None:
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.codebooks = codebooks
+        self.codes = codes
+
+    @property
+    def rows(self) -> int:
+        return len(self.order)
+
+    def save(self, table_dir: str) -> None:
+        for name in self.FILES:
+            array = getattr(self, name)
+            if array is not None:
+                path = os.path.join(table_dir, f"ivf_{name}.npy")
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, array)
+                os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, table_dir: str, quantized: bool) -> "IvfIndex":
+        names = cls.FILES if quantized else cls.FILES[:3]
+        return cls(*(np.load(os.path.join(table_dir, f"ivf_{name}.npy"), mmap_mode="r") for name in names))
+
+    def search(
+            self,
+            vectors: np.ndarray,
+            queries: np.ndarray,
+            k: int,
+            probes: int,
+            rerank: int
+            ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k of the indexed rows, scanning the `probes` closest lists
+
+        The rows of each probed list are scored against every query
+        probing it at once. With PQ codes, `k * rerank` candidates are
+        scored from the codes and reranked on the float vectors.
+        """
+        num_queries = len(queries)
+        probed = _top(queries @ self.centroids.T, min(probes, len(self.centroids)))
+        keep = k * rerank if self.codes is not None else k
+        tables = pq_tables(queries, self.codebooks) if self.codes is not None else None
+        found: List[List[np.ndarray]] = [[] for _ in range(num_queries)]
+        found_scores: List[List[np.ndarray]] = [[] for _ in range(num_queries)]
+        for list_id in np.unique(probed):
+            first, last = int(self.offsets[list_id]), int(self.offsets[list_id + 1])
+            if first == last:
+                continue
+            members = np.asarray(self.order[first:last])
+            asking = np.nonzero((probed == list_id).any(axis=1))[0]
+            if tables is None:
+                block = queries[asking] @ np.asarray(vectors[members], dtype=np.float32).T
+            else:
+                codes = np.asarray(self.codes[first:last])
+                block = tables[asking][:, np.arange(codes.shape[1]), codes].sum(axis=2)
+            top = _top(block, keep)
+            for row, query in enumerate(asking):
+                found[query].append(members[top[row]])
+                found_scores[query].append(block[row, top[row]])
+
+        rows = np.full((num_queries, k), -1, dtype=np.int64)
+        scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        for query in range(num_queries):
+            if not found[query]:
+                continue
+            candidates = np.concatenate(found[query])
+            candidate_scores = np.concatenate(found_scores[query])
+            if tables is not None:
+                candidates = candidates[_top(candidate_scores[None, :], keep)[0]]
+                candidates.sort()
+                candidate_scores = np.asarray(vectors[candidates], dtype=np.float32) @ queries[query]
+            best = np.argsort(-candidate_scores, kind="stable")[:k]
+            rows[query, :len(best)] = candidates[best]
+            scores[query, :len(best)] = candidate_scores[best]
+        return rows, scores
+
+
+class NumpyTable:
+    """One table of a `NumpyStore`
+
+    Files under its directory:
+        table.json: text columns, dimensions, committed rows, index
+        vectors.f32: float32 embeddings, row after row (memory-mapped)
+        columns-<first id>.parquet: text columns of the rows appended
+                    by one commit, with their `id`
+        ivf_*.npy: the `IvfIndex`
+
+    `table.json` is replaced last on every commit; vectors and column
+    files past its row count are leftovers of an interrupted commit and
+    are overwritten by the next one. One process writes a table at a
+    time, writer threads of that process take turns.
+    """
+    def __init__(self, table_dir: str) -> None:
+        self.table_dir = table_dir
+        self.lock = threading.RLock()
+        self.meta = {"columns": None, "dim": None, "rows": 0, "index": None}
+        meta_path = os.path.join(table_dir, "table.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        self.index = None
+        if self.meta["index"]:
+            self.index = IvfIndex.load(table_dir, quantized=bool(self.meta["index"]["pq_subvectors"]))
+        self._vectors = None
+        self._frame = None
+        self.source_ids = None
+
+    @property
+    def rows(self) -> int:
+        return self.meta["rows"]
+
+    def _save_meta(self) -> None:
+        path = os.path.join(self.table_dir, "table.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def vectors(self) -> np.ndarray:
+        """Memory map of the committed embeddings, (rows, dim)"""
+        with self.lock:
+            if not self.rows:
+                return np.zeros((0, self.meta["dim"] or 0), dtype=np.float32)
+            if self._vectors is None or len(self._vectors) != self.rows:
+                self._vectors = np.memmap(
+                        os.path.join(self.table_dir, "vectors.f32"),
+                        dtype=np.float32,
+                        mode="r",
+                        shape=(self.rows, self.meta["dim"])
+                        )
+            return self._vectors
+
+    def _segments(self) -> List[str]:
+        paths = sorted(glob.glob(os.path.join(self.table_dir, "columns-*.parquet")))
+        return [path for path in paths if int(os.path.basename(path)[8:20]) <= self.rows]
+
+    def frame(self) -> pd.DataFrame:
+        """Text columns of the committed rows, indexed by id"""
+        with self.lock:
+            if self._frame is None or len(self._frame) != self.rows:
+                frames = [pd.read_parquet(path) for path in self._segments()]
+                columns = ["id"] + list(self.meta["columns"] or [])
+                frame = pd.concat(frames) if frames else pd.DataFrame(columns=columns)
+                self._frame = frame.set_index("id")
+            return self._frame
+
+    def load_source_ids(self) -> None:
+        with self.lock:
+            if self.source_ids is None:
+                self.source_ids = set()
+                if "source_id" in (self.meta["columns"] or []):
+                    self.source_ids = set(self.frame()["source_id"].tolist())
+
+    def append(self, rows: Sequence[Sequence[str]], vectors: np.ndarray, columns: Sequence[str]) -> None:
+        """Commit rows and their embeddings, ids follow the last row's"""
+        with self.lock:
+            if self.meta["columns"] is None:
+                self.meta["columns"], self.meta["dim"] = list(columns), int(vectors.shape[1])
+            if list(columns) != self.meta["columns"] or vectors.shape[1] != self.meta["dim"]:
+                raise ValueError(f"{self.table_dir} holds {self.meta['columns']} and {self.meta['dim']} "
+                                 f"dimensions, got {list(columns)} and {vectors.shape[1]}")
+            first_id = self.rows + 1
+            path = os.path.join(self.table_dir, "vectors.f32")
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.truncate(self.rows * self.meta["dim"] * 4)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            frame = pd.DataFrame(list(rows), columns=self.meta["columns"])
+            frame.insert(0, "id", np.arange(first_id, first_id + len(frame), dtype=np.int64))
+            segment = os.path.join(self.table_dir, f"columns-{first_id:012d}.parquet")
+            frame.to_parquet(segment + ".tmp", index=False)
+            os.replace(segment + ".tmp", segment)
+            self.meta["rows"] += len(frame)
+            self._save_meta()
+            if self.source_ids is not None and "source_id" in frame:
+                self.source_ids.update(frame["source_id"].tolist())
+
+    def set_index(self, index: IvfIndex, lists: int, pq_subvectors: int) -> None:
+        with self.lock:
+            index.save(self.table_dir)
+            self.meta["index"] = {"lists": lists, "rows": index.rows, "pq_subvectors": pq_subvectors}
+            self._save_meta()
+            self.index = IvfIndex.load(self.table_dir, quantized=bool(pq_subvectors))
+
+
+class NumpyStoreWriter:
+    """Append rows to a `NumpyTable`, committing every `commit_rows` rows
+
+    Rows whose `source_id` is already stored are skipped, so a replayed
+    load does not duplicate them. Has the writer interface of
+    `database.writers`, `connection` is None.
+    """
+    def __init__(
+            self,
+            table: NumpyTable,
+            columns: Sequence[str],
+            commit_rows: int = COMMIT_ROWS
+            ) -> None:
+        self.connection = None
+        self.table = table
+        self.columns = tuple(columns)
+        self.commit_rows = commit_rows
+        self.source_index = self.columns.index("source_id") if "source_id" in self.columns else None
+        self.rows = []
+        self.embeddings = []
+        self.pending_rows = 0
+        self.timings = dict.fromkeys(WRITE_PHASES, 0.0)
+        if self.source_index is not None:
+            table.load_source_ids()
+
+    def write(
+            self,
+            rows: Sequence[Sequence[str]],
+            embeddings
+            ) -> None:
+        start = time.perf_counter()
+        vectors = to_host_array(embeddings).astype(np.float32, copy=False)
+        if self.source_index is not None:
+            with self.table.lock:
+                keep = [i for i, row in enumerate(rows) if row[self.source_index] not in self.table.source_ids]
+            rows, vectors = [rows[i] for i in keep], vectors[keep]
+        self.rows.extend(rows)
+        self.embeddings.append(vectors)
+        self.pending_rows += len(rows)
+        self.timings["serialize"] += time.perf_counter() - start
+        if self.pending_rows >= self.commit_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        """Commit the pending rows"""
+        if self.pending_rows == 0:
+            return
+        start = time.perf_counter()
+        self.table.append(self.rows, np.concatenate(self.embeddings), self.columns)
+        self.timings["commit"] += time.perf_counter() - start
+        self.rows = []
+        self.embeddings = []
+        self.pending_rows = 0
+
+    def close(self) -> None:
+        self.flush()
+
+
+class NumpyStore(VectorStore):
+    """Tables kept in memory-mapped files, searched in NumPy
+
+    Every table is a directory under `store_dir` (see `NumpyTable`).
+    Without an index a search scans every row, one matrix product per
+    block of `SCAN_CHUNK_ROWS`; `create_index` trains an IVF index (and
+    optionally product quantization) like pgvector's IVFFlat, searched
+    with `probes` lists per query. No server is needed, one process
+    writes a store at a time.
+
+    Args:
+        store_dir: directory of the store's tables
+    """
+    def __init__(self, store_dir: str = NUMPY_STORE_DIR) -> None:
+        self.store_dir = store_dir
+        self.tables: Dict[str, NumpyTable] = {}
+        self.lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+    def table(self, tb_name: str) -> NumpyTable:
+        with self.lock:
+            if tb_name not in self.tables:
+                table_dir = os.path.join(self.store_dir, tb_name)
+                os.makedirs(table_dir, exist_ok=True)
+                self.tables[tb_name] = NumpyTable(table_dir)
+            return self.tables[tb_name]
+
+    def open_writer(self, tb_name: str, columns: Sequence[str], hook=None):
+        """`NumpyStoreWriter` of a table; checkpoint hooks need a database, `hook` is ignored"""
+        return NumpyStoreWriter(self.table(tb_name), columns)
+
+    def create_index(
+            self,
+            tb_name: str,
+            lists: int = 0,
+            pq_subvectors: int = 0,
+            sample_rows: int = IVF_TRAIN_SAMPLE,
+            seed: int = 0,
+            **options
+            ) -> None:
+        """Train and build the IVF index of a table
+
+        Centroids are trained by k-means on `sample_rows` random rows,
+        every row then joins its list. With `pq_subvectors` the rows are
+        also encoded with product quantization, one byte per subvector,
+        and searches score them from their codes before reranking.
+
+        Args:
+            tb_name: table to index
+            lists: number of lists, `make_database.ivfflat_lists` of the
+                    row count if 0
+            pq_subvectors: subvectors of the PQ codes, 0 keeps only float
+                    vectors; must divide the dimensions
+            sample_rows: rows k-means is trained on
+            seed: random seed of the sample and the initial centroids
+            options: options of other stores (`method`, `m`, ...), ignored
+        """
+        table = self.table(tb_name)
+        vectors = table.vectors()
+        if not len(vectors):
+            raise ValueError(f"{tb_name} is empty, nothing to index")
+        lists = lists or ivfflat_lists(len(vectors))
+        started = time.perf_counter()
+        rng = np.random.default_rng(seed)
+        picked = np.sort(rng.choice(len(vectors), min(len(vectors), sample_rows), replace=False))
+        sample = np.asarray(vectors[picked], dtype=np.float32)
+        centroids = kmeans(sample, lists, metric="ip", seed=seed)
+        labels = assign_chunked(vectors, centroids)
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=len(centroids)))]).astype(np.int64)
+        codebooks = codes = None
+        if pq_subvectors:
+            codebooks = train_pq(sample, pq_subvectors, seed=seed)
+            codes = np.empty((len(order), pq_subvectors), dtype=np.uint8)
+            for first in range(0, len(order), SCAN_CHUNK_ROWS):
+                # read the block in row order, store its codes in list order
+                block = order[first:first + SCAN_CHUNK_ROWS]
+                positions = np.argsort(block)
+                codes[first + positions] = pq_encode(np.asarray(vectors[block[positions]], dtype=np.float32), codebooks)
+        table.set_index(IvfIndex(centroids, order, offsets, codebooks, codes), len(centroids), pq_subvectors)
+        logger.info(f"Built the IVF index of {tb_name}: {len(centroids)} lists over {len(order)} rows"
+                    f"{f', {pq_subvectors} PQ subvectors' if pq_subvectors else ''} "
+                    f"in {time.perf_counter() - started:.1f}s")
+
+    def search(
+            self,
+            embeddings,
+            tb_name: str,
+            k: int = 10,
+            probes: Optional[int] = None,
+            rerank: int = RERANK_FACTOR
+            ) -> SearchResult:
+        """Top-k inner-product search of a batch
+
+        With an index, `probes` lists are scanned per query
+        (`make_database.ivfflat_probes` of the lists by default) and the
+        rows appended since the build are scanned exactly; `rerank` is
+        the candidates per result scored from PQ codes.
+        """
+        table = self.table(tb_name)
+        queries = to_host_array(embeddings).astype(np.float32, copy=False)
+        vectors = table.vectors()
+        index = table.index
+        if index is None:
+            rows, scores = exact_scan(vectors, queries, k)
+        else:
+            probes = probes or ivfflat_probes(len(index.centroids))
+            indexed = index.search(vectors, queries, k, probes, rerank)
+            recent = exact_scan(vectors, queries, k, start=index.rows)
+            rows, scores = merge_top_k([indexed[0], recent[0]], [indexed[1], recent[1]], k)
+        return SearchResult(ids=np.where(rows >= 0, rows + 1, -1), scores=scores)
+
+    def fetch(
+            self,
+            tb_name: str,
+            ids: Sequence[int],
+            columns: Sequence[str] = ("title", "content")
+            ) -> Dict[int, Dict[str, Any]]:
+        frame = self.table(tb_name).frame()
+        found = frame.loc[frame.index.intersection([int(i) for i in ids]), list(columns)]
+        return {int(i): row for i, row in zip(found.index, found.to_dict("records"))}
+
+    def count(self, tb_name: str) -> int:
+        return self.table(tb_name).rows
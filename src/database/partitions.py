@@ -0,0 +1,114 @@
+from typing import (
+        List,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+PARTITION_METHODS = ("none", "hash", "range")
+# partitions of a table, `$1`/`%s` is the parent table
+PARTITIONS_SQL = '''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass({param})
+        ORDER BY c.relname
+        '''
+
+
+def partition_keys(partition_by: str) -> Tuple[str, str, str]:
+    """Key columns, key constraints and `PARTITION BY` clause of a table
+
+    Unique constraints of a partitioned table must contain its partition
+    key: `hash` partitions on `source_id`, so replayed rows are still
+    skipped by `ON CONFLICT`; `range` partitions on `id`, where
+    `source_id` is only unique together with `id`. A replayed row gets a
+    new `id` and never conflicts, so the loaders refuse range partitioned
+    tables (see `make_database.ensure_source_id`).
+
+    Returns:
+        (`id` and `source_id` column definitions, constraints to append
+        to the column list, partition clause)
+    """
+    if partition_by == "none":
+        return "id SERIAL PRIMARY KEY,\n                source_id TEXT UNIQUE,", "", ""
+    key_columns = "id SERIAL,\n                source_id TEXT NOT NULL,"
+    if partition_by == "hash":
+        return key_columns, \
+                ",\n                PRIMARY KEY (id, source_id),\n                UNIQUE (source_id)", \
+                "PARTITION BY HASH (source_id)"
+    if partition_by == "range":
+        return key_columns, \
+                ",\n                PRIMARY KEY (id),\n                UNIQUE (source_id, id)", \
+                "PARTITION BY RANGE (id)"
+    raise ValueError(f"Unknown partitioning {partition_by}, expected one of {PARTITION_METHODS}")
+
+
+def partition_name(tb_name: str, index: int) -> str:
+    return f"{tb_name}_p{index}"
+
+
+def create_partitions_sql(
+        tb_name: str,
+        partition_by: str,
+        partitions: int,
+        partition_rows: int
+        ) -> str:
+    """DDL of the partitions of `tb_name`
+
+    Hash partitions split `source_id` evenly, range partitions hold
+    `partition_rows` ids each and the last one every id above.
+    """
+    statements = []
+    for index in range(partitions):
+        if partition_by == "hash":
+            bounds = f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {index})"
+        else:
+            lower = "MINVALUE" if index == 0 else index * partition_rows + 1
+            upper = "MAXVALUE" if index == partitions - 1 else (index + 1) * partition_rows + 1
+            bounds = f"FOR VALUES FROM ({lower}) TO ({upper})"
+        statements.append(f"CREATE TABLE {partition_name(tb_name, index)} PARTITION OF {tb_name} {bounds};")
+    return "\n".join(statements)
+
+
+def list_partitions(connection, tb_name: str) -> List[str]:
+    """Partitions of `tb_name`, empty when it is not partitioned"""
+    with connection.cursor() as cursor:
+        cursor.execute(PARTITIONS_SQL.format(param="%s"), (tb_name,))
+        partitions = [row[0] for row in cursor.fetchall()]
+    connection.commit()
+    return partitions
+
+
+def is_range_partitioned(connection, tb_name: str) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute(
+                "SELECT partstrat = 'r' FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+                (tb_name,))
+        result = cursor.fetchone()
+    connection.commit()
+    return bool(result and result[0])
+
+
+def merge_top_k(
+        ids: Sequence[np.ndarray],
+        scores: Sequence[np.ndarray],
+        k: int
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge the per-partition top-k of a batch into the global top-k
+
+    Args:
+        ids, scores: one (num_queries, k) array per partition, padded
+                    with -1 / -inf
+        k: results kept per query
+
+    Returns:
+        (ids, scores) of shape (num_queries, k), best score first
+    """
+    all_ids = np.concatenate(ids, axis=1)
+    all_scores = np.concatenate(scores, axis=1)
+    order = np.argsort(-all_scores, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(all_ids, order, axis=1), np.take_along_axis(all_scores, order, axis=1)
@@ -0,0 +1,493 @@
+import copy
+import itertools
+import os
+import queue
+import threading
+import time
+from typing import (
+        Any,
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Tuple
+        )
+
+import numpy as np
+import torch
+from transformers import (
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+from model.retriever_model import (
+        encode_ctx,
+        tokenize_ctx
+        )
+from model.embedding_cache import (
+        EmbeddingCache
+        )
+from data.dedup import (
+        Deduplicator
+        )
+from model.batching import (
+        TokenBudget,
+        auto_max_tokens,
+        encode_ctx_buckets,
+        tokenize_ctx_buckets
+        )
+from database.vector_codec import (
+        to_host_array
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+BATCH=int(os.getenv("BATCH", 16))
+ENCODE_WINDOW=int(os.getenv("ENCODE_WINDOW", 256))
+PIPELINE_QUEUE_SIZE=int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+PIPELINE_LOG_INTERVAL=float(os.getenv("PIPELINE_LOG_INTERVAL", 60))
+
+_DONE = object()
+
+
+class StageCounter:
+    """Throughput counters of one pipeline stage
+
+    `busy` is the time spent doing the stage's own work, `wait_in` the
+    time blocked on an empty input queue (starved) and `wait_out` the
+    time blocked on a full output queue (back-pressured). The stage with
+    the highest busy share is the bottleneck.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.batches = 0
+        self.rows = 0
+        self.busy = 0.0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.lock = threading.Lock()
+
+    def record(
+            self,
+            rows: int = 0,
+            busy: float = 0.0,
+            wait_in: float = 0.0,
+            wait_out: float = 0.0
+            ) -> None:
+        with self.lock:
+            self.batches += 1 if rows else 0
+            self.rows += rows
+            self.busy += busy
+            self.wait_in += wait_in
+            self.wait_out += wait_out
+
+    def summary(self, elapsed: float) -> Dict[str, float]:
+        with self.lock:
+            return {
+                    "stage": self.name,
+                    "rows": self.rows,
+                    "batches": self.batches,
+                    "rows_per_sec": self.rows / self.busy if self.busy else 0.0,
+                    "busy_sec": round(self.busy, 3),
+                    "wait_in_sec": round(self.wait_in, 3),
+                    "wait_out_sec": round(self.wait_out, 3),
+                    "utilization": round(self.busy / elapsed, 3) if elapsed else 0.0,
+                    }
+
+
+class Batch:
+    """A batch of source rows travelling through the pipeline
+
+    `start`/`end` are the source offsets of its first and past-the-last
+    row, used to checkpoint what has been committed. Rows dropped as
+    duplicates still count in the range, `links` holds them when they
+    are linked to their canonical row.
+    """
+    __slots__ = ("seq", "start", "end", "rows", "encoded_input", "embeddings", "cache_plan", "links")
+
+    def __init__(self, seq: int, start: int, rows: List[Tuple[str, ...]]) -> None:
+        self.seq = seq
+        self.start = start
+        self.end = start + len(rows)
+        self.rows = rows
+        self.encoded_input = None
+        self.embeddings = None
+        self.cache_plan = None
+        self.links = None
+
+
+class IngestionPipeline:
+    """Staged producer/consumer ingestion
+
+    reader -> tokenizer pool -> encoder -> writer(s), connected by
+    bounded queues so a slow stage back-pressures the ones before it
+    instead of buffering without limit. Any stage failing stops the
+    whole pipeline and the error is re-raised from `run`.
+
+    Args:
+        rows: iterable of row tuples, ordered as the writer's columns
+        content_index: position of the passage text inside a row
+        context_encoder: a model that encodes data to embedding
+        context_tokenizer: a tokenizer that creates input for `context_encoder`
+        device: device the encoder runs on
+        open_writer: opens a writer (with its own database connection, if
+                    any), called once per writer thread with its hook
+        start_offset: source offset of the first row of `rows`
+        make_hook: creates the `CheckpointHook` of a writer, if any
+        max_tokens: encode with length-bucketed batches of at most
+                    `max_tokens` padded tokens (0 derives the budget from the
+                    device memory) instead of fixed `BATCH` rows
+        batch_size: number of rows per batch, defaults to `BATCH`, or to
+                    `ENCODE_WINDOW` (rows bucketed together) with `max_tokens`
+        num_tokenizers: number of tokenizer threads
+        num_writers: number of writer threads
+        queue_size: capacity of each inter-stage queue, in batches
+        cache: embedding cache, only passages it misses are encoded
+        dedup: drops exact and near duplicate passages before they are
+                    tokenized; the last column of a row is its `source_id`
+    """
+    def __init__(
+            self,
+            rows: Iterable[Tuple[str, ...]],
+            content_index: int,
+            context_encoder: DPRContextEncoder,
+            context_tokenizer: DPRContextEncoderTokenizer,
+            device: torch.device,
+            open_writer: Callable[[Any], Any],
+            start_offset: int = 0,
+            make_hook: Optional[Callable[[], Any]] = None,
+            max_tokens: Optional[int] = None,
+            batch_size: Optional[int] = None,
+            num_tokenizers: int = 1,
+            num_writers: int = 1,
+            queue_size: int = PIPELINE_QUEUE_SIZE,
+            cache: Optional[EmbeddingCache] = None,
+            dedup: Optional[Deduplicator] = None,
+            ) -> None:
+        self.rows = rows
+        self.content_index = content_index
+        self.context_encoder = context_encoder
+        self.context_tokenizer = context_tokenizer
+        self.device = device
+        self.open_writer = open_writer
+        self.start_offset = start_offset
+        self.make_hook = make_hook
+        self.budget = None
+        if max_tokens is not None:
+            self.budget = TokenBudget(max_tokens or auto_max_tokens(context_encoder, device))
+            logger.info(f"Encoding with a budget of {self.budget.max_tokens} tokens per batch")
+        if batch_size is None:
+            batch_size = BATCH if self.budget is None else ENCODE_WINDOW
+        self.batch_size = batch_size
+        self.num_tokenizers = max(1, num_tokenizers)
+        self.num_writers = max(1, num_writers)
+        self.cache = cache
+        self.dedup = dedup
+
+        self.read_queue = queue.Queue(maxsize=queue_size)
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+
+        self.counters = {
+                name: StageCounter(name)
+                for name in ("read", "tokenize", "encode", "write")
+                }
+        # seconds the writers spent per phase (serialize, send, commit)
+        self.write_timings: Dict[str, float] = {}
+        self.stop = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.error_lock = threading.Lock()
+
+    def _fail(self, err: BaseException) -> None:
+        with self.error_lock:
+            if self.error is None:
+                self.error = err
+        self.stop.set()
+
+    def _put(self, target: queue.Queue, item) -> float:
+        """Put `item` on a bounded queue, returns time spent blocked"""
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return time.perf_counter() - start
+
+    def _get(self, source: queue.Queue):
+        """Get an item, returns (item, time spent blocked)"""
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                item = source.get(timeout=0.1)
+                return item, time.perf_counter() - start
+            except queue.Empty:
+                continue
+        return _DONE, time.perf_counter() - start
+
+    def _read(self) -> None:
+        counter = self.counters["read"]
+        try:
+            seq = 0
+            offset = self.start_offset
+            iterator = iter(self.rows)
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                batch_rows = list(itertools.islice(iterator, self.batch_size))
+                busy = time.perf_counter() - start
+                if not batch_rows:
+                    break
+                batch = Batch(seq, offset, batch_rows)
+                if self.dedup is not None:
+                    start = time.perf_counter()
+                    batch.rows, batch.links = self.dedup.filter(
+                            batch_rows,
+                            content_index=self.content_index,
+                            id_index=len(batch_rows[0]) - 1
+                            )
+                    busy += time.perf_counter() - start
+                wait = self._put(self.read_queue, batch)
+                counter.record(rows=len(batch_rows), busy=busy, wait_out=wait)
+                seq += 1
+                offset += len(batch_rows)
+        except Exception as err:
+            self._fail(err)
+        finally:
+            for _ in range(self.num_tokenizers):
+                self._put(self.read_queue, _DONE)
+
+    def _tokenize(self, tokenizer: DPRContextEncoderTokenizer) -> None:
+        counter = self.counters["tokenize"]
+        try:
+            while True:
+                batch, wait_in = self._get(self.read_queue)
+                if batch is _DONE:
+                    break
+                start = time.perf_counter()
+                text = [row[self.content_index] for row in batch.rows]
+                if self.cache is not None and text:
+                    batch.cache_plan = self.cache.plan(text)
+                    text = [text[i] for i in batch.cache_plan.encode_index]
+                if not text:
+                    batch.encoded_input = None
+                elif self.budget is None:
+                    batch.encoded_input = tokenize_ctx(tokenizer=tokenizer, text=text)
+                else:
+                    batch.encoded_input = tokenize_ctx_buckets(
+                            tokenizer=tokenizer,
+                            text=text,
+                            budget=self.budget
+                            )
+                busy = time.perf_counter() - start
+                wait_out = self._put(self.encode_queue, batch)
+                counter.record(rows=len(batch.rows), busy=busy, wait_in=wait_in, wait_out=wait_out)
+        except Exception as err:
+            self._fail(err)
+        finally:
+            self._put(self.encode_queue, _DONE)
+
+    def _encode_input(self, encoded_input) -> torch.Tensor:
+        if self.budget is None:
+            return encode_ctx(
+                    model_encoder=self.context_encoder,
+                    encoded_input=encoded_input,
+                    device=self.device
+                    )
+        return encode_ctx_buckets(
+                model_encoder=self.context_encoder,
+                buckets=encoded_input,
+                device=self.device,
+                budget=self.budget
+                )
+
+    def _merge_cached(self, batch: Batch, encoded: Optional[np.ndarray]) -> np.ndarray:
+        """Store the batch's new embeddings and fill in the cached ones"""
+        plan = batch.cache_plan
+        parts = [(plan.hit_index, plan.hit_vectors)]
+        if len(plan.encode_index):
+            self.cache.put(plan.keys[plan.encode_index], encoded)
+            parts.append((plan.encode_index, encoded))
+        if len(plan.deferred_index):
+            found, vectors = self.cache.get(plan.keys[plan.deferred_index])
+            parts.append((plan.deferred_index[found], vectors))
+            missing = plan.deferred_index[~found]
+            if len(missing):
+                # claimed by a batch that is not encoded yet (several
+                # tokenizers may reorder batches), encode them here
+                text = [batch.rows[i][self.content_index] for i in missing]
+                vectors = to_host_array(encode_ctx(
+                        model_encoder=self.context_encoder,
+                        encoded_input=tokenize_ctx(tokenizer=self.context_tokenizer, text=text),
+                        device=self.device
+                        ))
+                parts.append((missing, vectors))
+        dim = next(vectors.shape[1] for index, vectors in parts if len(index))
+        output = np.empty((len(batch.rows), dim), dtype=np.float32)
+        for index, vectors in parts:
+            output[index] = vectors
+        return output
+
+    def _encode(self) -> None:
+        counter = self.counters["encode"]
+        remaining = self.num_tokenizers
+        try:
+            while remaining:
+                batch, wait_in = self._get(self.encode_queue)
+                if batch is _DONE:
+                    remaining -= 1
+                    if self.stop.is_set():
+                        break
+                    continue
+                start = time.perf_counter()
+                embeddings = None
+                if batch.encoded_input is not None:
+                    embeddings = to_host_array(self._encode_input(batch.encoded_input))
+                if self.cache is not None and batch.rows:
+                    embeddings = self._merge_cached(batch, embeddings)
+                batch.embeddings = embeddings
+                batch.encoded_input = None
+                batch.cache_plan = None
+                busy = time.perf_counter() - start
+                wait_out = self._put(self.write_queue, batch)
+                counter.record(rows=len(batch.rows), busy=busy, wait_in=wait_in, wait_out=wait_out)
+        except Exception as err:
+            self._fail(err)
+        finally:
+            for _ in range(self.num_writers):
+                self._put(self.write_queue, _DONE)
+
+    def _write(self) -> None:
+        counter = self.counters["write"]
+        writer = None
+        try:
+            hook = self.make_hook() if self.make_hook is not None else None
+            writer = self.open_writer(hook)
+            while True:
+                batch, wait_in = self._get(self.write_queue)
+                if batch is _DONE:
+                    break
+                start = time.perf_counter()
+                if hook is not None:
+                    hook.add(batch.start, batch.end)
+                    if batch.links:
+                        hook.add_links(batch.links)
+                if batch.rows:
+                    writer.write(rows=batch.rows, embeddings=batch.embeddings)
+                counter.record(rows=len(batch.rows), busy=time.perf_counter() - start, wait_in=wait_in)
+            if not self.stop.is_set():
+                start = time.perf_counter()
+                writer.close()
+                counter.record(busy=time.perf_counter() - start)
+        except Exception as err:
+            self._fail(err)
+        finally:
+            if writer is not None:
+                with self.error_lock:
+                    for phase, seconds in getattr(writer, "timings", {}).items():
+                        self.write_timings[phase] = self.write_timings.get(phase, 0.0) + seconds
+            # uncommitted rows of a failed run are rolled back on close
+            if writer is not None and writer.connection is not None:
+                writer.connection.close()
+
+    def report(self, elapsed: float) -> List[Dict[str, float]]:
+        """Per-stage throughput, logged and returned"""
+        summaries = [counter.summary(elapsed) for counter in self.counters.values()]
+        with self.error_lock:
+            write_timings = dict(self.write_timings)
+        for summary in summaries:
+            logger.info(
+                    f"[{summary['stage']}] rows={summary['rows']} "
+                    f"rows/s={summary['rows_per_sec']:.1f} "
+                    f"busy={summary['busy_sec']}s "
+                    f"starved={summary['wait_in_sec']}s "
+                    f"blocked={summary['wait_out_sec']}s "
+                    f"utilization={summary['utilization']}"
+                    )
+        if write_timings:
+            # collected as the writers finish, summed over writer threads
+            summaries[-1].update({f"{phase}_sec": round(seconds, 3) for phase, seconds in write_timings.items()})
+            logger.info("[write] " + " ".join(f"{phase}={seconds:.3f}s" for phase, seconds in write_timings.items()))
+        if self.cache is not None:
+            logger.info(f"[cache] {self.cache.stats()}")
+        if self.dedup is not None:
+            logger.info(f"[dedup] {self.dedup.stats()}")
+        return summaries
+
+    def run(self) -> List[Dict[str, float]]:
+        """Run every stage until the source is exhausted
+
+        Returns:
+            per-stage throughput summaries
+        """
+        threads = [threading.Thread(target=self._read, name="ingest-read", daemon=True)]
+        threads += [
+                threading.Thread(
+                    target=self._tokenize,
+                    args=(copy.deepcopy(self.context_tokenizer),),
+                    name=f"ingest-tokenize-{i}",
+                    daemon=True
+                    )
+                for i in range(self.num_tokenizers)
+                ]
+        threads.append(threading.Thread(target=self._encode, name="ingest-encode", daemon=True))
+        threads += [
+                threading.Thread(target=self._write, name=f"ingest-write-{i}", daemon=True)
+                for i in range(self.num_writers)
+                ]
+
+        started = time.perf_counter()
+        last_report = started
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+                now = time.perf_counter()
+                if now - last_report >= PIPELINE_LOG_INTERVAL:
+                    self.report(now - started)
+                    last_report = now
+
+        summaries = self.report(time.perf_counter() - started)
+        if self.error is not None:
+            raise self.error
+        return summaries
+
+
+def run_pipeline(
+        rows: Iterable[Tuple[str, ...]],
+        content_index: int,
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        open_writer: Callable[[Any], Any],
+        start_offset: int = 0,
+        make_hook: Optional[Callable[[], Any]] = None,
+        max_tokens: Optional[int] = None,
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        cache: Optional[EmbeddingCache] = None,
+        dedup: Optional[Deduplicator] = None,
+        ) -> List[Dict[str, float]]:
+    """Build an `IngestionPipeline` and run it to completion"""
+    pipeline = IngestionPipeline(
+            rows=rows,
+            content_index=content_index,
+            context_encoder=context_encoder,
+            context_tokenizer=context_tokenizer,
+            device=device,
+            open_writer=open_writer,
+            start_offset=start_offset,
+            make_hook=make_hook,
+            max_tokens=max_tokens,
+            num_tokenizers=num_tokenizers,
+            num_writers=num_writers,
+            cache=cache,
+            dedup=dedup,
+            )
+    return pipeline.run()
@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+        Any,
+        Callable,
+        Dict,
+        Hashable,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+
+from model.embedding_cache import (
+        normalize_text
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+SEARCH_CACHE_CHANNEL=os.getenv("SEARCH_CACHE_CHANNEL", "search_cache_invalidate")
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a time-to-live and a memory bound
+
+    Entries older than `ttl` seconds are treated as missing. The least
+    recently used entries are evicted once there are more than
+    `max_entries` of them or they hold more than `max_bytes`.
+
+    Args:
+        max_entries: entries kept at most
+        max_bytes: approximate bytes kept at most, as measured by `sizeof`
+        ttl: seconds an entry stays valid, 0 keeps entries until evicted
+        sizeof: approximate size of a value in bytes
+    """
+    def __init__(
+            self,
+            max_entries: int,
+            max_bytes: int,
+            ttl: float = 0,
+            sizeof: Callable[[Any], int] = lambda value: 0
+            ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(("hits", "misses", "expired", "evicted"), 0)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counts["misses"] += 1
+                return None
+            stored, size, value = entry
+            if self.ttl and time.monotonic() - stored > self.ttl:
+                self._drop(key)
+                self.counts["expired"] += 1
+                self.counts["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts["hits"] += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.monotonic(), size, value)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._drop(next(iter(self.entries)))
+                self.counts["evicted"] += 1
+
+    def _drop(self, key: Hashable) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def discard_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drop the entries whose key matches `predicate`"""
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            stats = dict(self.counts)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def _array_bytes(value) -> int:
+    if isinstance(value, tuple):
+        return sum(_array_bytes(item) for item in value)
+    return getattr(value, "nbytes", 64) + 64
+
+
+class QueryCache:
+    """Two-level cache of the retrieval path
+
+    Level 1 maps normalized query text (and the question encoder, when
+    several serve different tables) to its embedding, skipping the
+    question encoder. Level 2 maps (embedding, table, k, search settings,
+    filters, hybrid) to the top-k ids and scores, skipping the index scan.
+
+    Results of a table are dropped when it changes: writers send a
+    `NOTIFY` on `SEARCH_CACHE_CHANNEL` with the table name in the
+    transaction of their rows (see `notify_table_changed`), listeners
+    call `invalidate`. A result computed while its table changed is not
+    stored. The TTL bounds staleness if a notification is missed.
+
+    Args:
+        max_entries: entries per level
+        max_bytes: approximate bytes per level
+        ttl: seconds an entry stays valid
+        lowercase: fold case in level 1 keys (uncased encoders)
+    """
+    def __init__(
+            self,
+            max_entries: int = 10000,
+            max_bytes: int = 256 * 1024 * 1024,
+            ttl: float = 300,
+            lowercase: bool = False
+            ) -> None:
+        self.embeddings = LRUCache(max_entries, max_bytes, ttl=ttl, sizeof=_array_bytes)
+        self.results = LRUCache(max_entries, max_bytes, ttl=ttl, sizeof=_array_bytes)
+        self.lowercase = lowercase
+        self.generations: Dict[str, int] = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def query_key(self, query: str) -> str:
+        key = normalize_text(query)
+        return key.lower() if self.lowercase else key
+
+    def get_embedding(self, query: str, model: str = "") -> Optional[np.ndarray]:
+        return self.embeddings.get((model, self.query_key(query)))
+
+    def put_embedding(self, query: str, embedding: np.ndarray, model: str = "") -> None:
+        self.embeddings.put((model, self.query_key(query)), np.array(embedding, dtype=np.float32))
+
+    def result_key(
+            self,
+            embedding: np.ndarray,
+            tb_name: str,
+            k: int,
+            probes: Optional[int] = None,
+            ef_search: Optional[int] = None,
+            filters: Optional[Dict[str, Sequence[str]]] = None,
+            hybrid: bool = False
+            ) -> Tuple:
+        digest = hashlib.blake2b(np.ascontiguousarray(embedding, dtype=np.float32).tobytes(), digest_size=16)
+        filter_key = json.dumps(filters, sort_keys=True) if filters else ""
+        return (tb_name, digest.digest(), k, probes, ef_search, filter_key, hybrid)
+
+    def generation(self, tb_name: str) -> int:
+        """Changes counter of a table, captured before searching it"""
+        with self.lock:
+            return self.epoch + self.generations.get(tb_name, 0)
+
+    def get_result(self, key: Tuple) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        return self.results.get(key)
+
+    def put_result(self, key: Tuple, ids: np.ndarray, scores: np.ndarray, generation: int) -> None:
+        """Store a result unless its table changed since `generation`"""
+        with self.lock:
+            if self.epoch + self.generations.get(key[0], 0) != generation:
+                return
+            self.results.put(key, (np.array(ids), np.array(scores)))
+
+    def lookup_results(
+            self,
+            embeddings: np.ndarray,
+            tb_name: str,
+            k: int,
+            probes: Optional[int] = None,
+            ef_search: Optional[int] = None,
+            filters: Optional[Dict[str, Sequence[str]]] = None,
+            hybrid: bool = False
+            ) -> Tuple[List[Tuple], List[Optional[Tuple[np.ndarray, np.ndarray]]], int]:
+        """Cached top-k of a batch of query embeddings
+
+        Returns:
+            result keys, cached (ids, scores) or None of every embedding,
+            and the table generation to pass to `store_results`
+        """
+        generation = self.generation(tb_name)
+        keys = [
+                self.result_key(embedding, tb_name, k, probes, ef_search, filters, hybrid)
+                for embedding in embeddings
+                ]
+        return keys, [self.get_result(key) for key in keys], generation
+
+    def store_results(
+            self,
+            keys: List[Tuple],
+            cached: List[Optional[Tuple[np.ndarray, np.ndarray]]],
+            ids: Optional[np.ndarray],
+            scores: Optional[np.ndarray],
+            generation: int
+            ) -> Tuple[np.ndarray, np.ndarray]:
+        """Cache the results of the missed embeddings and merge them in order
+
+        Args:
+            keys, cached, generation: as returned by `lookup_results`
+            ids, scores: results of the embeddings whose `cached` is None,
+                        in their order, None if there was none
+        """
+        k = keys[0][2]
+        all_ids = np.full((len(keys), k), -1, dtype=np.int64)
+        all_scores = np.full((len(keys), k), -np.inf, dtype=np.float32)
+        missed = 0
+        for i, (key, hit) in enumerate(zip(keys, cached)):
+            if hit is None:
+                hit = (ids[missed], scores[missed])
+                self.put_result(key, *hit, generation=generation)
+                missed += 1
+            all_ids[i], all_scores[i] = hit
+        return all_ids, all_scores
+
+    def embed(self, queries: List[str], encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Embeddings of `queries`, encoding the uncached ones in one call"""
+        embeddings = [self.get_embedding(query) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for i, embedding in zip(missing, encode([queries[i] for i in missing])):
+                self.put_embedding(queries[i], embedding)
+                embeddings[i] = embedding
+        return np.stack(embeddings)
+
+    def invalidate(self, tb_name: Optional[str] = None) -> None:
+        """Drop the cached results of a table, of every table if None"""
+        with self.lock:
+            if tb_name is None:
+                # also covers tables without a generation yet
+                self.epoch += 1
+                self.results.clear()
+                return
+            self.generations[tb_name] = self.generations.get(tb_name, 0) + 1
+        dropped = self.results.discard_if(lambda key: key[0] == tb_name)
+        logger.debug(f"{tb_name} changed, dropped {dropped} cached results")
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
+
+
+def notify_table_changed(cursor, tb_name: str) -> None:
+    """Tell query caches that `tb_name` changes when this transaction commits"""
+    cursor.execute("SELECT pg_notify(%s, %s)", (SEARCH_CACHE_CHANNEL, tb_name))
+
+
+def listen(connection) -> None:
+    """Subscribe a psycopg2 connection to table change notifications"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {SEARCH_CACHE_CHANNEL}")
+    connection.commit()
+
+
+def drain_notifications(connection, cache: QueryCache) -> None:
+    """Apply the notifications received on a listening psycopg2 connection"""
+    connection.poll()
+    while connection.notifies:
+        notify = connection.notifies.pop(0)
+        if notify.channel == SEARCH_CACHE_CHANNEL:
+            cache.invalidate(notify.payload)
@@ -0,0 +1,495 @@
+import os
+from typing import (
+        Dict,
+        List,
+        Optional,
+        Sequence,
+        Tuple,
+        Union
+        )
+
+import numpy as np
+import torch
+
+from model.retriever_model import (
+        get_question_embd,
+        load_dpr_question_encoder
+        )
+from database.query_cache import (
+        QueryCache,
+        drain_notifications,
+        listen
+        )
+from database.vector_codec import (
+        register_vector_adapter,
+        to_host_array
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+TB_WIKI=os.getenv("TB_WIKI", "wiki_tb")
+QUESTION_MODEL_NAME=os.getenv(
+        "QUESTION_MODEL_NAME",
+        "vblagoje/dpr-question_encoder-single-lfqa-wiki"
+        )
+RERANK_FACTOR=int(os.getenv("RERANK_FACTOR", 4))
+TS_CONFIG=os.getenv("TS_CONFIG", "english")
+RRF_K=int(os.getenv("RRF_K", 60))
+# columns `filters` may refer to, they are interpolated into the SQL
+FILTER_COLUMNS = ("title", "name", "domain")
+EMBEDD_DIM = 128
+# compact index of each quantization: indexed expression (of an embedding
+# `{column}` of `{dim}` dimensions), operator class and bytes per dimension
+QUANTIZATIONS = {
+        "none": ("{column}", "vector_ip_ops", 4),
+        "halfvec": ("({column}::halfvec({dim}))", "halfvec_ip_ops", 2),
+        "binary": ("(binary_quantize({column})::bit({dim}))", "bit_hamming_ops", 1 / 8),
+        }
+# candidate ordering of each quantization, matching its indexed expression
+_COMPACT_DISTANCE = {
+        "halfvec": "t.{column}::halfvec({dim}) <#> q.embedd::halfvec({dim})",
+        "binary": "binary_quantize(t.{column})::bit({dim}) <~> binary_quantize(q.embedd)::bit({dim})",
+        }
+
+
+def index_spec(
+        quantization: str,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> Tuple[str, str, int]:
+    """Indexed expression, operator class and bytes per indexed vector"""
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {tuple(QUANTIZATIONS)}")
+    expression, opclass, dim_bytes = QUANTIZATIONS[quantization]
+    return expression.format(column=column, dim=dim), opclass, int(dim * dim_bytes)
+
+
+def _compact_distance(quantization: str, column: str, dim: int) -> str:
+    if quantization not in _COMPACT_DISTANCE:
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {tuple(QUANTIZATIONS)}")
+    return _COMPACT_DISTANCE[quantization].format(column=column, dim=dim)
+
+
+class SearchResult:
+    """Top-k results of a batch of queries
+
+    Attributes:
+        ids: int64 array of shape (num_queries, k), -1 where a query has
+            fewer than k results
+        scores: float32 array of shape (num_queries, k), inner product of
+            query and passage, -inf where there is no result
+    """
+    __slots__ = ("ids", "scores")
+
+    def __init__(self, ids: np.ndarray, scores: np.ndarray) -> None:
+        self.ids = ids
+        self.scores = scores
+
+    def __len__(self) -> int:
+        return self.ids.shape[0]
+
+
+def _filter_clause(
+        filters: Optional[Dict[str, Sequence[str]]]
+        ) -> Tuple[str, Dict[str, List[str]]]:
+    """Turn `{column: allowed values}` into a WHERE clause and its params"""
+    if not filters:
+        return "", {}
+    clauses, params = [], {}
+    for i, (column, values) in enumerate(sorted(filters.items())):
+        if column not in FILTER_COLUMNS:
+            raise ValueError(f"Can not filter on {column}, expected one of {FILTER_COLUMNS}")
+        if isinstance(values, str):
+            values = [values]
+        clauses.append(f"t.{column} = ANY(%(filter_{i})s)")
+        params[f"filter_{i}"] = list(values)
+    return "WHERE " + " AND ".join(clauses), params
+
+
+def build_search_sql(
+        tb_name: str,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        column: str = "embedd",
+        quantization: str = "none",
+        dim: int = EMBEDD_DIM
+        ) -> Tuple[str, Dict[str, List[str]]]:
+    """SQL answering a whole batch of queries in one round-trip
+
+    Every query vector of `%(queries)s` runs its own ORDER BY ... LIMIT
+    index scan through a LATERAL join. With a `quantization` other than
+    `none` the scan runs in two stages: `%(candidates)s` rows are read
+    in the order of the compact index (see `QUANTIZATIONS`), then
+    reranked by their exact inner product with the float vectors.
+    `column` is the embedding column searched, of `dim` dimensions.
+
+    Returns:
+        SQL expecting `queries` (vector[]), `k` and, with a quantization,
+        `candidates` params, and the filter params to merge into them
+    """
+    where, params = _filter_clause(filters)
+    if quantization == "none":
+        sql = f'''
+                SELECT q.ord, r.id, r.score
+                FROM unnest(%(queries)s::vector[]) WITH ORDINALITY AS q(embedd, ord)
+                CROSS JOIN LATERAL (
+                    SELECT t.id, -(t.{column} <#> q.embedd) AS score
+                    FROM {tb_name} t
+                    {where}
+                    ORDER BY t.{column} <#> q.embedd
+                    LIMIT %(k)s
+                ) r
+                ORDER BY q.ord, r.score DESC
+                '''
+        return sql, params
+    distance = _compact_distance(quantization, column, dim)
+    sql = f'''
+            SELECT q.ord, r.id, r.score
+            FROM unnest(%(queries)s::vector[]) WITH ORDINALITY AS q(embedd, ord)
+            CROSS JOIN LATERAL (
+                SELECT c.id, -(c.embedd <#> q.embedd) AS score
+                FROM (
+                    SELECT t.id, t.{column} AS embedd
+                    FROM {tb_name} t
+                    {where}
+                    ORDER BY {distance}
+                    LIMIT %(candidates)s
+                ) c
+                ORDER BY c.embedd <#> q.embedd
+                LIMIT %(k)s
+            ) r
+            ORDER BY q.ord, r.score DESC
+            '''
+    return sql, params
+
+
+def build_hybrid_sql(
+        tb_name: str,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        quantization: str = "none",
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> Tuple[str, Dict[str, List[str]]]:
+    """SQL fusing lexical and vector search of a batch in one round-trip
+
+    For every (vector, text) pair of `%(queries)s` and `%(texts)s`, the
+    ANN scan and a full-text match on the `content_tsv` GIN index each
+    return `%(candidates)s` rows; they are merged with reciprocal-rank
+    fusion, `sum(1 / (%(rrf_k)s + rank))`. The text matches any of its
+    words (`plainto_tsquery` with `&` turned into `|`) and is ranked with
+    `ts_rank_cd`. The vector branch scans the `quantization` index
+    without reranking, only ranks are fused.
+
+    Returns:
+        SQL expecting `queries` (vector[]), `texts` (text[]), `k`,
+        `candidates`, `rrf_k` and `ts_config` params, and the filter
+        params to merge into them; scores are fusion scores
+    """
+    where, params = _filter_clause(filters)
+    text_where = f"{where} AND" if where else "WHERE"
+    if quantization == "none":
+        distance = f"t.{column} <#> q.embedd"
+    else:
+        distance = _compact_distance(quantization, column, dim)
+    sql = f'''
+            SELECT q.ord, r.id, r.score
+            FROM unnest(%(queries)s::vector[], %(texts)s::text[]) WITH ORDINALITY AS q(embedd, text, ord)
+            CROSS JOIN LATERAL (
+                SELECT replace(plainto_tsquery(%(ts_config)s::regconfig, q.text)::text, '&', '|')::tsquery AS query
+            ) x
+            CROSS JOIN LATERAL (
+                SELECT c.id, sum(1.0 / (%(rrf_k)s + c.rank))::float4 AS score
+                FROM (
+                    (SELECT a.id, row_number() OVER (ORDER BY a.distance) AS rank
+                     FROM (
+                        SELECT t.id, {distance} AS distance
+                        FROM {tb_name} t
+                        {where}
+                        ORDER BY {distance}
+                        LIMIT %(candidates)s
+                     ) a)
+                    UNION ALL
+                    (SELECT l.id, row_number() OVER (ORDER BY l.relevance DESC) AS rank
+                     FROM (
+                        SELECT t.id, ts_rank_cd(t.content_tsv, x.query) AS relevance
+                        FROM {tb_name} t
+                        {text_where} t.content_tsv @@ x.query
+                        ORDER BY relevance DESC
+                        LIMIT %(candidates)s
+                     ) l)
+                ) c
+                GROUP BY c.id
+                ORDER BY score DESC
+                LIMIT %(k)s
+            ) r
+            ORDER BY q.ord, r.score DESC
+            '''
+    return sql, params
+
+
+def collect_results(
+        rows: Sequence[Tuple[int, int, float]],
+        num_queries: int,
+        k: int
+        ) -> SearchResult:
+    """Pack (query ordinal, id, score) rows into padded arrays
+
+    Rows must be sorted by ordinal (1-based), then by descending score.
+    """
+    ids = np.full((num_queries, k), -1, dtype=np.int64)
+    scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    if rows:
+        data = np.asarray(rows, dtype=np.float64)
+        query = data[:, 0].astype(np.int64) - 1
+        rank = np.arange(len(query)) - np.searchsorted(query, query, side="left")
+        ids[query, rank] = data[:, 1].astype(np.int64)
+        scores[query, rank] = data[:, 2]
+    return SearchResult(ids=ids, scores=scores)
+
+
+def hybrid_or_vector_sql(
+        tb_name: str,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        quantization: str = "none",
+        texts: Optional[Sequence[str]] = None,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> Tuple[str, Dict[str, object]]:
+    """`build_hybrid_sql` and its text params if `texts` are given,
+    `build_search_sql` otherwise"""
+    if texts is None:
+        return build_search_sql(tb_name=tb_name, filters=filters, column=column, quantization=quantization, dim=dim)
+    sql, params = build_hybrid_sql(
+            tb_name=tb_name, filters=filters, quantization=quantization, column=column, dim=dim)
+    params.update(texts=list(texts), rrf_k=RRF_K, ts_config=TS_CONFIG)
+    return sql, params
+
+
+def search_settings(
+        probes: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        exact: bool = False
+        ) -> List[Tuple[str, str]]:
+    """(name, value) of the settings a search runs with"""
+    settings = []
+    if probes is not None:
+        settings.append(("ivfflat.probes", str(probes)))
+    if ef_search is not None:
+        settings.append(("hnsw.ef_search", str(ef_search)))
+    if exact:
+        settings += [("enable_indexscan", "off"), ("enable_bitmapscan", "off")]
+    return settings
+
+
+def set_search_options(
+        cursor,
+        probes: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        exact: bool = False
+        ) -> None:
+    """Apply index scan settings to the current transaction only"""
+    for name, value in search_settings(probes=probes, ef_search=ef_search, exact=exact):
+        cursor.execute("SELECT set_config(%s, %s, true)", (name, value))
+
+
+def search_embeddings(
+        connection,
+        embeddings,
+        tb_name: str = TB_WIKI,
+        k: int = 10,
+        probes: Optional[int] = None,
+        filters: Optional[Dict[str, Sequence[str]]] = None,
+        ef_search: Optional[int] = None,
+        exact: bool = False,
+        quantization: str = "none",
+        rerank: int = RERANK_FACTOR,
+        texts: Optional[Sequence[str]] = None,
+        column: str = "embedd"
+        ) -> SearchResult:
+    """Top-k inner-product search for precomputed query embeddings
+
+    Args:
+        connection: psycopg2 connection
+        embeddings: tensor or array of shape (num_queries, dim)
+        tb_name: table to search (`wiki_tb` or `client_tb`)
+        k: number of results per query
+        probes: `ivfflat.probes` for this call only, index default if None
+        filters: `{column: allowed values}`, e.g. `{"domain": ["Drugs"]}`
+        ef_search: `hnsw.ef_search` for this call only
+        exact: disable index scans, the result is the exact top-k
+        quantization: scan the `halfvec` or `binary` index for candidates
+                    and rerank them on the float vectors
+        rerank: candidates per result with a quantization, and of each
+                search in hybrid mode
+        texts: query texts, one per embedding, for a hybrid lexical +
+                vector search (`build_hybrid_sql`)
+        column: embedding column to search, see `embedding_versions`
+    """
+    queries = to_host_array(embeddings)
+    register_vector_adapter()
+    sql, params = hybrid_or_vector_sql(tb_name, filters, quantization, texts, column=column, dim=queries.shape[1])
+    params.update(queries=queries, k=k, candidates=k * rerank)
+    with connection.cursor() as cursor:
+        set_search_options(cursor, probes=probes, ef_search=ef_search, exact=exact)
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    connection.commit()
+    return collect_results(rows, num_queries=len(queries), k=k)
+
+
+class QuestionEncoder:
+    """DPR question encoder embedding batches of queries
+
+    Args:
+        model_name_or_path: DPR question encoder checkpoint
+        device: device the question encoder runs on
+    """
+    def __init__(
+            self,
+            model_name_or_path: str = QUESTION_MODEL_NAME,
+            device: Optional[torch.device] = None
+            ) -> None:
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.question_encoder, self.question_tokenizer = load_dpr_question_encoder(model_name_or_path)
+        self.question_encoder.to(self.device)
+        self.question_encoder.eval()
+
+    def encode(self, queries: Union[str, List[str]]) -> np.ndarray:
+        """Embed a batch of queries in one forward pass"""
+        if isinstance(queries, str):
+            queries = [queries]
+        return to_host_array(get_question_embd(
+                model_encoder=self.question_encoder,
+                tokenizer=self.question_tokenizer,
+                text=queries,
+                device=self.device
+                ))
+
+
+class Searcher:
+    """Encode queries with a DPR question encoder and search a table
+
+    Args:
+        connection: psycopg2 connection reused by every call
+        tb_name: table to search
+        model_name_or_path: DPR question encoder checkpoint
+        device: device the question encoder runs on
+        cache: reuse the embeddings and results of repeated queries, the
+            connection listens for changes of the searched tables
+        quantization: compact index scanned for candidates, see
+            `search_embeddings`
+        rerank: candidates per result with a quantization
+        column: vector column searched, the one of the table's active
+            embedding version (`model_name_or_path` must be its question
+            encoder), see `embedding_versions.active_version`
+        store: search this `stores.VectorStore` (e.g. a `NumpyStore`)
+            instead of the table, without filters, hybrid matching or
+            `cache`; `connection` is then unused and may be None
+    """
+    def __init__(
+            self,
+            connection,
+            tb_name: str = TB_WIKI,
+            model_name_or_path: str = QUESTION_MODEL_NAME,
+            device: Optional[torch.device] = None,
+            cache: Optional[QueryCache] = None,
+            quantization: str = "none",
+            rerank: int = RERANK_FACTOR,
+            column: str = "embedd",
+            store=None
+            ) -> None:
+        if cache is not None and store is not None:
+            raise ValueError("Writes to a store are not notified, its searches can not be cached")
+        self.connection = connection
+        self.tb_name = tb_name
+        self.quantization = quantization
+        self.rerank = rerank
+        self.column = column
+        self.store = store
+        self.encoder = QuestionEncoder(model_name_or_path=model_name_or_path, device=device)
+        self.cache = cache
+        if cache is not None:
+            listen(connection)
+
+    def encode(self, queries: Union[str, List[str]]) -> np.ndarray:
+        """Embed a batch of queries in one forward pass"""
+        if self.cache is None:
+            return self.encoder.encode(queries)
+        if isinstance(queries, str):
+            queries = [queries]
+        return self.cache.embed(queries, self.encoder.encode)
+
+    def search(
+            self,
+            queries: Union[str, List[str]],
+            k: int = 10,
+            probes: Optional[int] = None,
+            filters: Optional[Dict[str, Sequence[str]]] = None,
+            ef_search: Optional[int] = None,
+            hybrid: bool = False
+            ) -> SearchResult:
+        """Top-k passages of every query
+
+        Args:
+            queries: a question or a batch of questions
+            k: number of results per query
+            probes: `ivfflat.probes` for this call only
+            filters: `{column: allowed values}`, e.g. `{"domain": ["Drugs"]}`
+            ef_search: `hnsw.ef_search` for this call only
+            hybrid: fuse full-text matches of the questions with the
+                vector search, scores are then fusion scores
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        if self.store is not None and (filters or ef_search or hybrid):
+            raise ValueError("Searches of a store have no filters, ef_search or hybrid matching")
+        embeddings = self.encode(queries)
+        texts = queries if hybrid else None
+        if self.cache is None:
+            return self._search_embeddings(embeddings, k, probes, filters, ef_search, texts)
+
+        drain_notifications(self.connection, self.cache)
+        keys, cached, generation = self.cache.lookup_results(
+                embeddings, self.tb_name, k, probes=probes, ef_search=ef_search, filters=filters, hybrid=hybrid)
+        missing = [i for i, hit in enumerate(cached) if hit is None]
+        result = None
+        if missing:
+            result = self._search_embeddings(
+                    embeddings[missing], k, probes, filters, ef_search,
+                    [texts[i] for i in missing] if hybrid else None)
+        ids, scores = self.cache.store_results(
+                keys,
+                cached,
+                ids=None if result is None else result.ids,
+                scores=None if result is None else result.scores,
+                generation=generation
+                )
+        return SearchResult(ids=ids, scores=scores)
+
+    def _search_embeddings(
+            self,
+            embeddings: np.ndarray,
+            k: int,
+            probes: Optional[int],
+            filters: Optional[Dict[str, Sequence[str]]],
+            ef_search: Optional[int],
+            texts: Optional[Sequence[str]]
+            ) -> SearchResult:
+        if self.store is not None:
+            return self.store.search(embeddings, tb_name=self.tb_name, k=k, probes=probes, rerank=self.rerank)
+        return search_embeddings(
+                connection=self.connection,
+                embeddings=embeddings,
+                tb_name=self.tb_name,
+                k=k,
+                probes=probes,
+                filters=filters,
+                ef_search=ef_search,
+                quantization=self.quantization,
+                rerank=self.rerank,
+                texts=texts,
+                column=self.column
+                )
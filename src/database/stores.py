@@ -0,0 +1,179 @@
+from typing import (
+        Any,
+        Dict,
+        Optional,
+        Sequence
+        )
+
+from database import make_database
+from database.search import (
+        RERANK_FACTOR,
+        SearchResult,
+        search_embeddings
+        )
+from database.writers import (
+        make_writer
+        )
+
+import logging
+logger = logging.getLogger(__name__)
+
+STORE_BACKENDS = ("postgres", "numpy")
+
+
+class VectorStore:
+    """Where the embeddings of a table are written and searched
+
+    Writers returned by `open_writer` have the writer interface of
+    `database.writers` (`write(rows, embeddings)`, `flush`, `close`,
+    `connection`, `timings`), so the ingestion pipeline writes to any
+    store the same way. Row ids start at 1, in insertion order.
+
+    Implementations: `PostgresStore` (pgvector) and
+    `numpy_store.NumpyStore` (memory-mapped files, no server).
+
+    Attributes:
+        checkpoints: writers commit the `CheckpointHook` they are given
+                with their rows, so an interrupted load resumes from its
+                checkpoint; otherwise it reads its source from the start
+                and the store skips the rows it already holds
+    """
+    checkpoints = False
+
+    def open_writer(self, tb_name: str, columns: Sequence[str], hook=None):
+        """Writer appending rows of `columns` and their embeddings"""
+        raise NotImplementedError
+
+    def create_index(self, tb_name: str, **options) -> None:
+        """Build the ANN index of a table"""
+        raise NotImplementedError
+
+    def search(
+            self,
+            embeddings,
+            tb_name: str,
+            k: int = 10,
+            probes: Optional[int] = None,
+            rerank: int = RERANK_FACTOR
+            ) -> SearchResult:
+        """Top-k inner-product search of a batch of query embeddings"""
+        raise NotImplementedError
+
+    def fetch(
+            self,
+            tb_name: str,
+            ids: Sequence[int],
+            columns: Sequence[str] = ("title", "content")
+            ) -> Dict[int, Dict[str, Any]]:
+        """Text columns of rows by id, missing ids are left out"""
+        raise NotImplementedError
+
+    def count(self, tb_name: str) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release what the store holds open"""
+
+
+class PostgresStore(VectorStore):
+    """pgvector tables of `make_database`, over the process-wide pool
+
+    Args:
+        quantization: compact index searched, see `search.search_embeddings`
+        bulk_load: writers stream with binary COPY instead of INSERT
+        embedding_column: vector column written and searched
+        idempotent: COPY writers skip rows whose `source_id` exists, see
+                    `writers.make_writer`
+    """
+    checkpoints = True
+
+    def __init__(
+            self,
+            quantization: str = "none",
+            bulk_load: bool = False,
+            embedding_column: str = "embedd",
+            idempotent: bool = True
+            ) -> None:
+        self.quantization = quantization
+        self.bulk_load = bulk_load
+        self.embedding_column = embedding_column
+        self.idempotent = idempotent
+
+    def open_writer(self, tb_name: str, columns: Sequence[str], hook=None):
+        return make_writer(
+                connection=make_database.connect(),
+                tb_name=tb_name,
+                columns=columns,
+                bulk_load=self.bulk_load,
+                idempotent=self.idempotent,
+                hook=hook,
+                embedding_column=self.embedding_column
+                )
+
+    def create_index(self, tb_name: str, **options) -> None:
+        """`make_database.create_index`, `options` are its arguments"""
+        options.setdefault("quantization", self.quantization)
+        options.setdefault("column", self.embedding_column)
+        make_database.create_index(tb_name=tb_name, **options)
+
+    def search(
+            self,
+            embeddings,
+            tb_name: str,
+            k: int = 10,
+            probes: Optional[int] = None,
+            rerank: int = RERANK_FACTOR
+            ) -> SearchResult:
+        connection = make_database.connect()
+        try:
+            return search_embeddings(
+                    connection,
+                    embeddings,
+                    tb_name=tb_name,
+                    k=k,
+                    probes=probes,
+                    quantization=self.quantization,
+                    rerank=rerank,
+                    column=self.embedding_column
+                    )
+        finally:
+            connection.close()
+
+    def fetch(
+            self,
+            tb_name: str,
+            ids: Sequence[int],
+            columns: Sequence[str] = ("title", "content")
+            ) -> Dict[int, Dict[str, Any]]:
+        connection = make_database.connect()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT id, {', '.join(columns)} FROM {tb_name} WHERE id = ANY(%s)",
+                               ([int(i) for i in ids],))
+                rows = cursor.fetchall()
+            connection.commit()
+        finally:
+            connection.close()
+        return {row[0]: dict(zip(columns, row[1:])) for row in rows}
+
+    def count(self, tb_name: str) -> int:
+        return make_database.count_row(tb_name=tb_name)
+
+
+def open_store(backend: str = "postgres", store_dir: str = "", **options) -> VectorStore:
+    """Store of a `STORE_BACKENDS` backend
+
+    Args:
+        backend: `postgres` or `numpy`
+        store_dir: directory of the `numpy` store, `NUMPY_STORE_DIR` by default
+        options: arguments of the `PostgresStore`
+    """
+    if backend == "postgres":
+        return PostgresStore(**options)
+    if backend == "numpy":
+        from database.numpy_store import (
+                NUMPY_STORE_DIR,
+                NumpyStore
+                )
+        return NumpyStore(store_dir or NUMPY_STORE_DIR)
+    raise ValueError(f"Unknown store {backend}, expected one of {STORE_BACKENDS}")
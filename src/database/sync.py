@@ -0,0 +1,354 @@
+import hashlib
+import io
+import os
+from typing import (
+        Any,
+        Dict,
+        Iterator,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import torch
+from transformers import (
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+from data.make_data import (
+        CLIENT_COLUMNS,
+        read_csv_batches
+        )
+from database import make_database
+from database.pipeline import (
+        run_pipeline
+        )
+from database.query_cache import (
+        notify_table_changed
+        )
+from database.writers import (
+        make_writer
+        )
+from model.embedding_cache import (
+        EmbeddingCache
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+SYNC_REINDEX_FRACTION=float(os.getenv("SYNC_REINDEX_FRACTION", 0.2))
+SYNC_FETCH_ROWS=int(os.getenv("SYNC_FETCH_ROWS", 50000))
+
+# separates the values hashed together, Postgres computes the same
+# `content_hash` with md5(concat_ws(chr(31), ...))
+_SEPARATOR = "\x1f"
+# columns of a client row written by a sync, in table order
+SYNC_COLUMNS = make_database.CLIENT_TEXT_COLUMNS + ("source_id", "content_hash")
+
+
+def key_hash(values: Sequence[str]) -> str:
+    """Hash of the natural key columns of a row"""
+    return hashlib.md5(_SEPARATOR.join(values).encode("utf-8")).hexdigest()[:16]
+
+
+def content_hash(values: Sequence[str]) -> str:
+    """Hash of the text columns of a row, equal to `content_hash_sql`"""
+    return hashlib.md5(_SEPARATOR.join(values).encode("utf-8")).hexdigest()
+
+
+def content_hash_sql(columns: Sequence[str]) -> str:
+    return f"md5(concat_ws(chr(31), {', '.join(columns)}))"
+
+
+def ensure_content_hash(connection, tb_name: str) -> None:
+    """Add the `content_hash` column, filled for rows loaded without it"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {tb_name} ADD COLUMN IF NOT EXISTS content_hash TEXT")
+        cursor.execute(f'''
+                UPDATE {tb_name} SET content_hash = {content_hash_sql(make_database.CLIENT_TEXT_COLUMNS)}
+                WHERE content_hash IS NULL
+                ''')
+        if cursor.rowcount:
+            logger.info(f"Computed the content hash of {cursor.rowcount} rows of {tb_name}")
+    connection.commit()
+
+
+def _load_keys(
+        connection,
+        tb_name: str,
+        path: str,
+        key_columns: Sequence[str]
+        ) -> int:
+    """Stream the (key, content hash) of every csv row into `_sync_keys`
+
+    A natural key shared by several rows is told apart by its occurrence
+    (`<hash>#1`, `<hash>#2`, ...) in file order.
+
+    Returns:
+        number of rows in the file
+    """
+    usecols = list(dict.fromkeys(CLIENT_COLUMNS + tuple(key_columns)))
+    num_rows = 0
+    with connection.cursor() as cursor:
+        cursor.execute('''
+                CREATE TEMP TABLE _sync_raw (
+                row_number BIGINT, key_hash TEXT, content_hash TEXT);
+                ''')
+        for first_row, chunk in read_csv_batches(path, usecols=usecols):
+            keys = zip(*(chunk[column].tolist() for column in key_columns))
+            texts = zip(*(chunk[column].tolist() for column in CLIENT_COLUMNS))
+            lines = io.StringIO()
+            for row_number, key, text in zip(range(first_row, first_row + len(chunk)), keys, texts):
+                lines.write(f"{row_number}\t{key_hash(key)}\t{content_hash(text)}\n")
+            lines.seek(0)
+            cursor.copy_expert("COPY _sync_raw FROM STDIN", lines)
+            num_rows = first_row + len(chunk)
+        cursor.execute(f'''
+                CREATE TEMP TABLE _sync_keys AS
+                SELECT row_number, content_hash,
+                key_hash || CASE WHEN occurrence > 0 THEN '#' || occurrence ELSE '' END AS source_id
+                FROM (SELECT *, row_number() OVER (PARTITION BY key_hash ORDER BY row_number) - 1 AS occurrence
+                      FROM _sync_raw) raw;
+                DROP TABLE _sync_raw;
+                CREATE UNIQUE INDEX ON _sync_keys (source_id);
+                ANALYZE _sync_keys;
+
+                CREATE TEMP TABLE _sync_delta AS
+                SELECT k.row_number, k.source_id, k.content_hash, t.source_id IS NOT NULL AS changed
+                FROM _sync_keys k LEFT JOIN {tb_name} t ON t.source_id = k.source_id
+                WHERE t.source_id IS NULL OR t.content_hash IS DISTINCT FROM k.content_hash;
+                ''')
+    connection.commit()
+    return num_rows
+
+
+def _rekey(connection, tb_name: str) -> int:
+    """Give rows whose key disappeared the new key of the same content
+
+    Covers rows renamed in the csv and tables loaded by row number before
+    their first sync: their embedding is kept instead of encoded again.
+    Rows with the same content hash are paired in id / key order.
+
+    Returns:
+        number of rows re-keyed
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+                WITH old AS (
+                    SELECT t.id, t.content_hash,
+                    row_number() OVER (PARTITION BY t.content_hash ORDER BY t.id) AS rank
+                    FROM {tb_name} t
+                    WHERE NOT EXISTS (SELECT 1 FROM _sync_keys k WHERE k.source_id = t.source_id)
+                ), new AS (
+                    SELECT d.source_id, d.content_hash,
+                    row_number() OVER (PARTITION BY d.content_hash ORDER BY d.source_id) AS rank
+                    FROM _sync_delta d WHERE NOT d.changed
+                ), moved AS (
+                    UPDATE {tb_name} t SET source_id = new.source_id
+                    FROM old JOIN new USING (content_hash, rank)
+                    WHERE t.id = old.id
+                    RETURNING t.source_id
+                )
+                DELETE FROM _sync_delta d USING moved WHERE d.source_id = moved.source_id;
+                ''')
+        rekeyed = cursor.rowcount
+        if rekeyed:
+            notify_table_changed(cursor, tb_name)
+    connection.commit()
+    return rekeyed
+
+
+def _delta_rows(connection, path: str) -> Iterator[Tuple[str, ...]]:
+    """Rows of the csv to encode and upsert, joined with their key
+
+    The delta row numbers are read from a server-side cursor in file
+    order while the file is streamed again, so neither is held whole.
+    """
+    with connection.cursor(name="sync_delta") as delta:
+        delta.itersize = SYNC_FETCH_ROWS
+        delta.execute("SELECT row_number, source_id, content_hash FROM _sync_delta ORDER BY row_number")
+        pending = next(delta, None)
+        for first_row, chunk in read_csv_batches(path):
+            if pending is None:
+                break
+            last_row = first_row + len(chunk)
+            if pending[0] >= last_row:
+                continue
+            columns = [chunk[column].tolist() for column in CLIENT_COLUMNS]
+            while pending is not None and pending[0] < last_row:
+                row_number, source_id, hashed = pending
+                i = row_number - first_row
+                yield tuple(column[i] for column in columns) + (source_id, hashed)
+                pending = next(delta, None)
+    connection.commit()
+
+
+def _count(connection, sql: str) -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        result = cursor.fetchone()[0]
+    connection.commit()
+    return result
+
+
+def reindex_vector_indexes(tb_name: str) -> None:
+    """Rebuild the ANN indexes of a table (or of its partitions) in place
+
+    IVFFlat lists are re-sized to the current row count first. Uses
+    `REINDEX CONCURRENTLY`, searches keep using the old index meanwhile.
+    """
+    connection = make_database.connect()
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                    SELECT ic.relname, c.relname, am.amname FROM pg_index i
+                    JOIN pg_class ic ON ic.oid = i.indexrelid
+                    JOIN pg_am am ON am.oid = ic.relam
+                    JOIN pg_class c ON c.oid = i.indrelid
+                    WHERE am.amname IN ('ivfflat', 'hnsw') AND ic.relkind = 'i'
+                    AND (c.oid = to_regclass(%s)
+                         OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%s)))
+                    ''', (tb_name, tb_name))
+            indexes = cursor.fetchall()
+            make_database.set_build_options(cursor, *make_database.server_build_budget(connection))
+            for index, table, method in indexes:
+                if method == "ivfflat":
+                    lists = make_database.ivfflat_lists(make_database.count_row(tb_name=table))
+                    cursor.execute(f"ALTER INDEX {index} SET (lists = {lists})")
+                logger.info(f"Reindexing {index} on {table}")
+                cursor.execute(f"REINDEX INDEX CONCURRENTLY {index}")
+    finally:
+        connection.close()
+    if not indexes:
+        logger.warning(f"{tb_name} has no vector index to rebuild")
+
+
+def sync_client_knowledges(
+        path: str,
+        context_encoder: DPRContextEncoder,
+        context_tokenizer: DPRContextEncoderTokenizer,
+        device: torch.device,
+        tb_name: str = make_database.TB_CLIENT,
+        key_columns: Sequence[str] = ("Title", "Domain"),
+        num_tokenizers: int = 1,
+        num_writers: int = 1,
+        max_tokens: Optional[int] = None,
+        cache: Optional[EmbeddingCache] = None,
+        reindex: bool = True,
+        reindex_fraction: float = SYNC_REINDEX_FRACTION,
+        embedding_column: str = "embedd"
+        ) -> Dict[str, Any]:
+    """Bring a client table in line with a new version of its csv
+
+    Rows are keyed on a hash of their natural `key_columns` (stored as
+    `source_id`) and compared by the hash of their text (`content_hash`):
+
+    1. the (key, content hash) of every csv row is streamed into a
+       temporary table and diffed against the table in SQL;
+    2. rows whose key disappeared but whose content is still in the csv
+       are re-keyed, keeping their embedding;
+    3. new and changed rows are encoded and upserted with COPY;
+    4. rows whose key is not in the csv any more are deleted.
+
+    When the inserted, updated and deleted rows reach `reindex_fraction`
+    of the table, its ANN indexes are rebuilt (IVFFlat centroids drift,
+    HNSW keeps deleted neighbours around).
+
+    Args:
+        path: the new client knowledge csv
+        context_encoder: a model that encodes data to embedding
+        context_tokenizer: a tokenizer that creates input for `context_encoder`
+        device: device the encoder runs on
+        tb_name: client table to sync
+        key_columns: csv columns identifying a row across versions
+        num_tokenizers: number of tokenizer threads
+        num_writers: number of writer threads
+        max_tokens: encode length-bucketed batches, see `IngestionPipeline`
+        cache: embedding cache, changed rows it already holds are not
+                    encoded again
+        reindex: rebuild the indexes when enough changed
+        reindex_fraction: share of changed rows that triggers the rebuild
+        embedding_column: vector column of the active embedding version,
+                    `context_encoder` must be its model
+
+    Returns:
+        row counts of the sync and whether the indexes were rebuilt
+    """
+    make_database.ensure_source_id(tb_name=tb_name)
+    connection = make_database.connect()
+    try:
+        ensure_content_hash(connection, tb_name)
+        rows_before = _count(connection, f"SELECT count(*) FROM {tb_name}")
+        num_rows = _load_keys(connection, tb_name, path, key_columns)
+        rekeyed = _rekey(connection, tb_name)
+        inserted = _count(connection, "SELECT count(*) FROM _sync_delta WHERE NOT changed")
+        updated = _count(connection, "SELECT count(*) FROM _sync_delta WHERE changed")
+        logger.info(f"{path} holds {num_rows} rows: {inserted} new, {updated} changed, "
+                    f"{rekeyed} re-keyed in {tb_name}")
+
+        if inserted or updated:
+            def _open_writer(hook):
+                return make_writer(
+                        connection=make_database.connect(),
+                        tb_name=tb_name,
+                        columns=SYNC_COLUMNS,
+                        hook=hook,
+                        upsert=True,
+                        embedding_column=embedding_column
+                        )
+
+            run_pipeline(
+                    rows=_delta_rows(connection, path),
+                    content_index=2,
+                    context_encoder=context_encoder,
+                    context_tokenizer=context_tokenizer,
+                    device=device,
+                    open_writer=_open_writer,
+                    max_tokens=max_tokens,
+                    num_tokenizers=num_tokenizers,
+                    num_writers=num_writers,
+                    cache=cache
+                    )
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                    DELETE FROM {tb_name} t
+                    WHERE NOT EXISTS (SELECT 1 FROM _sync_keys k WHERE k.source_id = t.source_id)
+                    ''')
+            deleted = cursor.rowcount
+            if deleted:
+                notify_table_changed(cursor, tb_name)
+            cursor.execute("DROP TABLE _sync_keys; DROP TABLE _sync_delta;")
+        connection.commit()
+        logger.info(f"Deleted {deleted} rows of {tb_name} missing from {path}")
+
+        if updated or deleted:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"VACUUM (ANALYZE) {tb_name}")
+            connection.autocommit = False
+    finally:
+        connection.close()
+
+    changed = inserted + updated + deleted
+    fraction = changed / max(rows_before, 1)
+    rebuilt = reindex and rows_before > 0 and fraction >= reindex_fraction
+    if rebuilt:
+        logger.info(f"{fraction:.1%} of {tb_name} changed, rebuilding its vector indexes")
+        reindex_vector_indexes(tb_name)
+    elif changed:
+        logger.info(f"{fraction:.1%} of {tb_name} changed, its vector indexes are kept")
+    return {
+            "rows": num_rows,
+            "inserted": inserted,
+            "updated": updated,
+            "deleted": deleted,
+            "rekeyed": rekeyed,
+            "changed_fraction": round(fraction, 4),
+            "reindexed": rebuilt,
+            }
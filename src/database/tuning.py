@@ -0,0 +1,389 @@
+import time
+from typing import (
+        Dict,
+        List,
+        Optional,
+        Sequence,
+        Tuple
+        )
+
+import numpy as np
+
+from database import make_database
+from database.search import (
+        EMBEDD_DIM,
+        QUANTIZATIONS,
+        index_spec,
+        search_embeddings
+        )
+from database.vector_codec import (
+        register_vector_typecaster
+        )
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def parse_int_list(value: str) -> List[int]:
+    """Parse a comma separated list of integers ("1,5,10")"""
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def estimate_rows(connection, tb_name: str) -> int:
+    """Planner estimate of the number of rows, exact count if never analyzed"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", (tb_name,))
+        rows = cursor.fetchone()[0]
+        if rows is None or rows <= 0:
+            cursor.execute(f"SELECT count(*) FROM {tb_name}")
+            rows = cursor.fetchone()[0]
+    connection.commit()
+    return rows
+
+
+def sample_query_vectors(
+        connection,
+        tb_name: str,
+        num_queries: int,
+        seed: int = 0,
+        column: str = "embedd"
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample stored passage embeddings (of `column`) to use as queries
+
+    Uses `TABLESAMPLE BERNOULLI` so the sample does not scan and sort the
+    whole table. The passages stay in the table: their own id is excluded
+    when measuring recall.
+
+    Returns:
+        (ids, vectors) of the sampled passages
+    """
+    register_vector_typecaster(connection)
+    percent = min(100.0, 100.0 * 3 * num_queries / max(estimate_rows(connection, tb_name), 1))
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+                SELECT id, {column} FROM {tb_name}
+                TABLESAMPLE BERNOULLI (%s) REPEATABLE (%s)
+                WHERE {column} IS NOT NULL
+                LIMIT %s
+                ''', (percent, seed, num_queries))
+        rows = cursor.fetchall()
+    connection.commit()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    vectors = np.stack([row[1] for row in rows]).astype(np.float32)
+    return ids, vectors
+
+
+def _exclude(ids: np.ndarray, exclude: Optional[np.ndarray], k: int) -> np.ndarray:
+    """Drop each query's own id from its results and keep the top k"""
+    if exclude is None:
+        return ids[:, :k]
+    keep = ids != exclude[:, None]
+    order = np.argsort(~keep, axis=1, kind="stable")
+    return np.take_along_axis(ids, order, axis=1)[:, :k]
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Mean fraction of the exact top-k found, per query"""
+    recalls = []
+    for found_ids, truth_ids in zip(found, truth):
+        truth_ids = truth_ids[truth_ids >= 0]
+        if len(truth_ids):
+            recalls.append(len(np.intersect1d(found_ids, truth_ids)) / len(truth_ids))
+    return float(np.mean(recalls)) if recalls else 0.0
+
+
+def exact_top_k(
+        connection,
+        tb_name: str,
+        vectors: np.ndarray,
+        k: int,
+        exclude: Optional[np.ndarray] = None,
+        column: str = "embedd"
+        ) -> np.ndarray:
+    """Ground-truth top-k ids with index scans disabled"""
+    extra = 0 if exclude is None else 1
+    result = search_embeddings(connection, vectors, tb_name=tb_name, k=k + extra, exact=True, column=column)
+    return _exclude(result.ids, exclude, k)
+
+
+def measure(
+        connection,
+        tb_name: str,
+        vectors: np.ndarray,
+        truth: np.ndarray,
+        k: int,
+        exclude: Optional[np.ndarray] = None,
+        probes: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        quantization: str = "none",
+        rerank: int = 1,
+        column: str = "embedd"
+        ) -> Dict[str, float]:
+    """Recall@k and per-query latency of one index setting (on `column`)
+
+    Queries are sent one at a time so the latency is the one a single
+    caller sees.
+    """
+    extra = 0 if exclude is None else 1
+    latencies = []
+    found = []
+    for i in range(len(vectors)):
+        start = time.perf_counter()
+        result = search_embeddings(
+                connection,
+                vectors[i:i + 1],
+                tb_name=tb_name,
+                k=k + extra,
+                probes=probes,
+                ef_search=ef_search,
+                quantization=quantization,
+                rerank=rerank,
+                column=column
+                )
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(result.ids[0])
+    found = _exclude(np.stack(found), exclude, k)
+    return {
+            "recall": round(recall_at_k(found, truth), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            }
+
+
+def vector_indexes(connection, tb_name: str, column: str = "embedd") -> List[Tuple[str, str]]:
+    """(name, definition) of the ANN indexes of a table on `column`
+
+    Indexes of the other embedding versions' columns are left out.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('''
+                SELECT ic.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i
+                JOIN pg_class ic ON ic.oid = i.indexrelid
+                JOIN pg_am am ON am.oid = ic.relam
+                WHERE i.indrelid = to_regclass(%s) AND am.amname IN ('ivfflat', 'hnsw')
+                AND EXISTS (
+                    SELECT 1 FROM pg_depend d
+                    JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+                    WHERE d.classid = 'pg_class'::regclass AND d.objid = i.indexrelid
+                    AND d.refobjid = i.indrelid AND a.attname = %s
+                )
+                ORDER BY ic.relname
+                ''', (tb_name, column))
+        result = cursor.fetchall()
+    connection.commit()
+    return result
+
+
+def index_quantization(definition: str) -> str:
+    """Quantization an ANN index definition was built with"""
+    if "binary_quantize" in definition:
+        return "binary"
+    if "halfvec" in definition:
+        return "halfvec"
+    return "none"
+
+
+def index_sizes_mb(connection, tb_name: str, column: str = "embedd") -> Dict[str, float]:
+    """On-disk size of the table's ANN index on `column` of each quantization"""
+    sizes = {}
+    with connection.cursor() as cursor:
+        for name, definition in vector_indexes(connection, tb_name, column=column):
+            cursor.execute("SELECT pg_relation_size(%s::regclass)", (name,))
+            size = cursor.fetchone()[0] / (1024 * 1024)
+            quantization = index_quantization(definition)
+            sizes[quantization] = round(sizes.get(quantization, 0) + size, 1)
+    connection.commit()
+    return sizes
+
+
+def _rebuild_ivfflat(
+        connection,
+        tb_name: str,
+        lists: int,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> None:
+    """Replace the float IVFFlat index of `column`, other indexes are kept"""
+    connection.autocommit = True
+    spec, opclass, _ = index_spec("none", column=column, dim=dim)
+    with connection.cursor() as cursor:
+        for name, _ in make_database.vector_index_names(connection, tb_name, "ivfflat", column=column):
+            cursor.execute(f"DROP INDEX {name}")
+        logger.info(f"Building ivfflat index on {tb_name}.{column} with {lists} lists")
+        cursor.execute(f"CREATE INDEX {make_database.index_name(tb_name, 'ivfflat', column=column)} ON {tb_name} "
+                       f"USING ivfflat ({spec} {opclass}) WITH (lists = {lists})")
+    connection.autocommit = False
+
+
+def sweep(
+        connection,
+        tb_name: str,
+        num_queries: int = 100,
+        k: int = 10,
+        probes: Sequence[int] = (1, 2, 4, 8, 16, 32, 64),
+        ef_search: Sequence[int] = (10, 20, 40, 80, 160, 320),
+        lists: Sequence[int] = (),
+        query_vectors: Optional[np.ndarray] = None,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> List[Dict[str, float]]:
+    """Recall@k against latency for a range of index settings
+
+    The exact top-k is computed once with a sequential scan. The current
+    index of `column` is swept over `probes` (IVFFlat) or `ef_search`
+    (HNSW). Every value of `lists` rebuilds the float IVFFlat index of
+    `column` (the last one is kept) and sweeps `probes` again.
+
+    Args:
+        connection: psycopg2 connection
+        tb_name: table to tune
+        num_queries: number of stored passages sampled as queries, when
+                    `query_vectors` is not given
+        k: size of the result list recall is measured on
+        probes: `ivfflat.probes` values to try
+        ef_search: `hnsw.ef_search` values to try
+        lists: IVFFlat `lists` values to rebuild the index with
+        query_vectors: embeddings of real held-out questions, by the
+                    question encoder of `column`'s embedding version
+        column: vector column tuned, the one of the table's active
+                    embedding version (see `embedding_versions`)
+        dim: dimensions of `column`
+
+    Returns:
+        one row per setting with recall, p50 and p99 latency
+    """
+    exclude = None
+    if query_vectors is None:
+        exclude, query_vectors = sample_query_vectors(connection, tb_name, num_queries, column=column)
+    logger.info(f"Computing exact top-{k} of {len(query_vectors)} queries on {tb_name}.{column}")
+    truth = exact_top_k(connection, tb_name, query_vectors, k, exclude, column=column)
+
+    report = []
+
+    def _sweep_current(index_lists: Optional[int] = None) -> None:
+        definitions = " ".join(definition for _, definition in vector_indexes(connection, tb_name, column=column))
+        if "USING hnsw" in definitions:
+            for value in ef_search:
+                row = {"method": "hnsw", "ef_search": value}
+                row.update(measure(connection, tb_name, query_vectors, truth, k, exclude,
+                                   ef_search=value, column=column))
+                logger.info(row)
+                report.append(row)
+        if "USING ivfflat" in definitions:
+            for value in probes:
+                row = {"method": "ivfflat", "lists": index_lists, "probes": value}
+                row.update(measure(connection, tb_name, query_vectors, truth, k, exclude,
+                                   probes=value, column=column))
+                logger.info(row)
+                report.append(row)
+
+    if lists:
+        for value in lists:
+            _rebuild_ivfflat(connection, tb_name, value, column=column, dim=dim)
+            _sweep_current(index_lists=value)
+        logger.warning(f"{tb_name}.{column} keeps the ivfflat index with {lists[-1]} lists")
+    else:
+        _sweep_current()
+    return report
+
+
+def compare_quantizations(
+        connection,
+        tb_name: str,
+        quantizations: Sequence[str] = ("none", "halfvec", "binary"),
+        rerank: Sequence[int] = (1, 2, 4, 10),
+        num_queries: int = 100,
+        k: int = 10,
+        probes: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        method: str = "ivfflat",
+        query_vectors: Optional[np.ndarray] = None,
+        column: str = "embedd",
+        dim: int = EMBEDD_DIM
+        ) -> List[Dict[str, float]]:
+    """Index size, latency and recall@k of each quantization
+
+    A missing index is built with `method` and kept, the planner picks
+    the one matching the searched expression. Quantized indexes are
+    measured for every `rerank` factor: the number of candidates reranked
+    on the float vectors per result.
+
+    Args:
+        connection: psycopg2 connection
+        tb_name: table to measure
+        quantizations: `none`, `halfvec` and/or `binary`
+        rerank: rerank factors to try
+        num_queries: number of stored passages sampled as queries, when
+                    `query_vectors` is not given
+        k: size of the result list recall is measured on
+        probes: `ivfflat.probes` of every search
+        ef_search: `hnsw.ef_search` of every search
+        method: `ivfflat` or `hnsw`, for the indexes built here
+        query_vectors: embeddings of real held-out questions, by the
+                    question encoder of `column`'s embedding version
+        column: vector column measured, the one of the table's active
+                    embedding version (see `embedding_versions`)
+        dim: dimensions of `column`
+
+    Returns:
+        one row per quantization and rerank factor
+    """
+    for quantization in quantizations:
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, expected one of {tuple(QUANTIZATIONS)}")
+    built = {index_quantization(definition) for _, definition in vector_indexes(connection, tb_name, column=column)}
+    for quantization in quantizations:
+        if quantization not in built:
+            make_database.create_index(
+                    tb_name=tb_name,
+                    method=method,
+                    quantization=quantization,
+                    column=column,
+                    dim=dim
+                    )
+    sizes = index_sizes_mb(connection, tb_name, column=column)
+
+    exclude = None
+    if query_vectors is None:
+        exclude, query_vectors = sample_query_vectors(connection, tb_name, num_queries, column=column)
+    logger.info(f"Computing exact top-{k} of {len(query_vectors)} queries on {tb_name}.{column}")
+    truth = exact_top_k(connection, tb_name, query_vectors, k, exclude, column=column)
+
+    report = []
+    for quantization in quantizations:
+        for factor in (rerank if quantization != "none" else (1,)):
+            row = {
+                    "quantization": quantization,
+                    "rerank": factor if quantization != "none" else "",
+                    "index_mb": sizes.get(quantization, ""),
+                    }
+            row.update(measure(
+                    connection,
+                    tb_name,
+                    query_vectors,
+                    truth,
+                    k,
+                    exclude,
+                    probes=probes,
+                    ef_search=ef_search,
+                    quantization=quantization,
+                    rerank=factor,
+                    column=column
+                    ))
+            logger.info(row)
+            report.append(row)
+    return report
+
+
+def format_report(report: List[Dict[str, float]]) -> str:
+    """Render sweep results as an aligned text table"""
+    if not report:
+        return "no vector index found"
+    columns = []
+    for row in report:
+        columns += [key for key in row if key not in columns]
+    widths = {key: max(len(key), *(len(str(row.get(key, ""))) for row in report)) for key in columns}
+    lines = ["  ".join(key.ljust(widths[key]) for key in columns)]
+    for row in report:
+        lines.append("  ".join(str(row.get(key, "")).ljust(widths[key]) for key in columns))
+    return "\n".join(lines)
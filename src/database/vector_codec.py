@@ -0,0 +1,209 @@
+import io
+import struct
+from typing import (
+        Tuple
+        )
+
+import numpy as np
+from psycopg2.extensions import (
+        AsIs,
+        adapt,
+        new_array_type,
+        new_type,
+        register_adapter,
+        register_type
+        )
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+def to_host_array(embeddings) -> np.ndarray:
+    """Move a batch of embeddings to host memory as a float32 matrix
+
+    Accepts a `torch.Tensor` (on any device) or a NumPy array of shape
+    (batch, dim). A tensor is transferred with a single device-to-host
+    copy instead of one copy per row.
+    """
+    if hasattr(embeddings, "detach"):
+        embeddings = embeddings.detach().float().cpu().numpy()
+    array = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if array.ndim == 1:
+        array = array.reshape(1, -1)
+    return array
+
+
+def vector_wire_dtype(dim: int, with_length: bool = False) -> np.dtype:
+    """Structured dtype matching pgvector's binary representation
+
+    `vector_send`/`vector_recv` use an int16 dimension, an unused int16
+    and `dim` big-endian float4. With `with_length` the int32 length
+    prefix of a binary COPY field is included as well.
+    """
+    fields = [("dim", ">i2"), ("unused", ">i2"), ("data", ">f4", (dim,))]
+    if with_length:
+        fields.insert(0, ("length", ">i4"))
+    return np.dtype(fields)
+
+
+def encode_vector_batch(
+        embeddings,
+        with_length: bool = False
+        ) -> np.ndarray:
+    """Encode a (batch, dim) matrix into pgvector's binary format
+
+    The result is a (batch, nbytes) uint8 array, row `i` being the wire
+    representation of vector `i`. Conversion to big-endian happens in one
+    vectorized copy of the whole batch.
+
+    Args:
+        embeddings: torch tensor or NumPy array of shape (batch, dim)
+        with_length: prefix every row with its binary COPY field length
+    """
+    array = to_host_array(embeddings)
+    batch, dim = array.shape
+    encoded = np.empty(batch, dtype=vector_wire_dtype(dim, with_length))
+    if with_length:
+        encoded["length"] = 4 + 4 * dim
+    encoded["dim"] = dim
+    encoded["unused"] = 0
+    encoded["data"] = array
+    return encoded.view(np.uint8).reshape(batch, -1)
+
+
+def decode_vector_batch(data, dim: int) -> np.ndarray:
+    """Decode concatenated pgvector binary values into a float32 matrix
+
+    Args:
+        data: bytes-like object holding `n` vectors in wire format
+        dim: dimension of each vector
+    """
+    decoded = np.frombuffer(data, dtype=vector_wire_dtype(dim))
+    return decoded["data"].astype(np.float32)
+
+
+def encode_vector(vector) -> bytes:
+    """Encode one vector into pgvector's binary format (no length prefix)"""
+    return encode_vector_batch(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0].tobytes()
+
+
+def decode_vector(data) -> np.ndarray:
+    """Decode one pgvector binary value into a float32 array"""
+    dim = struct.unpack_from("!h", data, 0)[0]
+    return decode_vector_batch(data, dim)[0]
+
+
+def format_vector_literals(embeddings) -> list:
+    """Format a batch of embeddings as pgvector text literals (`[x,y,...]`)
+
+    The float-to-text conversion runs inside NumPy for the whole batch
+    rather than through one Python float object per dimension.
+    """
+    array = to_host_array(embeddings)
+    texts = array.astype(str)
+    return ["[" + ",".join(row) + "]" for row in texts]
+
+
+class VectorAdapter:
+    """psycopg2 adapter that sends a 1-D float NumPy array as `vector`
+
+    psycopg2 only sends parameters as text, so the array is rendered as
+    a pgvector literal; binary transfer goes through `COPY` instead.
+    """
+    def __init__(self, vector: np.ndarray) -> None:
+        self.vector = vector
+
+    def getquoted(self) -> bytes:
+        literal = format_vector_literals(self.vector)[0]
+        return adapt(literal).getquoted() + b"::vector"
+
+
+def _adapt_ndarray(array: np.ndarray):
+    if array.ndim == 1 and np.issubdtype(array.dtype, np.floating):
+        return VectorAdapter(array)
+    if array.ndim == 2 and np.issubdtype(array.dtype, np.floating):
+        literals = format_vector_literals(array)
+        return AsIs(adapt(literals).getquoted().decode("utf-8") + "::vector[]")
+    return adapt(array.tolist())
+
+
+def register_vector_adapter() -> None:
+    """Let psycopg2 pass NumPy float arrays as `vector` / `vector[]`"""
+    register_adapter(np.ndarray, _adapt_ndarray)
+
+
+def _parse_vector(value, cursor):
+    if value is None:
+        return None
+    return np.fromstring(value[1:-1], dtype=np.float32, sep=",")
+
+
+def register_vector_typecaster(connection) -> None:
+    """Return `vector` columns as float32 NumPy arrays on `connection`
+
+    Parsing happens in NumPy's C text parser instead of building a list
+    of Python floats.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+                "SELECT oid, typarray FROM pg_type WHERE typname = 'vector'"
+                )
+        result = cursor.fetchone()
+    if result is None:
+        raise ValueError("vector type not found, is the pgvector extension installed?")
+    oid, array_oid = result
+    vector_type = new_type((oid,), "VECTOR", _parse_vector)
+    register_type(vector_type, connection)
+    register_type(new_array_type((array_oid,), "VECTOR[]", vector_type), connection)
+
+
+def read_vectors(
+        cursor,
+        tb_name: str,
+        column: str = "embedd",
+        where: str = ""
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """Read ids and vectors of a table through binary `COPY ... TO STDOUT`
+
+    The binary COPY stream has a fixed record size, so it is decoded in
+    one `np.frombuffer` call without any text parsing. Rows with a NULL
+    vector are skipped.
+
+    Args:
+        cursor: psycopg2 cursor
+        tb_name: name of table
+        column: vector column to read
+        where: optional SQL predicate to filter the rows
+
+    Returns:
+        (ids, vectors): int64 array of shape (n,) and float32 array of
+                        shape (n, dim)
+    """
+    predicate = f"{column} IS NOT NULL"
+    if where:
+        predicate += f" AND ({where})"
+    buffer = io.BytesIO()
+    cursor.copy_expert(
+            f"COPY (SELECT id::int8, {column} FROM {tb_name} WHERE {predicate} ORDER BY id) "
+            "TO STDOUT WITH (FORMAT binary)",
+            buffer
+            )
+    data = buffer.getbuffer()
+    if bytes(data[:len(COPY_SIGNATURE)]) != COPY_SIGNATURE:
+        raise ValueError("Unexpected binary COPY header")
+    extension_length = struct.unpack_from("!i", data, len(COPY_SIGNATURE) + 4)[0]
+    start = len(COPY_SIGNATURE) + 8 + extension_length
+    body = data[start:len(data) - 2]
+    if len(body) == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    # field count (int16), id length + int8, vector length + vector
+    dim = struct.unpack_from("!h", body, 2 + 4 + 8 + 4)[0]
+    record = np.dtype([
+            ("fields", ">i2"),
+            ("id_length", ">i4"),
+            ("id", ">i8"),
+            ("vector_length", ">i4"),
+            ("vector", vector_wire_dtype(dim)),
+            ])
+    records = np.frombuffer(body, dtype=record)
+    return records["id"].astype(np.int64), records["vector"]["data"].astype(np.float32)
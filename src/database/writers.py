@@ -0,0 +1,457 @@
+import io
+import os
+import struct
+import time
+from typing import (
+        Optional,
+        Sequence
+        )
+
+from psycopg2.extras import execute_values
+
+from database.checkpoint import (
+        move_checkpoints
+        )
+from database.query_cache import (
+        notify_table_changed
+        )
+from database.vector_codec import (
+        encode_vector_batch,
+        register_vector_adapter,
+        to_host_array
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+COMMIT_ROWS=int(os.getenv("COMMIT_ROWS", 10000))
+COMMIT_BYTES=int(os.getenv("COMMIT_BYTES", 64 * 1024 * 1024))
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_HEADER = COPY_SIGNATURE + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+NULL_FIELD = struct.pack("!i", -1)
+# where a writer spends its time: building the rows to send, sending them
+# (INSERT / COPY round trips) and committing (checkpoint included)
+WRITE_PHASES = ("serialize", "send", "commit")
+
+
+def encode_text_field(value: Optional[str]) -> bytes:
+    """Encode a text value as a binary COPY field (length prefix + utf-8)"""
+    if value is None:
+        return NULL_FIELD
+    data = value.encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+class InsertWriter:
+    """Write rows with a multi-row `INSERT ... VALUES` and commit per batch
+
+    This is the original ingestion path and is kept as the default. Rows
+    whose `source_id` already exists are skipped. `timings` accumulates
+    the seconds spent in each of `WRITE_PHASES`.
+    """
+    def __init__(
+            self,
+            connection,
+            tb_name: str,
+            columns: Sequence[str],
+            hook=None,
+            embedding_column: str = "embedd",
+            ) -> None:
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.tb_name = tb_name
+        self.columns = tuple(columns) + (embedding_column,)
+        self.hook = hook
+        self.row_template = "(" + ",".join(["%s"] * len(self.columns)) + ")"
+        self.timings = dict.fromkeys(WRITE_PHASES, 0.0)
+        register_vector_adapter()
+
+    def write(
+            self,
+            rows: Sequence[Sequence[str]],
+            embeddings
+            ) -> None:
+        """Insert a batch of rows and commit
+
+        Args:
+            rows: text values of each row, ordered as `columns`
+            embeddings: tensor or array of shape (len(rows), dim)
+        """
+        start = time.perf_counter()
+        vectors = to_host_array(embeddings)
+        values = [tuple(row) + (vector,) for row, vector in zip(rows, vectors)]
+        args = ','.join(self.cursor.mogrify(self.row_template, i).decode('utf-8') for i in values)
+        sql_insert_query = f"""
+                INSERT INTO {self.tb_name} ({", ".join(self.columns)})
+                VALUES"""
+        sent = time.perf_counter()
+        self.timings["serialize"] += sent - start
+        self.cursor.execute(sql_insert_query + (args) + " ON CONFLICT DO NOTHING")
+        self.timings["send"] += time.perf_counter() - sent
+        self._commit()
+
+    def _commit(self, changed: bool = True) -> None:
+        start = time.perf_counter()
+        if changed:
+            notify_table_changed(self.cursor, self.tb_name)
+        if self.hook is not None:
+            self.hook.before_commit(self.cursor)
+        self.connection.commit()
+        if self.hook is not None:
+            self.hook.after_commit()
+        self.timings["commit"] += time.perf_counter() - start
+
+    def flush(self) -> None:
+        """Commit the hook's state left by batches without rows
+
+        Rows are committed on every write, but the checkpoint ranges and
+        duplicate links of all-duplicate batches wait for the next one.
+        """
+        if self.hook is not None and self.hook.has_pending:
+            self._commit(changed=False)
+
+    def close(self) -> None:
+        self.flush()
+        self.cursor.close()
+
+
+class CopyWriter:
+    """Stream rows with `COPY ... FROM STDIN (FORMAT binary)`
+
+    Rows are serialized straight into a binary COPY buffer and sent to
+    the server in a single COPY once `commit_rows` rows or `commit_bytes`
+    bytes are pending, which is also when the transaction is committed.
+
+    With `idempotent`, rows are copied into a temporary table first and
+    moved with `INSERT ... ON CONFLICT DO NOTHING`, so replayed rows are
+    skipped by their unique `source_id` instead of failing the COPY.
+    With `upsert` they replace the existing row of their `source_id`
+    instead. `written_rows` counts the rows committed to the table,
+    skipped replays excluded. `timings` accumulates the seconds spent in
+    each of `WRITE_PHASES`.
+    """
+    def __init__(
+            self,
+            connection,
+            tb_name: str,
+            columns: Sequence[str],
+            commit_rows: int = COMMIT_ROWS,
+            commit_bytes: int = COMMIT_BYTES,
+            idempotent: bool = True,
+            hook=None,
+            upsert: bool = False,
+            embedding_column: str = "embedd",
+            ) -> None:
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.tb_name = tb_name
+        self.columns = tuple(columns) + (embedding_column,)
+        self.commit_rows = commit_rows
+        self.commit_bytes = commit_bytes
+        self.hook = hook
+        column_list = ", ".join(self.columns)
+        copy_target = tb_name
+        self.merge_sql = None
+        if idempotent or upsert:
+            copy_target = f"_copy_{tb_name}"
+            self.cursor.execute(f'''
+                    CREATE TEMP TABLE IF NOT EXISTS {copy_target}
+                    ON COMMIT DELETE ROWS
+                    AS SELECT {column_list} FROM {tb_name} WITH NO DATA;
+                    ''')
+            self.connection.commit()
+            conflict = "DO NOTHING"
+            if upsert:
+                updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in self.columns if column != "source_id")
+                conflict = f"(source_id) DO UPDATE SET {updates}"
+            self.merge_sql = (
+                    f"INSERT INTO {tb_name} ({column_list}) "
+                    f"SELECT {column_list} FROM {copy_target} ON CONFLICT {conflict}"
+                    )
+        self.copy_sql = (
+                f"COPY {copy_target} ({column_list}) "
+                "FROM STDIN WITH (FORMAT binary)"
+                )
+        self.field_count = struct.pack("!h", len(self.columns))
+        self.written_rows = 0
+        self.timings = dict.fromkeys(WRITE_PHASES, 0.0)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.buffer = io.BytesIO()
+        self.buffer.write(COPY_HEADER)
+        self.pending_rows = 0
+
+    def write(
+            self,
+            rows: Sequence[Sequence[str]],
+            embeddings
+            ) -> None:
+        """Append a batch of rows to the COPY buffer
+
+        Args:
+            rows: text values of each row, ordered as `columns`
+            embeddings: tensor or array of shape (len(rows), dim)
+        """
+        start = time.perf_counter()
+        vectors = encode_vector_batch(embeddings, with_length=True)
+        for row, vector in zip(rows, vectors):
+            self.buffer.write(self.field_count)
+            for value in row:
+                self.buffer.write(encode_text_field(value))
+            self.buffer.write(vector)
+        self.pending_rows += len(rows)
+        self.timings["serialize"] += time.perf_counter() - start
+
+        if self.pending_rows >= self.commit_rows \
+                or self.buffer.tell() >= self.commit_bytes:
+            self.flush()
+
+    def _commit(self, changed: bool = True) -> None:
+        start = time.perf_counter()
+        if changed:
+            notify_table_changed(self.cursor, self.tb_name)
+        if self.hook is not None:
+            self.hook.before_commit(self.cursor)
+        self.connection.commit()
+        if self.hook is not None:
+            self.hook.after_commit()
+        self.timings["commit"] += time.perf_counter() - start
+
+    def flush(self) -> None:
+        """Send pending rows in one COPY and commit
+
+        Without pending rows, the hook's state left by all-duplicate
+        batches (checkpoint ranges, duplicate links) is still committed.
+        """
+        if self.pending_rows == 0:
+            if self.hook is not None and self.hook.has_pending:
+                self._commit(changed=False)
+            return
+        start = time.perf_counter()
+        self.buffer.write(COPY_TRAILER)
+        self.buffer.seek(0)
+        self.cursor.copy_expert(self.copy_sql, self.buffer)
+        written = self.pending_rows
+        if self.merge_sql is not None:
+            self.cursor.execute(self.merge_sql)
+            written = self.cursor.rowcount
+        self.timings["send"] += time.perf_counter() - start
+        self._commit()
+        self.written_rows += written
+        logger.debug(f"Copied {self.pending_rows} rows into {self.tb_name}")
+        self._reset()
+
+    def close(self) -> None:
+        self.flush()
+        self.cursor.close()
+
+
+class NullWriter:
+    """Serialize rows like `CopyWriter` and discard them
+
+    A sink for benchmarking everything but the database: the binary COPY
+    encoding is still paid (and timed as `serialize`), nothing is sent.
+    Has the writer interface of `database.writers`, `connection` is None.
+    """
+    def __init__(self, columns: Sequence[str]) -> None:
+        self.connection = None
+        self.field_count = struct.pack("!h", len(columns) + 1)
+        self.timings = dict.fromkeys(WRITE_PHASES, 0.0)
+        self.rows = 0
+        self.bytes = 0
+
+    def write(
+            self,
+            rows: Sequence[Sequence[str]],
+            embeddings
+            ) -> None:
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        vectors = encode_vector_batch(embeddings, with_length=True)
+        for row, vector in zip(rows, vectors):
+            buffer.write(self.field_count)
+            for value in row:
+                buffer.write(encode_text_field(value))
+            buffer.write(vector)
+        self.rows += len(rows)
+        self.bytes += buffer.tell()
+        self.timings["serialize"] += time.perf_counter() - start
+
+    def flush(self) -> None:
+        """Nothing is pending"""
+
+    def close(self) -> None:
+        logger.debug(f"Discarded {self.rows} rows ({self.bytes} bytes)")
+
+
+class EmbeddingColumnWriter:
+    """Fill a vector column of rows that already exist
+
+    Used to re-embed a table into a new embedding version's column (see
+    `embedding_versions`). Rows are `(id, md5 of content, content)`; the
+    embeddings of a batch are sent in one `UPDATE ... FROM (VALUES ...)`
+    and committed. A row whose content changed since it was read is left
+    as is, its new content is encoded by the catch-up pass. `timings`
+    accumulates the seconds spent in each of `WRITE_PHASES`.
+    """
+    def __init__(
+            self,
+            connection,
+            tb_name: str,
+            column: str,
+            ) -> None:
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.tb_name = tb_name
+        self.column = column
+        self.update_sql = f'''
+                UPDATE {tb_name} t SET {column} = v.embedd
+                FROM (VALUES %s) AS v(id, content_md5, embedd)
+                WHERE t.id = v.id AND md5(coalesce(t.content, '')) = v.content_md5
+                '''
+        self.rows = 0
+        self.timings = dict.fromkeys(WRITE_PHASES, 0.0)
+        register_vector_adapter()
+
+    def write(
+            self,
+            rows: Sequence[Sequence],
+            embeddings
+            ) -> None:
+        start = time.perf_counter()
+        vectors = to_host_array(embeddings)
+        values = [(row[0], row[1], vector) for row, vector in zip(rows, vectors)]
+        sent = time.perf_counter()
+        self.timings["serialize"] += sent - start
+        execute_values(self.cursor, self.update_sql, values, page_size=len(values))
+        self.rows += self.cursor.rowcount
+        committed = time.perf_counter()
+        self.timings["send"] += committed - sent
+        self.connection.commit()
+        self.timings["commit"] += time.perf_counter() - committed
+
+    def flush(self) -> None:
+        """Rows are committed on every write, nothing to flush"""
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+def make_writer(
+        connection,
+        tb_name: str,
+        columns: Sequence[str],
+        bulk_load: bool = False,
+        idempotent: bool = True,
+        hook=None,
+        upsert: bool = False,
+        embedding_column: str = "embedd"
+        ):
+    """Create the writer used by the ingestion loop
+
+    Args:
+        connection: an open psycopg2 connection
+        tb_name: name of the table to write to
+        columns: text columns written before the embedding
+        bulk_load: stream with binary COPY instead of multi-row INSERT
+        idempotent: skip rows whose `source_id` already exists (COPY only,
+                    INSERT always does)
+        hook: `CheckpointHook` called around every commit
+        upsert: replace the rows whose `source_id` already exists (always
+                    with COPY)
+        embedding_column: vector column written, the one of the active
+                    embedding version (see `embedding_versions`)
+    """
+    if bulk_load or upsert:
+        return CopyWriter(
+                connection=connection,
+                tb_name=tb_name,
+                columns=columns,
+                idempotent=idempotent,
+                hook=hook,
+                upsert=upsert,
+                embedding_column=embedding_column
+                )
+    return InsertWriter(
+            connection=connection,
+            tb_name=tb_name,
+            columns=columns,
+            hook=hook,
+            embedding_column=embedding_column
+            )
+
+
+def staging_table_name(tb_name: str) -> str:
+    return f"{tb_name}_staging"
+
+
+def create_staging_table(connection, tb_name: str) -> str:
+    """Create an UNLOGGED copy of `tb_name` to bulk-load into
+
+    Only column defaults are copied (the `id` sequence is shared) so the
+    load does not maintain the primary key index row by row.
+
+    Returns:
+        name of the staging table
+    """
+    staging = staging_table_name(tb_name)
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+                CREATE UNLOGGED TABLE IF NOT EXISTS {staging}
+                (LIKE {tb_name} INCLUDING DEFAULTS INCLUDING GENERATED);
+                ''')
+    connection.commit()
+    logger.info(f"Loading into unlogged staging table {staging}")
+    return staging
+
+
+def swap_staging_table(connection, tb_name: str) -> None:
+    """Move the staging table's rows into `tb_name`
+
+    When `tb_name` is still empty the staging table is made durable and
+    renamed in its place, otherwise its rows are appended with a single
+    `INSERT ... SELECT`.
+    """
+    staging = staging_table_name(tb_name)
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {tb_name} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {tb_name})")
+        has_rows = cursor.fetchone()[0]
+        if has_rows:
+            # generated columns (`content_tsv`) are computed again on insert
+            cursor.execute('''
+                    SELECT column_name FROM information_schema.columns
+                    WHERE table_name = %s AND is_generated = 'NEVER'
+                    ORDER BY ordinal_position
+                    ''', (tb_name,))
+            columns = ", ".join(row[0] for row in cursor.fetchall())
+            cursor.execute(f'''
+                    INSERT INTO {tb_name} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT DO NOTHING;
+                    DROP TABLE {staging};
+                    ''')
+        else:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (tb_name,))
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f'''
+                    ALTER TABLE {staging} SET LOGGED;
+                    ALTER TABLE {staging} ADD CONSTRAINT {staging}_pkey PRIMARY KEY (id);
+                    CREATE UNIQUE INDEX {staging}_source_id_key ON {staging} (source_id);
+                    ''')
+            if sequence:
+                cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {staging}.id")
+            cursor.execute(f'''
+                    DROP TABLE {tb_name};
+                    ALTER TABLE {staging} RENAME TO {tb_name};
+                    ALTER TABLE {tb_name} RENAME CONSTRAINT {staging}_pkey TO {tb_name}_pkey;
+                    ALTER INDEX {staging}_source_id_key RENAME TO {tb_name}_source_id_key;
+                    ''')
+        move_checkpoints(cursor, from_tb=staging, to_tb=tb_name)
+        notify_table_changed(cursor, tb_name)
+    connection.commit()
+    logger.info(f"Swapped staging table {staging} into {tb_name}")
@@ -0,0 +1,173 @@
+import os
+import threading
+from typing import (
+        List,
+        Tuple
+        )
+
+import numpy as np
+import torch
+from transformers import (
+        BatchEncoding,
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+import dotenv
+
+dotenv.load_dotenv()
+
+MAX_LENGTH = 512
+MIN_TOKENS = MAX_LENGTH
+CPU_MAX_TOKENS=int(os.getenv("CPU_MAX_TOKENS", 8192))
+GPU_MEMORY_FRACTION=float(os.getenv("GPU_MEMORY_FRACTION", 0.6))
+# live activation tensors per token and layer, relative to the hidden size
+ACTIVATION_FACTOR = 24
+
+
+class TokenBudget:
+    """Maximum number of (padded) tokens per encoder forward pass
+
+    Shared by the batch planner and the encoder: a forward pass running
+    out of memory lowers the budget for every later batch.
+    """
+    def __init__(self, max_tokens: int) -> None:
+        self.max_tokens = max(MIN_TOKENS, int(max_tokens))
+        self.lock = threading.Lock()
+
+    def shrink(self, failed_tokens: int) -> None:
+        with self.lock:
+            self.max_tokens = max(MIN_TOKENS, min(self.max_tokens, int(failed_tokens * 0.75)))
+
+
+def auto_max_tokens(
+        model_encoder: DPRContextEncoder,
+        device: torch.device
+        ) -> int:
+    """Derive a token budget from the memory of `device`
+
+    On GPU the budget is the free memory (`GPU_MEMORY_FRACTION` of it)
+    divided by an estimate of the activation memory of one token. On CPU
+    memory is rarely the limit, `CPU_MAX_TOKENS` keeps batches cache
+    friendly.
+    """
+    if device.type != "cuda":
+        return CPU_MAX_TOKENS
+    config = getattr(model_encoder, "config", None)
+    hidden_size = getattr(config, "hidden_size", 768)
+    num_heads = getattr(config, "num_attention_heads", 12)
+    free, _ = torch.cuda.mem_get_info(device)
+    bytes_per_token = 4 * (ACTIVATION_FACTOR * hidden_size + 2 * num_heads * MAX_LENGTH)
+    return max(MIN_TOKENS, int(free * GPU_MEMORY_FRACTION / bytes_per_token))
+
+
+def plan_token_batches(
+        lengths: np.ndarray,
+        max_tokens: int
+        ) -> List[np.ndarray]:
+    """Group passages into batches whose padded size fits `max_tokens`
+
+    Passages are sorted by length (longest first) so every batch pads to
+    roughly the length of its own passages.
+
+    Args:
+        lengths: number of tokens of every passage
+        max_tokens: budget of `batch size * longest passage` per batch
+
+    Returns:
+        indices (into `lengths`) of the passages of every batch
+    """
+    order = np.argsort(-lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        longest = max(int(lengths[order[start]]), 1)
+        size = max(1, max_tokens // longest)
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+class TokenBuckets:
+    """Tokenized passages of one window, split into token-budget batches"""
+    def __init__(
+            self,
+            size: int,
+            batches: List[Tuple[np.ndarray, BatchEncoding]]
+            ) -> None:
+        self.size = size
+        self.batches = batches
+
+
+def tokenize_ctx_buckets(
+        tokenizer: DPRContextEncoderTokenizer,
+        text: List[str],
+        budget: TokenBudget
+        ) -> TokenBuckets:
+    """Tokenize a window of passages into length-bucketed batches
+
+    Args:
+        tokenizer: DPR tokenizer
+        text: passages of the window
+        budget: token budget of a forward pass
+    """
+    encoded = tokenizer(text, truncation=True, max_length=MAX_LENGTH)
+    lengths = np.fromiter((len(ids) for ids in encoded["input_ids"]), dtype=np.int64, count=len(text))
+    batches = []
+    for indices in plan_token_batches(lengths, budget.max_tokens):
+        features = {key: [values[i] for i in indices] for key, values in encoded.items()}
+        batches.append((indices, tokenizer.pad(features, return_tensors="pt")))
+    return TokenBuckets(size=len(text), batches=batches)
+
+
+def _is_oom(err: RuntimeError) -> bool:
+    return "out of memory" in str(err)
+
+
+def _encode_batch(
+        model_encoder: DPRContextEncoder,
+        encoded_input: BatchEncoding,
+        device: torch.device,
+        budget: TokenBudget
+        ) -> torch.Tensor:
+    """Encode one batch, halving it when the device runs out of memory"""
+    try:
+        with torch.no_grad():
+            return model_encoder(**encoded_input.to(device))["pooler_output"]
+    except RuntimeError as err:
+        batch_size, length = encoded_input["input_ids"].shape
+        if not _is_oom(err) or batch_size == 1:
+            raise
+        torch.cuda.empty_cache()
+        budget.shrink(batch_size * length)
+        half = batch_size // 2
+        first = BatchEncoding({key: value[:half] for key, value in encoded_input.items()})
+        second = BatchEncoding({key: value[half:] for key, value in encoded_input.items()})
+        return torch.cat([
+                _encode_batch(model_encoder, first, device, budget),
+                _encode_batch(model_encoder, second, device, budget)
+                ])
+
+
+def encode_ctx_buckets(
+        model_encoder: DPRContextEncoder,
+        buckets: TokenBuckets,
+        device: torch.device,
+        budget: TokenBudget
+        ) -> torch.Tensor:
+    """Encode length-bucketed batches, embeddings in the original order
+
+    Args:
+        model_encoder: DPR context encoder model
+        buckets: output of `tokenize_ctx_buckets`
+        device: device the encoder runs on
+        budget: token budget, lowered on out-of-memory errors
+    """
+    model_encoder.eval()
+    output = None
+    for indices, encoded_input in buckets.batches:
+        embeddings = _encode_batch(model_encoder, encoded_input, device, budget)
+        if output is None:
+            output = embeddings.new_empty((buckets.size, embeddings.shape[-1]))
+        output[torch.as_tensor(indices, device=output.device)] = embeddings
+    return output
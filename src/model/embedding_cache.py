@@ -0,0 +1,481 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from typing import (
+        Dict,
+        List,
+        Optional,
+        Tuple
+        )
+
+import numpy as np
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+EMBEDDING_CACHE_SHARD_ROWS=int(os.getenv("EMBEDDING_CACHE_SHARD_ROWS", 65536))
+
+_ROW_BITS = 32
+_ROW_MASK = (1 << _ROW_BITS) - 1
+# marks locations in the shards of other writers
+_SHARED = 1 << 62
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form of a passage: NFC, whitespace collapsed
+
+    Passages differing only in these ways tokenize to the same input ids,
+    so they share one cache entry.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_keys(model_id: str, text: List[str]) -> np.ndarray:
+    """64-bit cache keys of passages, scoped to an encoder
+
+    Args:
+        model_id: identifies the encoder weights and backend; embeddings of
+                different models never share a key
+        text: passages
+    """
+    prefix = hashlib.blake2b(model_id.encode("utf-8") + b"\0", digest_size=8)
+    keys = np.empty(len(text), dtype=np.uint64)
+    for i, passage in enumerate(text):
+        digest = prefix.copy()
+        digest.update(normalize_text(passage).encode("utf-8"))
+        keys[i] = int.from_bytes(digest.digest(), "little")
+    return keys
+
+
+class CachePlan:
+    """Which passages of a batch are cached, to encode, or deferred
+
+    Attributes:
+        keys: cache key of every passage
+        hit_index: positions found in the cache, with `hit_vectors`
+        encode_index: positions to encode, one per distinct missing key
+        deferred_index: positions whose key is encoded by another position
+                    of this batch, or by another batch still in flight
+    """
+    __slots__ = ("keys", "hit_index", "hit_vectors", "encode_index", "deferred_index")
+
+    def __init__(
+            self,
+            keys: np.ndarray,
+            hit_index: np.ndarray,
+            hit_vectors: np.ndarray,
+            encode_index: np.ndarray,
+            deferred_index: np.ndarray
+            ) -> None:
+        self.keys = keys
+        self.hit_index = hit_index
+        self.hit_vectors = hit_vectors
+        self.encode_index = encode_index
+        self.deferred_index = deferred_index
+
+
+class EmbeddingCache:
+    """Content-addressed on-disk cache of passage embeddings
+
+    Embeddings live in fixed-size float32 shards that are memory-mapped;
+    the index is a sorted array of 64-bit keys and their (shard, row)
+    location, 16 bytes per entry, persisted next to the shards. New
+    entries are kept in a small dict and merged into the sorted arrays
+    when the index is saved (at every new shard and on `close`).
+
+    Entries are keyed by model and passage only, every process of every
+    load shares them. Each process writes its own `writer-<n>` directory
+    (claimed with a file lock, so concurrent processes never write the
+    same index) and reads the entries the other writers had saved when
+    it opened the cache.
+
+    The cache is capped at `max_bytes` of shards, counted over every
+    writer directory when a writer starts a new shard. The writer's own
+    oldest shards are evicted first, then the directories of writers that
+    are no longer running, least recently saved first.
+
+    Thread safe: the ingestion pipeline plans lookups from the tokenizer
+    threads and stores embeddings from the encoder thread.
+
+    Args:
+        cache_dir: directory of the cache, a subdirectory per model is used
+        model_id: identifies the encoder weights and backend
+        max_bytes: size cap of the embedding shards
+        shard_rows: embeddings per shard file
+    """
+    def __init__(
+            self,
+            cache_dir: str,
+            model_id: str,
+            max_bytes: int,
+            shard_rows: int = EMBEDDING_CACHE_SHARD_ROWS
+            ) -> None:
+        self.model_id = model_id
+        self.root = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]+", "--", model_id.strip("/")))
+        self.max_bytes = max_bytes
+        self.shard_rows = shard_rows
+        self.dim: Optional[int] = None
+        # [shard id, rows filled], oldest first
+        self.shards: List[List[int]] = []
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.locations = np.empty(0, dtype=np.int64)
+        self.recent: Dict[int, int] = {}
+        self.pending = set()
+        self.maps: Dict[int, np.memmap] = {}
+        # entries of the other writers, located in `shared_maps`
+        self.shared_keys = np.empty(0, dtype=np.uint64)
+        self.shared_locations = np.empty(0, dtype=np.int64)
+        self.shared_maps: List[np.memmap] = []
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(
+                ("lookups", "hits", "duplicates", "encoded", "evicted_shards", "evicted_writers"), 0)
+        os.makedirs(self.root, exist_ok=True)
+        self.path, self.lock_file = self._claim_writer()
+        self._load()
+        self._load_shared()
+
+    def _claim_writer(self):
+        """Directory of the first writer slot no other process holds"""
+        slot = 0
+        while True:
+            lock_file = open(os.path.join(self.root, f"writer-{slot}.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                slot += 1
+                continue
+            path = os.path.join(self.root, f"writer-{slot}")
+            os.makedirs(path, exist_ok=True)
+            return path, lock_file
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.path, f"shard-{shard:06d}.f32")
+
+    def _shard_bytes(self) -> int:
+        return self.shard_rows * (self.dim or 0) * 4
+
+    def _load(self) -> None:
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path) as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.shard_rows = meta["shard_rows"]
+        self.shards = meta["shards"]
+        self.keys = np.load(os.path.join(self.path, "keys.npy"))
+        self.locations = np.load(os.path.join(self.path, "locations.npy"))
+        logger.info(f"Embedding cache {self.path}: {len(self.keys)} entries in {len(self.shards)} shards")
+
+    def _load_shared(self) -> None:
+        """Map the saved shards of the other writers, read-only
+
+        Shards are mapped up front: one evicted later by its writer stays
+        readable through the mapping.
+        """
+        keys, locations = [], []
+        # a cache written before writer directories keeps its files in the root
+        paths = [self.root] + sorted(glob.glob(os.path.join(self.root, "writer-*")))
+        for path in paths:
+            meta_path = os.path.join(path, "meta.json")
+            if path == self.path or not os.path.isdir(path) or not os.path.exists(meta_path):
+                continue
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                writer_keys = np.load(os.path.join(path, "keys.npy"))
+                writer_locations = np.load(os.path.join(path, "locations.npy"))
+            except (OSError, ValueError) as err:
+                logger.warning(f"Skipping embedding cache {path}: {err}")
+                continue
+            if self.dim is not None and meta["dim"] != self.dim:
+                continue
+            files = {}
+            for shard, _ in meta["shards"]:
+                try:
+                    memmap = np.memmap(
+                            os.path.join(path, f"shard-{shard:06d}.f32"),
+                            dtype=np.float32,
+                            mode="r",
+                            shape=(meta["shard_rows"], meta["dim"])
+                            )
+                except (OSError, ValueError):
+                    continue
+                files[shard] = len(self.shared_maps)
+                self.shared_maps.append(memmap)
+            shards = writer_locations >> _ROW_BITS
+            mapped = np.isin(shards, list(files))
+            file_ids = np.array([files.get(int(shard), 0) for shard in shards[mapped]], dtype=np.int64)
+            keys.append(writer_keys[mapped])
+            locations.append((file_ids << _ROW_BITS) | (writer_locations[mapped] & _ROW_MASK))
+            self.dim = self.dim or meta["dim"]
+        if keys:
+            keys, locations = np.concatenate(keys), np.concatenate(locations)
+            order = np.argsort(keys, kind="stable")
+            self.shared_keys, self.shared_locations = keys[order], locations[order]
+            logger.info(f"Embedding cache {self.root}: {len(self.shared_keys)} entries of other writers")
+
+    def _map(self, shard: int) -> np.memmap:
+        if shard not in self.maps:
+            self.maps[shard] = np.memmap(
+                    self._shard_path(shard),
+                    dtype=np.float32,
+                    mode="r+",
+                    shape=(self.shard_rows, self.dim)
+                    )
+        return self.maps[shard]
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """Locations of `keys`, -1 where missing"""
+        locations = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.keys):
+            index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[index] == keys
+            locations[found] = self.locations[index[found]]
+        if self.recent:
+            for i in np.flatnonzero(locations < 0):
+                locations[i] = self.recent.get(int(keys[i]), -1)
+        missing = np.flatnonzero(locations < 0)
+        if len(self.shared_keys) and len(missing):
+            index = np.minimum(np.searchsorted(self.shared_keys, keys[missing]), len(self.shared_keys) - 1)
+            found = self.shared_keys[index] == keys[missing]
+            locations[missing[found]] = self.shared_locations[index[found]] | _SHARED
+        return locations
+
+    def _read(self, locations: np.ndarray) -> np.ndarray:
+        vectors = np.empty((len(locations), self.dim or 0), dtype=np.float32)
+        shared = (locations & _SHARED) != 0
+        shards = (locations & ~_SHARED) >> _ROW_BITS
+        for is_shared, shard in set(zip(shared.tolist(), shards.tolist())):
+            mask = (shared == is_shared) & (shards == shard)
+            memmap = self.shared_maps[shard] if is_shared else self._map(shard)
+            vectors[mask] = memmap[locations[mask] & _ROW_MASK]
+        return vectors
+
+    def plan(self, text: List[str]) -> CachePlan:
+        """Look a batch of passages up and claim the keys it will encode
+
+        A missing key is encoded by the first position that asks for it;
+        later positions, in this batch or in later batches, are deferred
+        until its embedding is stored.
+        """
+        keys = text_keys(self.model_id, text)
+        with self.lock:
+            locations = self._find(keys)
+            hit_index = np.flatnonzero(locations >= 0)
+            hit_vectors = self._read(locations[hit_index])
+            encode_index, deferred_index = [], []
+            for i in np.flatnonzero(locations < 0):
+                key = int(keys[i])
+                if key in self.pending:
+                    deferred_index.append(i)
+                else:
+                    self.pending.add(key)
+                    encode_index.append(i)
+            self.counts["lookups"] += len(keys)
+            self.counts["hits"] += len(hit_index)
+            self.counts["duplicates"] += len(deferred_index)
+        return CachePlan(
+                keys=keys,
+                hit_index=hit_index,
+                hit_vectors=hit_vectors,
+                encode_index=np.asarray(encode_index, dtype=np.int64),
+                deferred_index=np.asarray(deferred_index, dtype=np.int64)
+                )
+
+    def get(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Embeddings of `keys`
+
+        Returns:
+            (found mask, embeddings of the found keys)
+        """
+        with self.lock:
+            locations = self._find(keys)
+            found = locations >= 0
+            return found, self._read(locations[found])
+
+    def put(self, keys: np.ndarray, vectors: np.ndarray) -> None:
+        """Store embeddings and release the claim on their keys"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            self.counts["encoded"] += len(keys)
+            start = 0
+            while start < len(keys):
+                if not self.shards or self.shards[-1][1] == self.shard_rows:
+                    self._new_shard()
+                shard, filled = self.shards[-1]
+                size = min(len(keys) - start, self.shard_rows - filled)
+                self._map(shard)[filled:filled + size] = vectors[start:start + size]
+                for j, key in enumerate(keys[start:start + size]):
+                    self.recent[int(key)] = (shard << _ROW_BITS) | (filled + j)
+                self.shards[-1][1] = filled + size
+                start += size
+            self.pending.difference_update(int(key) for key in keys)
+
+    def _new_shard(self) -> None:
+        shard = self.shards[-1][0] + 1 if self.shards else 0
+        self.maps[shard] = np.memmap(
+                self._shard_path(shard),
+                dtype=np.float32,
+                mode="w+",
+                shape=(self.shard_rows, self.dim)
+                )
+        self.shards.append([shard, 0])
+        # other writers grow while this one runs, their size is read from
+        # disk under a lock shared by all writers of the cache
+        with open(os.path.join(self.root, "evict.lock"), "w") as evict_lock:
+            fcntl.flock(evict_lock, fcntl.LOCK_EX)
+            others = self._other_writers()
+            excess = len(self.shards) * self._shard_bytes() + sum(size for _, size, _ in others) - self.max_bytes
+            evicted = []
+            while len(self.shards) > 1 and excess > 0:
+                evicted.append(self.shards.pop(0)[0])
+                excess -= self._shard_bytes()
+            if evicted:
+                self._evict(evicted)
+            self._save()
+            for old in evicted:
+                os.remove(self._shard_path(old))
+            for path, size, _ in sorted(others, key=lambda writer: writer[2]):
+                if excess <= 0:
+                    break
+                if self._remove_stale_writer(path):
+                    excess -= size
+
+    def _other_writers(self) -> List[Tuple[str, int, float]]:
+        """(directory, shard bytes, last save time) of the other writers"""
+        writers = []
+        paths = [self.root] + sorted(glob.glob(os.path.join(self.root, "writer-*")))
+        for path in paths:
+            if path == self.path or not os.path.isdir(path):
+                continue
+            size = 0
+            for shard_path in glob.glob(os.path.join(path, "shard-*.f32")):
+                try:
+                    size += os.path.getsize(shard_path)
+                except OSError:
+                    pass
+            try:
+                saved = os.path.getmtime(os.path.join(path, "meta.json"))
+            except OSError:
+                saved = 0.0
+            if size:
+                writers.append((path, size, saved))
+        return writers
+
+    def _remove_stale_writer(self, path: str) -> bool:
+        """Delete the files of a writer directory no process holds
+
+        Processes that mapped its shards keep reading them until they
+        close the cache.
+
+        Returns:
+            whether the directory was emptied
+        """
+        lock_file = None
+        if path != self.root:
+            lock_file = open(path + ".lock", "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        try:
+            # the index goes first, a shard is never listed without its file
+            names = ["meta.json", "keys.npy", "locations.npy"]
+            names += sorted(os.path.basename(p) for p in glob.glob(os.path.join(path, "shard-*.f32")))
+            for name in names:
+                try:
+                    os.remove(os.path.join(path, name))
+                except FileNotFoundError:
+                    pass
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        self.counts["evicted_writers"] += 1
+        logger.info(f"Embedding cache evicted the stale writer {path}")
+        return True
+
+    def _evict(self, shards: List[int]) -> None:
+        for shard in shards:
+            self.maps.pop(shard, None)
+        evicted = np.asarray(shards, dtype=np.int64)
+        keep = ~np.isin(self.locations >> _ROW_BITS, evicted)
+        self.keys = self.keys[keep]
+        self.locations = self.locations[keep]
+        self.recent = {
+                key: location for key, location in self.recent.items()
+                if (location >> _ROW_BITS) not in shards
+                }
+        self.counts["evicted_shards"] += len(shards)
+        logger.info(f"Embedding cache evicted shards {shards}")
+
+    def _save(self) -> None:
+        """Merge new entries into the sorted index and persist it
+
+        Shards are flushed first, the index never points to rows that are
+        not on disk.
+        """
+        for memmap in self.maps.values():
+            memmap.flush()
+        if self.recent:
+            keys = np.concatenate([self.keys, np.fromiter(self.recent.keys(), dtype=np.uint64)])
+            locations = np.concatenate([self.locations, np.fromiter(self.recent.values(), dtype=np.int64)])
+            order = np.argsort(keys, kind="stable")
+            self.keys = keys[order]
+            self.locations = locations[order]
+            self.recent = {}
+        for name, array in (("keys.npy", self.keys), ("locations.npy", self.locations)):
+            with open(os.path.join(self.path, name + ".tmp"), "wb") as f:
+                np.save(f, array)
+        meta = {"model_id": self.model_id, "dim": self.dim, "shard_rows": self.shard_rows, "shards": self.shards}
+        with open(os.path.join(self.path, "meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        for name in ("keys.npy", "locations.npy", "meta.json"):
+            os.replace(os.path.join(self.path, name + ".tmp"), os.path.join(self.path, name))
+
+    def stats(self) -> Dict[str, float]:
+        """Lookup counters and hit rate of this process"""
+        with self.lock:
+            stats = dict(self.counts)
+            stats["entries"] = len(self.keys) + len(self.recent) + len(self.shared_keys)
+            stats["bytes"] = len(self.shards) * self._shard_bytes() + sum(m.nbytes for m in self.shared_maps)
+        reused = stats["hits"] + stats["duplicates"]
+        stats["hit_rate"] = round(reused / stats["lookups"], 4) if stats["lookups"] else 0.0
+        return stats
+
+    def close(self) -> None:
+        """Persist the index and log the statistics"""
+        with self.lock:
+            if self.dim is not None:
+                self._save()
+            self.maps = {}
+            self.shared_maps = []
+            self.lock_file.close()
+        logger.info(f"Embedding cache {self.path}: {self.stats()}")
+
+
+def open_embedding_cache(
+        cache_dir: str,
+        model_id: str,
+        max_gb: float
+        ) -> Optional[EmbeddingCache]:
+    """Open the embedding cache of an ingestion process, None if disabled
+
+    Processes of any load, however it is sharded, share the entries of
+    the same model; each writes its own files, see `EmbeddingCache`.
+    """
+    if not cache_dir:
+        return None
+    return EmbeddingCache(cache_dir=cache_dir, model_id=model_id, max_bytes=int(max_gb * 2 ** 30))
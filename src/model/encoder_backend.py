@@ -0,0 +1,261 @@
+import os
+import re
+import time
+from typing import (
+        Dict,
+        List
+        )
+
+import numpy as np
+import torch
+from transformers import (
+        DPRConfig,
+        DPRContextEncoder,
+        DPRContextEncoderTokenizer
+        )
+
+import logging
+import dotenv
+logger = logging.getLogger(__name__)
+
+dotenv.load_dotenv()
+
+ONNX_CACHE_DIR=os.getenv(
+        "ONNX_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "wiki-database", "onnx")
+        )
+ONNX_OPSET=int(os.getenv("ONNX_OPSET", 14))
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+class _PooledOutput(torch.nn.Module):
+    """Expose only `pooler_output` so the exported graph has one output"""
+    def __init__(self, model: DPRContextEncoder) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids
+                ).pooler_output
+
+
+def onnx_model_dir(model_name_or_path: str) -> str:
+    """Cache directory of the exported models of a checkpoint"""
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "--", model_name_or_path.strip("/"))
+    return os.path.join(ONNX_CACHE_DIR, slug)
+
+
+def export_onnx(model_name_or_path: str) -> str:
+    """Export a DPR context encoder to ONNX, once
+
+    Args:
+        model_name_or_path: name of DPR model on HuggingFace hub or path
+                            to DPR checkpoint
+
+    Returns:
+        path of the cached fp32 ONNX model
+    """
+    path = os.path.join(onnx_model_dir(model_name_or_path), "model.onnx")
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    logger.info(f"Exporting {model_name_or_path} to {path}")
+
+    tokenizer = DPRContextEncoderTokenizer.from_pretrained(model_name_or_path)
+    model = DPRContextEncoder.from_pretrained(model_name_or_path).eval()
+    dummy = tokenizer(["an example passage", "another one"], padding=True, return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    dynamic_axes["pooler_output"] = {0: "batch"}
+
+    tmp_path = path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+                _PooledOutput(model),
+                tuple(dummy[name] for name in names),
+                tmp_path,
+                input_names=names,
+                output_names=["pooler_output"],
+                dynamic_axes=dynamic_axes,
+                opset_version=ONNX_OPSET
+                )
+    os.replace(tmp_path, path)
+    return path
+
+
+def quantize_onnx(model_name_or_path: str) -> str:
+    """Dynamically quantize the exported model's weights to int8, once
+
+    Returns:
+        path of the cached int8 ONNX model
+    """
+    from onnxruntime.quantization import (
+            QuantType,
+            quantize_dynamic
+            )
+
+    fp32_path = export_onnx(model_name_or_path)
+    path = os.path.join(os.path.dirname(fp32_path), "model-int8.onnx")
+    if os.path.exists(path):
+        return path
+    logger.info(f"Quantizing {fp32_path} to {path}")
+    tmp_path = path + ".tmp"
+    quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, path)
+    return path
+
+
+class OnnxEncoder:
+    """ONNX Runtime session that behaves like `DPRContextEncoder`
+
+    Calling it with tokenizer outputs returns `{"pooler_output": tensor}`,
+    so it can replace the PyTorch model in `encode_ctx`/`get_ctx_embd`.
+    Runs on CPU.
+
+    Args:
+        model_path: path of the ONNX model
+        config: config of the exported checkpoint
+        intra_op_threads: threads used inside an operator, 0 lets ONNX
+                        Runtime decide
+        inter_op_threads: threads running independent operators, 0 lets
+                        ONNX Runtime decide
+    """
+    def __init__(
+            self,
+            model_path: str,
+            config: DPRConfig,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0
+            ) -> None:
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+                model_path,
+                sess_options=options,
+                providers=["CPUExecutionProvider"]
+                )
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.config = config
+
+    def eval(self) -> "OnnxEncoder":
+        return self
+
+    def to(self, device) -> "OnnxEncoder":
+        return self
+
+    def __call__(self, **encoded_input) -> Dict[str, torch.Tensor]:
+        feeds = {
+                name: np.ascontiguousarray(encoded_input[name].cpu().numpy(), dtype=np.int64)
+                for name in self.input_names
+                }
+        (pooled,) = self.session.run(["pooler_output"], feeds)
+        return {"pooler_output": torch.from_numpy(pooled)}
+
+
+def load_encoder_backend(
+        model_name_or_path: str,
+        backend: str = "torch",
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0
+        ):
+    """Load the context encoder with the requested backend
+
+    Args:
+        model_name_or_path: name of DPR model on HuggingFace hub or path
+                            to DPR checkpoint
+        backend: `torch` (eager fp32), `onnx` (ONNX Runtime fp32) or
+                `onnx-int8` (ONNX Runtime, dynamically quantized weights).
+                ONNX models are exported on first use and cached in
+                `ONNX_CACHE_DIR`.
+        intra_op_threads: threads used inside an operator, 0 keeps the default
+        inter_op_threads: threads running independent operators, 0 keeps
+                        the default
+    """
+    if backend == "torch":
+        if intra_op_threads > 0:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads > 0:
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError as err:
+                logger.warning(f"Could not set inter-op threads: {err}")
+        return DPRContextEncoder.from_pretrained(model_name_or_path)
+    if backend == "onnx":
+        model_path = export_onnx(model_name_or_path)
+    elif backend == "onnx-int8":
+        model_path = quantize_onnx(model_name_or_path)
+    else:
+        raise ValueError(f"Unknown encoder backend {backend}, expected one of {ENCODER_BACKENDS}")
+    return OnnxEncoder(
+            model_path=model_path,
+            config=DPRConfig.from_pretrained(model_name_or_path),
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads
+            )
+
+
+def check_agreement(
+        reference,
+        candidate,
+        tokenizer: DPRContextEncoderTokenizer,
+        text: List[str],
+        batch_size: int = 16
+        ) -> Dict[str, float]:
+    """Compare a backend's embeddings and speed with the fp32 PyTorch encoder's
+
+    Args:
+        reference: fp32 `DPRContextEncoder`
+        candidate: encoder to evaluate
+        tokenizer: DPR tokenizer
+        text: sample passages
+        batch_size: passages per forward pass
+
+    Returns:
+        mean / min / 1st percentile cosine similarity between the
+        embeddings of the same passage, the mean relative difference
+        of their inner-product scores, the encode seconds of each backend
+        and the candidate's speedup over the reference
+    """
+    from model.retriever_model import get_ctx_embd
+
+    cpu = torch.device("cpu")
+    reference.to(cpu)
+    # one untimed batch each, the first run pays for lazy initialization
+    for encoder in (reference, candidate):
+        get_ctx_embd(encoder, tokenizer, text[:batch_size], cpu)
+    expected, actual = [], []
+    seconds = {"reference": 0.0, "candidate": 0.0}
+    for start in range(0, len(text), batch_size):
+        chunk = text[start:start + batch_size]
+        for name, encoder, embeddings in (("reference", reference, expected), ("candidate", candidate, actual)):
+            started = time.perf_counter()
+            embeddings.append(get_ctx_embd(encoder, tokenizer, chunk, cpu).float().numpy())
+            seconds[name] += time.perf_counter() - started
+    expected = np.concatenate(expected)
+    actual = np.concatenate(actual)
+
+    cosine = np.sum(expected * actual, axis=1) / (
+            np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1) + 1e-12
+            )
+    expected_scores = expected @ expected.T
+    actual_scores = actual @ actual.T
+    score_drift = np.abs(actual_scores - expected_scores) / (np.abs(expected_scores) + 1e-12)
+    report = {
+            "samples": len(text),
+            "cosine_mean": float(cosine.mean()),
+            "cosine_min": float(cosine.min()),
+            "cosine_p01": float(np.percentile(cosine, 1)),
+            "score_relative_drift": float(score_drift.mean()),
+            "reference_seconds": round(seconds["reference"], 3),
+            "candidate_seconds": round(seconds["candidate"], 3),
+            "speedup": round(seconds["reference"] / seconds["candidate"], 2) if seconds["candidate"] else 0.0,
+            }
+    logger.info(f"Encoder agreement with fp32: {report}")
+    return report
@@ -1,34 +1,119 @@
 from typing import (
+        Optional,
         Tuple,
         Union,
         List
         )
 
 from transformers import (
+        BatchEncoding,
         DPRContextEncoderTokenizer,
-        DPRContextEncoder
+        DPRContextEncoder,
+        DPRQuestionEncoderTokenizer,
+        DPRQuestionEncoder
         )
 import torch
 
+from model.encoder_backend import (
+        load_encoder_backend
+        )
+from model.batching import (
+        TokenBudget,
+        auto_max_tokens,
+        encode_ctx_buckets,
+        tokenize_ctx_buckets
+        )
+
 def load_dpr_context_encoder(
-        model_name_or_path: str
+        model_name_or_path: str,
+        backend: str = "torch",
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0
         )-> Tuple[DPRContextEncoder,DPRContextEncoderTokenizer]:
     """Load model DPR context encoder to encode knowledges
 
     Args:
         model_name_or_path: name of DPR model needs to be downloaded from
                             HuggingFace hub or path to DPR checkpoint
+        backend: `torch`, `onnx` or `onnx-int8`, see `load_encoder_backend`
+        intra_op_threads: threads used inside an operator, 0 keeps the default
+        inter_op_threads: threads running independent operators, 0 keeps
+                        the default
     """
     ctx_token = DPRContextEncoderTokenizer.from_pretrained(model_name_or_path)
-    ctx_model = DPRContextEncoder.from_pretrained(model_name_or_path)
+    ctx_model = load_encoder_backend(
+            model_name_or_path=model_name_or_path,
+            backend=backend,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads
+            )
 
     return (ctx_model, ctx_token)
 
+def load_context_encoder(
+        model_name_or_path: str,
+        backend: str = "torch",
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0
+        )-> Tuple[DPRContextEncoder,DPRContextEncoderTokenizer,torch.device]:
+    """Load a DPR context encoder on its device, in eval mode
+
+    Arguments are the ones of `load_dpr_context_encoder`. The device is
+    CUDA when available and `backend` is `torch`, the CPU otherwise.
+    """
+    ctx_model, ctx_token = load_dpr_context_encoder(
+            model_name_or_path=model_name_or_path,
+            backend=backend,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads
+            )
+    device = torch.device("cuda" if torch.cuda.is_available() and backend == "torch" else "cpu")
+    ctx_model.to(device)
+    ctx_model.eval()
+    return (ctx_model, ctx_token, device)
+
+def tokenize_ctx(
+        tokenizer: DPRContextEncoderTokenizer,
+        text: Union[str, List[str]]
+        ) -> BatchEncoding:
+    """Tokenize knowledges into model inputs (kept on CPU)
+
+    Args:
+        tokenizer: DPR tokenizer
+        text: a knowledge (sentence, paragraph,...)
+    """
+    return tokenizer(
+            text,
+            padding=True,
+            truncation=True,
+            max_length=512,
+            return_tensors="pt"
+            )
+
+def encode_ctx(
+        model_encoder: DPRContextEncoder,
+        encoded_input: BatchEncoding,
+        device: torch.device
+        ) -> torch.tensor:
+    """Encode tokenized knowledges
+
+    Args:
+        model_encoder: DPR context encoder model
+        encoded_input: output of `tokenize_ctx`
+    """
+    model_encoder.eval()
+    encoded_input = encoded_input.to(device)
+    with torch.no_grad():
+        model_output = model_encoder(**encoded_input)
+
+    return model_output["pooler_output"]
+
 def get_ctx_embd(
         model_encoder: DPRContextEncoder,
         tokenizer: DPRContextEncoderTokenizer,
         text: Union[str, List[str]],
-        device: torch.device
+        device: torch.device,
+        max_tokens: Optional[int] = None
         ) -> torch.tensor:
     """Get knowledge embedding
 
@@ -36,6 +121,55 @@ def get_ctx_embd(
         model_encoder: DPR context encoder model
         tokenizer: DPR tokenizer
         text: a knowledge (sentence, paragraph,...)
+        max_tokens: when set, passages are sorted by length and encoded in
+                    batches of at most `max_tokens` padded tokens (0 derives
+                    the budget from the device memory). Embeddings are
+                    returned in the order of `text` either way.
+    """
+    if max_tokens is not None:
+        if isinstance(text, str):
+            text = [text]
+        budget = TokenBudget(max_tokens or auto_max_tokens(model_encoder, device))
+        buckets = tokenize_ctx_buckets(tokenizer=tokenizer, text=text, budget=budget)
+        return encode_ctx_buckets(
+                model_encoder=model_encoder,
+                buckets=buckets,
+                device=device,
+                budget=budget
+                )
+    encoded_input = tokenize_ctx(tokenizer=tokenizer, text=text)
+    return encode_ctx(
+            model_encoder=model_encoder,
+            encoded_input=encoded_input,
+            device=device
+            )
+
+def load_dpr_question_encoder(
+        model_name_or_path: str
+        )-> Tuple[DPRQuestionEncoder,DPRQuestionEncoderTokenizer]:
+    """Load model DPR question encoder to encode queries
+
+    Args:
+        model_name_or_path: name of DPR model needs to be downloaded from
+                            HuggingFace hub or path to DPR checkpoint
+    """
+    q_token = DPRQuestionEncoderTokenizer.from_pretrained(model_name_or_path)
+    q_model = DPRQuestionEncoder.from_pretrained(model_name_or_path)
+
+    return (q_model, q_token)
+
+def get_question_embd(
+        model_encoder: DPRQuestionEncoder,
+        tokenizer: DPRQuestionEncoderTokenizer,
+        text: Union[str, List[str]],
+        device: torch.device
+        ) -> torch.tensor:
+    """Get query embedding
+
+    Args:
+        model_encoder: DPR question encoder model
+        tokenizer: DPR question tokenizer
+        text: a query or a batch of queries
     """
     model_encoder.eval()
     encoded_input = tokenizer(
@@ -49,4 +183,3 @@ def get_ctx_embd(
         model_output = model_encoder(**encoded_input)
 
     return model_output["pooler_output"]
-
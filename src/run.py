@@ -1,10 +1,27 @@
 import os
+import itertools
 import logging
+import multiprocessing
 import torch
+from typing import Optional
 
 from configs.arguments import Arguments
 from model import retriever_model
+from model import encoder_backend
+from model.embedding_cache import open_embedding_cache
+from data.dedup import make_deduplicator
 from database import make_database
+from database import index_manager
+from database import stores
+from database.checkpoint import dataset_fingerprint
+from database.embedding_versions import (
+        EmbeddingVersion,
+        active_version
+        )
+from database.connection import (
+        DatabaseConfig,
+        configure
+        )
 from data import make_data
 
 import dotenv
@@ -23,51 +40,234 @@ BATCH=int(os.getenv("BATCH", 16))
 logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+def ingest_shard(
+        args,
+        version: EmbeddingVersion,
+        shard_index: int,
+        num_shards: int,
+        num_threads: int,
+        store: Optional[stores.VectorStore] = None
+        ) -> None:
+    """Encode and insert one shard of the wiki snippets
+
+    Runs in its own process when `--num_workers` > 1, with its own
+    encoder replica and database connections. Passages are encoded with
+    the model of the table's active embedding `version`, and written to
+    `store` instead of the database if given.
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    configure(DatabaseConfig.from_args(args))
+    encoder_model, model_tokenizer, device = retriever_model.load_context_encoder(
+            model_name_or_path=version.model,
+            backend=args.encoder_backend,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads
+            )
+    print("Start downloading dataset")
+    wiki_snippets = make_data.download_dataset(
+            dataset_name=args.dataset_name,
+            dataset_version = args.dataset_version,
+            streaming=args.streaming
+            )
+    if args.check_encoder_agreement and args.encoder_backend != "torch" and shard_index == 0:
+        sample = [
+                str(article["passage_text"])
+                for article in itertools.islice(iter(wiki_snippets), args.check_encoder_agreement)
+                ]
+        encoder_backend.check_agreement(
+                reference=encoder_backend.load_encoder_backend(version.model),
+                candidate=encoder_model,
+                tokenizer=model_tokenizer,
+                text=sample
+                )
+    wiki_snippets = make_data.shard_dataset(
+            snippets=wiki_snippets,
+            shard_index=shard_index,
+            num_shards=num_shards
+            )
+
+    cache = open_embedding_cache(
+            cache_dir=args.embedding_cache_dir,
+            model_id=f"{version.model}@{args.encoder_backend}",
+            max_gb=args.embedding_cache_gb
+            )
+    fingerprint = dataset_fingerprint(args.dataset_name, args.dataset_version)
+
+    print("Start inserting knowledges")
+    make_database.insert_knowledges(
+            context_encoder=encoder_model,
+            context_tokenizer=model_tokenizer,
+            snippets=wiki_snippets,
+            device=device,
+            fingerprint=fingerprint,
+            bulk_load=args.bulk_load,
+            unlogged_staging=args.unlogged_staging,
+            num_tokenizers=args.num_tokenizers,
+            num_writers=args.num_writers,
+            shard_index=shard_index,
+            num_shards=num_shards,
+            max_tokens=args.max_tokens,
+            cache=cache,
+            dedup=make_deduplicator(args.dedup, args.dedup_threshold, args.dedup_max_entries),
+            artifact_dir=args.artifact_dir if args.encode_only else "",
+            tb_name=args.tbname or TB_WIKI,
+            embedding_column=version.column,
+            store=store
+            )
+    if cache is not None:
+        cache.close()
+
+def run_numpy_store(args, tb_name: str) -> None:
+    """Load the wiki snippets into a `NumpyStore` and build its index
+
+    A single process writes the store, with the original encoder; no
+    database is used.
+    """
+    if args.num_workers > 1 or args.num_shards > 1:
+        raise ValueError("--store numpy is written by a single process, drop --num_workers and --num_shards")
+    if args.encode_only or args.import_only or args.unlogged_staging:
+        raise ValueError("--store numpy can not be combined with --encode_only, --import_only or --unlogged_staging")
+    store = stores.open_store("numpy", store_dir=args.store_dir)
+    if not args.just_create_index:
+        num_threads = args.num_threads or max(1, os.cpu_count() or 1)
+        ingest_shard(args, EmbeddingVersion.legacy(tb_name), 0, 1, num_threads, store=store)
+    store.create_index(tb_name, lists=args.ivf_lists, pq_subvectors=args.pq_subvectors)
+
 def main():
     arguments = Arguments()
     args = arguments.parse()
-    row = 17553713 if args.dataset_version == "wiki40b_en_100_0" else 33849898
+    configure(DatabaseConfig.from_args(args))
+    tb_name = args.tbname or TB_WIKI
+    if args.store == "numpy":
+        run_numpy_store(args, tb_name)
+        return
+    index_partitions = [partition for partition in args.index_partitions.split(",") if partition] or None
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {args.num_shards})")
+    if args.partition_by == "range" and not args.just_create_index:
+        raise ValueError("--partition_by range can not skip replayed rows by source_id, use --partition_by hash")
+    if args.unlogged_staging and args.partition_by != "none":
+        raise ValueError("--unlogged_staging can not load a partitioned table")
+    if args.unlogged_staging and args.num_shards > 1:
+        raise ValueError("--unlogged_staging can not be combined with a multi-host load")
+    if args.encode_only and args.import_only:
+        raise ValueError("--encode_only and --import_only can not be combined")
+    if (args.encode_only or args.import_only) and not args.artifact_dir:
+        raise ValueError("--encode_only and --import_only need an --artifact_dir")
     if not args.just_create_index:
-        if args.init_db and not args.init_tb:
+        if args.encode_only:
+            logger.info(f"Encoding into {args.artifact_dir}, the database is not used")
+        elif args.init_db and not args.init_tb:
             make_database.create_postgres_db()
-            make_database.create_wiki_table()
+            make_database.create_wiki_table(
+                    tb_name=tb_name,
+                    lexical=args.lexical_index,
+                    partition_by=args.partition_by,
+                    partitions=args.partitions,
+                    partition_rows=args.partition_rows
+                    )
         elif args.init_tb and not args.init_db:
-            make_database.create_wiki_table()
+            make_database.create_wiki_table(
+                    tb_name=tb_name,
+                    lexical=args.lexical_index,
+                    partition_by=args.partition_by,
+                    partitions=args.partitions,
+                    partition_rows=args.partition_rows
+                    )
         elif not args.init_tb and not args.init_db:
             logger.warning("Make sure your database and table exist")
         else:
             ValueError("Database and table are created at the same time, or just a table is created")
 
-        encoder_model, model_tokenizer = retriever_model.load_dpr_context_encoder(
-                model_name_or_path="vblagoje/dpr-ctx_encoder-single-lfqa-wiki"
-                )
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print("Start downloading dataset")
-        encoder_model.to(device)
-        encoder_model.eval()
-        wiki_snippets = make_data.download_dataset(
-                dataset_name=args.dataset_name,
-                dataset_version = args.dataset_version,
-                streaming=args.streaming
-                )
+        # part files hold embeddings of the original model, for `embedd`
+        version = EmbeddingVersion.legacy(tb_name) if args.encode_only else active_version(tb_name)
+        if args.import_only and version.column != "embedd":
+            raise ValueError(f"{tb_name} was migrated to {version.column}, part files can not be imported into it")
+        if args.import_only:
+            make_database.import_artifacts(
+                    tb_name=tb_name,
+                    artifact_dir=args.artifact_dir,
+                    num_writers=args.num_writers,
+                    shard_index=args.shard_index,
+                    num_shards=args.num_shards
+                    )
+        else:
+            # every host runs `num_workers` processes, each owning one global shard
+            num_shards = args.num_shards * args.num_workers
+            shards = [args.shard_index * args.num_workers + w for w in range(args.num_workers)]
+            num_threads = args.num_threads or max(1, (os.cpu_count() or 1) // args.num_workers)
+            if args.num_workers == 1:
+                ingest_shard(args, version, shards[0], num_shards, num_threads)
+            else:
+                context = multiprocessing.get_context("spawn")
+                workers = [
+                        context.Process(
+                            target=ingest_shard,
+                            args=(args, version, shard, num_shards, num_threads),
+                            name=f"ingest-shard-{shard}"
+                            )
+                        for shard in shards
+                        ]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                failed = [worker.name for worker in workers if worker.exitcode != 0]
+                if failed:
+                    raise RuntimeError(f"Ingestion workers failed: {failed}")
+                if args.unlogged_staging:
+                    make_database.finish_staging_load(tb_name=tb_name)
 
-        print("Start inserting knowledges")
-        make_database.insert_knowledges(
-                context_encoder=encoder_model,
-                context_tokenizer=model_tokenizer,
-                snippets=wiki_snippets,
-                device=device
-                )
-        make_database.create_index(
-                tb_name=TB_WIKI,
-                num_data=row)
+        if args.encode_only:
+            logger.info("Index is created by the --import_only run")
+        elif args.num_shards > 1:
+            logger.warning("Index is not created for a multi-host load, "
+                           "run with --just_create_index once every host is done.")
+        else:
+            make_database.create_index(
+                    tb_name=tb_name,
+                    method=args.index_method,
+                    m=args.hnsw_m,
+                    ef_construction=args.hnsw_ef_construction,
+                    quantization=args.quantization,
+                    num_workers=args.index_workers,
+                    partitions=index_partitions,
+                    column=version.column,
+                    dim=version.dim)
+            if args.lexical_index:
+                make_database.create_lexical_index(tb_name=tb_name, columns=make_database.WIKI_TEXT_COLUMNS)
     else:
         logger.warning("Only index initialization is perfomed, make sure your table is filled up with data.")
-        make_database.create_index(
-                tb_name=TB_WIKI,
-                num_data=row)
+        version = active_version(tb_name)
+        if args.rebuild_index:
+            report = index_manager.rebuild_index(
+                    tb_name=tb_name,
+                    method=args.index_method,
+                    m=args.hnsw_m,
+                    ef_construction=args.hnsw_ef_construction,
+                    quantization=args.quantization,
+                    num_workers=args.index_workers,
+                    column=version.column,
+                    dim=version.dim,
+                    num_queries=args.rebuild_check_queries or index_manager.INDEX_CHECK_QUERIES,
+                    min_recall=(index_manager.INDEX_MIN_RECALL
+                                if args.rebuild_min_recall is None else args.rebuild_min_recall)
+                    )
+            logger.info(f"Rebuilt index of {tb_name}: {report}")
+        else:
+            make_database.create_index(
+                    tb_name=tb_name,
+                    method=args.index_method,
+                    m=args.hnsw_m,
+                    ef_construction=args.hnsw_ef_construction,
+                    quantization=args.quantization,
+                    num_workers=args.index_workers,
+                    partitions=index_partitions,
+                    column=version.column,
+                    dim=version.dim)
+        if args.lexical_index:
+            make_database.create_lexical_index(tb_name=tb_name, columns=make_database.WIKI_TEXT_COLUMNS)
 
 if __name__=="__main__":
     main()
-
-
@@ -0,0 +1,69 @@
+import os
+import json
+import logging
+import torch
+
+from configs.arguments import Arguments
+from model import retriever_model
+from database import benchmark
+from database.connection import (
+        DatabaseConfig,
+        configure
+        )
+from database.tuning import format_report
+
+import dotenv
+
+dotenv.load_dotenv()
+
+BENCH_TB=os.getenv("BENCH_TB", "ingest_bench")
+MODEL_NAME="vblagoje/dpr-ctx_encoder-single-lfqa-wiki"
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    arguments = Arguments()
+    args = arguments.parse()
+    configure(DatabaseConfig.from_args(args))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    encoder_model, model_tokenizer, device = retriever_model.load_context_encoder(
+            model_name_or_path=MODEL_NAME,
+            backend=args.encoder_backend,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads
+            )
+
+    report = benchmark.run_ingestion_benchmark(
+            context_encoder=encoder_model,
+            context_tokenizer=model_tokenizer,
+            device=device,
+            shape=args.bench_shape,
+            num_rows=args.bench_rows,
+            mean_words=args.bench_words,
+            std_words=args.bench_words_std,
+            distribution=args.bench_length_distribution,
+            seed=args.bench_seed,
+            sink=args.bench_sink,
+            tb_name=args.tbname or BENCH_TB,
+            bulk_load=args.bulk_load,
+            num_tokenizers=args.num_tokenizers,
+            num_writers=args.num_writers,
+            max_tokens=args.max_tokens,
+            keep_table=args.bench_keep_table
+            )
+    report["config"]["encoder_backend"] = args.encoder_backend
+    print(f"{report['rows_per_sec']} rows/s in {report['elapsed_sec']}s")
+    print(format_report([{"step": step, "sec": seconds, "ms_per_row": report["breakdown_ms_per_row"][step]}
+                         for step, seconds in report["breakdown_sec"].items()]))
+    if args.bench_baseline:
+        with open(args.bench_baseline) as f:
+            baseline = json.load(f)
+        print(format_report(benchmark.compare_reports(baseline, report)))
+    if args.bench_output:
+        with open(args.bench_output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import logging
+import torch
+
+from configs.arguments import Arguments
+from model import retriever_model
+from database import embedding_versions
+from database.connection import (
+        DatabaseConfig,
+        configure
+        )
+from database.tuning import format_report
+
+import dotenv
+
+dotenv.load_dotenv()
+
+TB_WIKI=os.getenv("TB_WIKI", "wiki_tb")
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    arguments = Arguments()
+    args = arguments.parse()
+    configure(DatabaseConfig.from_args(args))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    tb_name = args.tbname or TB_WIKI
+    step = args.migrate_step
+
+    if step == "status":
+        print(format_report(embedding_versions.version_report(tb_name)))
+        return
+    if not args.migrate_version:
+        raise ValueError(f"--migrate_step {step} needs a --migrate_version")
+
+    known = {version.version for version in embedding_versions.list_versions(tb_name)}
+    if step == "add" or (step == "all" and args.migrate_version not in known):
+        if not args.migrate_model or not args.migrate_question_model:
+            raise ValueError("A new version needs a --migrate_model and a --migrate_question_model")
+        encoder_model, model_tokenizer, device = retriever_model.load_context_encoder(
+                model_name_or_path=args.migrate_model,
+                backend=args.encoder_backend,
+                intra_op_threads=args.intra_op_threads,
+                inter_op_threads=args.inter_op_threads
+                )
+        dim = retriever_model.get_ctx_embd(
+                model_encoder=encoder_model,
+                tokenizer=model_tokenizer,
+                text=["dimension probe"],
+                device=device
+                ).shape[1]
+        embedding_versions.add_version(
+                tb_name=tb_name,
+                version=args.migrate_version,
+                model=args.migrate_model,
+                question_model=args.migrate_question_model,
+                dim=dim
+                )
+    version = embedding_versions.get_version(tb_name, args.migrate_version)
+
+    if step == "drop":
+        embedding_versions.drop_version(version)
+        return
+    if step in ("backfill", "switch", "all"):
+        encoder_model, model_tokenizer, device = retriever_model.load_context_encoder(
+                model_name_or_path=version.model,
+                backend=args.encoder_backend,
+                intra_op_threads=args.intra_op_threads,
+                inter_op_threads=args.inter_op_threads
+                )
+    if step in ("backfill", "all") and (version.status == "backfilling" or args.migrate_catch_up):
+        embedding_versions.backfill(
+                version,
+                context_encoder=encoder_model,
+                context_tokenizer=model_tokenizer,
+                device=device,
+                page_rows=args.migrate_page_rows or embedding_versions.MIGRATE_PAGE_ROWS,
+                max_rows_per_sec=(embedding_versions.MIGRATE_MAX_ROWS_PER_SEC
+                                  if args.migrate_max_rows_per_sec is None else args.migrate_max_rows_per_sec),
+                max_tokens=args.max_tokens,
+                num_tokenizers=args.num_tokenizers,
+                num_writers=args.num_writers,
+                pending_only=args.migrate_catch_up
+                )
+    elif step == "backfill":
+        logger.warning(f"{version} is {version.status}, nothing to backfill")
+    if step == "index" or (step == "all" and version.status == "backfilling"):
+        embedding_versions.build_version_index(
+                version,
+                method=args.index_method,
+                m=args.hnsw_m,
+                ef_construction=args.hnsw_ef_construction,
+                quantization=args.quantization,
+                num_workers=args.index_workers
+                )
+        version = embedding_versions.get_version(tb_name, args.migrate_version)
+    if step in ("switch", "all"):
+        embedding_versions.switch(
+                version,
+                context_encoder=encoder_model,
+                context_tokenizer=model_tokenizer,
+                device=device,
+                max_tokens=args.max_tokens
+                )
+    print(format_report(embedding_versions.version_report(tb_name)))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,467 @@
+import os
+import asyncio
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+from configs.arguments import Arguments
+from database.async_search import (
+        create_async_pool,
+        fetch_active_versions,
+        fetch_partitions,
+        listen_table_changes,
+        search_embeddings_async
+        )
+from database.connection import DatabaseConfig
+from database.embedding_versions import EmbeddingVersion
+from database.federated import (
+        FEDERATED_CONFIDENT_HITS,
+        FEDERATED_CONFIDENT_Z,
+        FederatedSource,
+        ScoreCalibrator,
+        federated_search_async,
+        parse_source_options
+        )
+from database.query_cache import QueryCache
+from database.search import (
+        QUESTION_MODEL_NAME,
+        RERANK_FACTOR,
+        QuestionEncoder
+        )
+from serving.batcher import (
+        MicroBatcher,
+        Overloaded,
+        Stopped
+        )
+from serving.metrics import LatencyHistogram
+
+import dotenv
+
+dotenv.load_dotenv()
+
+TB_WIKI=os.getenv("TB_WIKI", "wiki_tb")
+TB_CLIENT=os.getenv("TB_CLIENT", "client_tb")
+EMBEDDING_VERSION_POLL=float(os.getenv("EMBEDDING_VERSION_POLL", 10))
+MAX_K = 1000
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class RetrievalServer:
+    """HTTP/JSON retrieval over `wiki_tb`/`client_tb`
+
+    Queries of concurrent requests are encoded together by a
+    `MicroBatcher` (one forward pass in a single encoder thread), and the
+    searches run over an asyncpg pool, so a request waiting on Postgres
+    holds no thread. Requests beyond `--max_inflight` are rejected with
+    503 and requests slower than `--request_timeout` end with 504.
+
+    With `--fan_out` the partitions of a partitioned table are searched
+    concurrently and their top-k merged.
+
+    Repeated queries skip the encoder and, unless their table changed
+    since, the search too (`QueryCache`, `--query_cache_*`).
+
+    A federated request searches every table of `--federated_tables`
+    concurrently, encoding its queries once per question encoder, and
+    merges their hits on scores calibrated per table and weighted by
+    `--federated_weights`; confident hits of the first table cancel the
+    searches of the others, see `database.federated`.
+
+    Every table is searched on the column of its active embedding
+    version with that version's question encoder. The versions are
+    polled every `EMBEDDING_VERSION_POLL` seconds; when a migration
+    switches a table, the new question encoder is loaded before the
+    table moves over, requests in flight finish on the old version.
+
+    Endpoints:
+        POST /search: {"queries": [...] or "query": "...", "k": 10,
+                      "table": "wiki_tb", "probes": null, "ef_search": null,
+                      "filters": {"domain": ["Drugs"]}, "with_content": false,
+                      "hybrid": false, "federated": false}
+        GET /metrics: latency histograms and counters
+        GET /health: database reachability
+    """
+    def __init__(self, args) -> None:
+        self.config = DatabaseConfig.from_args(args)
+        self.default_table = args.tbname or TB_WIKI
+        federated_tables = [table for table in args.federated_tables.split(",") if table] or [TB_CLIENT, TB_WIKI]
+        self.tables = {TB_WIKI, TB_CLIENT, self.default_table, *federated_tables}
+        self.federated = self._federated_sources(args, federated_tables)
+        self.calibrators = {table: ScoreCalibrator() for table in federated_tables}
+        self.confident_z = FEDERATED_CONFIDENT_Z if args.federated_confident_z is None else args.federated_confident_z
+        self.confident_hits = args.federated_confident_hits or FEDERATED_CONFIDENT_HITS
+        self.federated_requests = Counter()
+        self.max_inflight = args.max_inflight
+        self.request_timeout = args.request_timeout
+        self.quantization = args.quantization
+        self.rerank = args.rerank_factor or RERANK_FACTOR
+        self.fan_out = args.fan_out
+        self.partitions = {}
+        # overrides the question encoder of tables still on `embedd`
+        self.question_model = args.question_model
+        self.max_batch_size = args.max_batch_size
+        self.max_wait_ms = args.max_wait_ms
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="question-encoder")
+        # table -> active `EmbeddingVersion`, question model -> its `MicroBatcher`
+        self.versions = {}
+        self.batchers = {}
+        self.idle = set()
+        default_model = args.question_model or QUESTION_MODEL_NAME
+        encoder = QuestionEncoder(model_name_or_path=default_model)
+        self.batchers[default_model] = self._make_batcher(encoder)
+        self.cache = None
+        if args.query_cache_entries > 0:
+            self.cache = QueryCache(
+                    max_entries=args.query_cache_entries,
+                    max_bytes=int(args.query_cache_mb * 1024 * 1024),
+                    ttl=args.query_cache_ttl,
+                    lowercase=getattr(encoder.question_tokenizer, "do_lower_case", False)
+                    )
+        self.pool = None
+        self.listener = None
+        self.watcher = None
+        self.inflight = 0
+        self.status = Counter()
+        self.latency = {name: LatencyHistogram() for name in ("total", "encode", "search")}
+
+    @staticmethod
+    def _federated_sources(args, tables: list) -> list:
+        weights = parse_source_options(args.federated_weights, float)
+        budgets = [parse_source_options(value, int)
+                   for value in (args.federated_k, args.federated_probes, args.federated_ef_search)]
+        for options in [weights] + budgets:
+            unknown = set(options) - set(tables)
+            if unknown:
+                raise ValueError(f"{sorted(unknown)} are not federated tables {tables}")
+        k, probes, ef_search = budgets
+        return [
+                FederatedSource(
+                    table,
+                    weight=weights.get(table, 1.0),
+                    k=k.get(table),
+                    probes=probes.get(table),
+                    ef_search=ef_search.get(table)
+                    )
+                for table in tables
+                ]
+
+    def _make_batcher(self, encoder: QuestionEncoder) -> MicroBatcher:
+        # every question encoder runs in the same single encoder thread
+        return MicroBatcher(
+                process=lambda queries: list(encoder.encode(queries)),
+                max_batch_size=self.max_batch_size,
+                max_wait_ms=self.max_wait_ms,
+                max_queue=self.max_inflight * self.max_batch_size,
+                executor=self.executor
+                )
+
+    async def _refresh_versions(self) -> None:
+        """Move tables whose active embedding version changed over to it"""
+        active = await fetch_active_versions(self.pool, sorted(self.tables))
+        for table in self.tables:
+            version = active.get(table) or EmbeddingVersion.legacy(table)
+            if version.column == "embedd" and self.question_model:
+                version.question_model = self.question_model
+            current = self.versions.get(table)
+            if current is not None and (current.column, current.question_model) == \
+                    (version.column, version.question_model):
+                continue
+            if version.question_model not in self.batchers:
+                logger.info(f"Loading question encoder {version.question_model} for {table}")
+                encoder = await asyncio.get_running_loop().run_in_executor(
+                        None, QuestionEncoder, version.question_model)
+                batcher = self._make_batcher(encoder)
+                batcher.start()
+                self.batchers[version.question_model] = batcher
+            self.versions[table] = version
+            if current is not None:
+                logger.info(f"{table} switched to {version.column} ({version.question_model})")
+                if self.cache is not None:
+                    self.cache.invalidate(table)
+                # scores of the new encoder live on a scale of their own
+                if table in self.calibrators:
+                    self.calibrators[table] = ScoreCalibrator()
+        # an encoder is unloaded one poll after its last table left it,
+        # and later while requests still have queries queued on it
+        used = {version.question_model for version in self.versions.values()}
+        for model in [model for model in self.idle if model not in used and not self.batchers[model].busy]:
+            logger.info(f"Unloading question encoder {model}")
+            await self.batchers.pop(model).stop()
+        self.idle = {model for model in self.batchers if model not in used}
+
+    async def _watch_versions(self) -> None:
+        while True:
+            await asyncio.sleep(EMBEDDING_VERSION_POLL)
+            try:
+                await self._refresh_versions()
+            except Exception:
+                logger.exception("Could not refresh the embedding versions")
+
+    async def start(self, app: web.Application) -> None:
+        self.pool = await create_async_pool(self.config)
+        if self.fan_out:
+            for table in self.tables:
+                self.partitions[table] = await fetch_partitions(self.pool, table)
+        if self.cache is not None:
+            self.listener = await listen_table_changes(self.config, self.cache)
+        for batcher in self.batchers.values():
+            batcher.start()
+        await self._refresh_versions()
+        self.watcher = asyncio.ensure_future(self._watch_versions())
+
+    async def stop(self, app: web.Application) -> None:
+        if self.watcher is not None:
+            self.watcher.cancel()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+        if self.listener is not None:
+            await self.listener.close()
+        if self.pool is not None:
+            await self.pool.close()
+        self.executor.shutdown(wait=False)
+
+    def _parse(self, body: dict) -> dict:
+        queries = body.get("queries")
+        if queries is None:
+            queries = [body["query"]]
+        if not isinstance(queries, list) or not queries or not all(isinstance(q, str) for q in queries):
+            raise ValueError("queries must be a non-empty list of strings")
+        k = int(body.get("k", 10))
+        if not 0 < k <= MAX_K:
+            raise ValueError(f"k must be in [1, {MAX_K}]")
+        table = body.get("table", self.default_table)
+        if table not in self.tables:
+            raise ValueError(f"table must be one of {sorted(self.tables)}")
+        probes = body.get("probes")
+        ef_search = body.get("ef_search")
+        federated = bool(body.get("federated", False))
+        if federated and (body.get("filters") or body.get("hybrid")):
+            raise ValueError("federated requests take no filters and no hybrid search")
+        return {
+                "queries": queries,
+                "k": k,
+                "table": table,
+                "probes": None if probes is None else int(probes),
+                "ef_search": None if ef_search is None else int(ef_search),
+                "filters": body.get("filters"),
+                "with_content": bool(body.get("with_content", False)),
+                "hybrid": bool(body.get("hybrid", False)),
+                "federated": federated,
+                }
+
+    async def _encode(self, queries: list, model: str) -> np.ndarray:
+        batcher = self.batchers.get(model)
+        if batcher is None:
+            raise Stopped(f"the question encoder {model} was unloaded")
+        if self.cache is None:
+            return np.stack(await asyncio.gather(*(batcher.submit(query) for query in queries)))
+        embeddings = [self.cache.get_embedding(query, model) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        encoded = await asyncio.gather(*(batcher.submit(queries[i]) for i in missing))
+        for i, embedding in zip(missing, encoded):
+            self.cache.put_embedding(queries[i], embedding, model)
+            embeddings[i] = embedding
+        return np.stack(embeddings)
+
+    async def _top_k(self, embeddings: np.ndarray, request: dict, version: EmbeddingVersion):
+        texts = request["queries"] if request["hybrid"] else None
+
+        def search(embeddings, texts):
+            return search_embeddings_async(
+                    self.pool,
+                    embeddings,
+                    tb_name=request["table"],
+                    k=request["k"],
+                    probes=request["probes"],
+                    filters=request["filters"],
+                    ef_search=request["ef_search"],
+                    quantization=self.quantization,
+                    rerank=self.rerank,
+                    texts=texts,
+                    partitions=self.partitions.get(request["table"]),
+                    column=version.column
+                    )
+
+        if self.cache is None:
+            result = await search(embeddings, texts)
+            return result.ids, result.scores
+        keys, cached, generation = self.cache.lookup_results(
+                embeddings,
+                request["table"],
+                request["k"],
+                probes=request["probes"],
+                ef_search=request["ef_search"],
+                filters=request["filters"],
+                hybrid=request["hybrid"]
+                )
+        missing = [i for i, hit in enumerate(cached) if hit is None]
+        ids = scores = None
+        if missing:
+            result = await search(embeddings[missing], [texts[i] for i in missing] if texts else None)
+            ids, scores = result.ids, result.scores
+        return self.cache.store_results(keys, cached, ids, scores, generation)
+
+    async def _fetch_contents(self, table: str, ids) -> dict:
+        ids = [int(i) for i in np.unique(ids) if i >= 0]
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(f"SELECT id, title, content FROM {table} WHERE id = ANY($1::int[])", ids)
+        return {row["id"]: {"title": row["title"], "content": row["content"]} for row in rows}
+
+    async def _search(self, request: dict) -> list:
+        if request["federated"]:
+            return await self._federated_search(request)
+        started = time.perf_counter()
+        # the whole request runs on one version, even if a switch lands meanwhile
+        version = self.versions[request["table"]]
+        embeddings = await self._encode(request["queries"], version.question_model)
+        encoded = time.perf_counter()
+        self.latency["encode"].observe((encoded - started) * 1000)
+
+        top_ids, top_scores = await self._top_k(embeddings, request, version)
+        contents = {}
+        if request["with_content"]:
+            contents = await self._fetch_contents(request["table"], top_ids)
+        self.latency["search"].observe((time.perf_counter() - encoded) * 1000)
+
+        results = []
+        for ids, scores in zip(top_ids, top_scores):
+            hits = []
+            for passage_id, score in zip(ids, scores):
+                if passage_id < 0:
+                    break
+                hit = {"id": int(passage_id), "score": float(score)}
+                hit.update(contents.get(int(passage_id), {}))
+                hits.append(hit)
+            results.append(hits)
+        return results
+
+    async def _federated_search(self, request: dict) -> list:
+        started = time.perf_counter()
+        versions = {source.tb_name: self.versions[source.tb_name] for source in self.federated}
+        # tables sharing a question encoder share one encoder pass
+        models = sorted({version.question_model for version in versions.values()})
+        encoded = await asyncio.gather(*(self._encode(request["queries"], model) for model in models))
+        embeddings = dict(zip(models, encoded))
+        searched = time.perf_counter()
+        self.latency["encode"].observe((searched - started) * 1000)
+
+        result = await federated_search_async(
+                self.pool,
+                {table: embeddings[version.question_model] for table, version in versions.items()},
+                self.federated,
+                self.calibrators,
+                k=request["k"],
+                probes=request["probes"],
+                ef_search=request["ef_search"],
+                columns={table: version.column for table, version in versions.items()},
+                partitions=self.partitions,
+                quantization=self.quantization,
+                rerank=self.rerank,
+                confident_z=self.confident_z,
+                confident_hits=self.confident_hits
+                )
+        self.federated_requests["requests"] += 1
+        if result.stopped_early:
+            self.federated_requests["stopped_early"] += 1
+        contents = {}
+        if request["with_content"]:
+            for index, table in enumerate(result.tables):
+                contents[index] = await self._fetch_contents(table, result.ids[result.sources == index])
+        self.latency["search"].observe((time.perf_counter() - searched) * 1000)
+
+        results = []
+        for ids, scores, sources in zip(result.ids, result.scores, result.sources):
+            hits = []
+            for passage_id, score, source in zip(ids, scores, sources):
+                if passage_id < 0:
+                    break
+                hit = {"id": int(passage_id), "table": result.tables[source], "score": float(score)}
+                hit.update(contents.get(int(source), {}).get(int(passage_id), {}))
+                hits.append(hit)
+            results.append(hits)
+        return results
+
+    def _reply(self, status: int, payload: dict, **headers) -> web.Response:
+        self.status[status] += 1
+        return web.json_response(payload, status=status, headers=headers or None)
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        if self.inflight >= self.max_inflight:
+            return self._reply(503, {"error": "overloaded"}, **{"Retry-After": "1"})
+        self.inflight += 1
+        started = time.perf_counter()
+        try:
+            parsed = self._parse(await request.json())
+            results = await asyncio.wait_for(self._search(parsed), timeout=self.request_timeout)
+            return self._reply(200, {"results": results})
+        except Overloaded:
+            return self._reply(503, {"error": "overloaded"}, **{"Retry-After": "1"})
+        except Stopped:
+            # the table moved to another embedding version meanwhile
+            return self._reply(503, {"error": "the question encoder was unloaded, retry"}, **{"Retry-After": "1"})
+        except asyncio.TimeoutError:
+            return self._reply(504, {"error": f"no result within {self.request_timeout}s"})
+        except (ValueError, KeyError, TypeError) as err:
+            return self._reply(400, {"error": str(err)})
+        except Exception as err:
+            logger.exception("Search failed")
+            return self._reply(500, {"error": str(err)})
+        finally:
+            self.inflight -= 1
+            self.latency["total"].observe((time.perf_counter() - started) * 1000)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response({
+                "inflight": self.inflight,
+                "responses": {str(status): count for status, count in self.status.items()},
+                "latency": {name: histogram.snapshot() for name, histogram in self.latency.items()},
+                "batcher": {
+                    model: {
+                        "batch_size": batcher.batch_sizes.snapshot(),
+                        "queue_wait": batcher.wait_ms.snapshot(),
+                        "forward_pass": batcher.process_ms.snapshot(),
+                        }
+                    for model, batcher in self.batchers.items()
+                    },
+                "embedding_versions": {table: version.version for table, version in self.versions.items()},
+                "federated": {
+                    "requests": self.federated_requests["requests"],
+                    "stopped_early": self.federated_requests["stopped_early"],
+                    "calibration": {table: calibrator.stats() for table, calibrator in self.calibrators.items()},
+                    },
+                "query_cache": self.cache.stats() if self.cache is not None else None,
+                })
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        try:
+            async with self.pool.acquire(timeout=self.request_timeout) as connection:
+                await connection.fetchval("SELECT 1")
+        except Exception as err:
+            return web.json_response({"status": "unavailable", "error": str(err)}, status=503)
+        return web.json_response({"status": "ok"})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+                web.post("/search", self.handle_search),
+                web.get("/metrics", self.handle_metrics),
+                web.get("/health", self.handle_health),
+                ])
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
+
+def main():
+    arguments = Arguments()
+    args = arguments.parse()
+    server = RetrievalServer(args)
+    web.run_app(server.make_app(), host=args.server_host, port=args.server_port)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import json
+import logging
+
+from configs.arguments import Arguments
+from database import make_database
+from database import tuning
+from database.connection import (
+        DatabaseConfig,
+        configure
+        )
+from database.embedding_versions import active_version
+from database.search import Searcher
+
+import dotenv
+
+dotenv.load_dotenv()
+
+TB_WIKI=os.getenv("TB_WIKI", "wiki_tb")
+
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    arguments = Arguments()
+    args = arguments.parse()
+    configure(DatabaseConfig.from_args(args))
+    tb_name = args.tbname or TB_WIKI
+    # tune the index searches use: the one of the active embedding version
+    version = active_version(tb_name)
+    logger.info(f"Tuning {version}")
+    connection = make_database.connect()
+
+    query_vectors = None
+    if args.tune_questions_file:
+        with open(args.tune_questions_file, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        query_vectors = Searcher(
+                connection,
+                tb_name=tb_name,
+                model_name_or_path=version.question_model,
+                column=version.column
+                ).encode(questions)
+
+    if args.tune_quantizations:
+        probes = tuning.parse_int_list(args.tune_probes)
+        ef_search = tuning.parse_int_list(args.tune_ef_search)
+        report = tuning.compare_quantizations(
+                connection,
+                tb_name=tb_name,
+                quantizations=[item.strip() for item in args.tune_quantizations.split(",") if item.strip()],
+                rerank=tuning.parse_int_list(args.tune_rerank),
+                num_queries=args.tune_queries,
+                k=args.tune_k,
+                probes=probes[-1] if probes else None,
+                ef_search=ef_search[-1] if ef_search else None,
+                method=args.index_method,
+                query_vectors=query_vectors,
+                column=version.column,
+                dim=version.dim
+                )
+    else:
+        report = tuning.sweep(
+                connection,
+                tb_name=tb_name,
+                num_queries=args.tune_queries,
+                k=args.tune_k,
+                probes=tuning.parse_int_list(args.tune_probes),
+                ef_search=tuning.parse_int_list(args.tune_ef_search),
+                lists=tuning.parse_int_list(args.tune_lists),
+                query_vectors=query_vectors,
+                column=version.column,
+                dim=version.dim
+                )
+    print(tuning.format_report(report))
+    if args.tune_output:
+        with open(args.tune_output, "w") as f:
+            json.dump(report, f, indent=2)
+    connection.close()
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from typing import (
+        Any,
+        Callable,
+        List,
+        Optional
+        )
+
+from serving.metrics import (
+        LatencyHistogram
+        )
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a batcher's queue is full, callers should back off"""
+
+
+class Stopped(Exception):
+    """Raised for items of a batcher that was stopped before their result"""
+
+
+class MicroBatcher:
+    """Collect concurrent requests into batches for one blocking function
+
+    Items submitted by concurrent coroutines are queued; a single worker
+    task takes up to `max_batch_size` of them, waiting at most
+    `max_wait_ms` after the first one for more to arrive, and runs
+    `process` on the whole batch in `executor`. While a batch is being
+    processed new items keep queueing, so under load batches fill up
+    without waiting.
+
+    `stop` fails the items still queued or being processed with
+    `Stopped`, their callers never wait on a batcher that is gone.
+
+    Args:
+        process: maps a list of items to a list of results, same order
+        max_batch_size: items per call of `process`
+        max_wait_ms: longest time the first item of a batch waits for
+                    company
+        max_queue: items waiting at most, `submit` raises `Overloaded`
+                    beyond it
+        executor: runs `process`, the loop's default executor if None
+    """
+    def __init__(
+            self,
+            process: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = 32,
+            max_wait_ms: float = 5.0,
+            max_queue: int = 1024,
+            executor: Optional[Executor] = None
+            ) -> None:
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.executor = executor
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        # entries taken off the queue and not answered yet
+        self.taken: list = []
+        self.batch_sizes = LatencyHistogram(buckets_ms=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+        self.wait_ms = LatencyHistogram()
+        self.process_ms = LatencyHistogram()
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    @property
+    def busy(self) -> bool:
+        """Whether items are queued or being processed"""
+        return bool(self.taken) or (self.queue is not None and not self.queue.empty())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        pending = self.taken
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, future, _ in pending:
+            if not future.done():
+                future.set_exception(Stopped("the batcher was stopped"))
+
+    async def submit(self, item: Any) -> Any:
+        """Queue an item and wait for its result"""
+        if self.task is None:
+            raise Stopped("the batcher is not running")
+        if self.queue.qsize() >= self.max_queue:
+            raise Overloaded(f"{self.queue.qsize()} items waiting")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = self.taken = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # requests that timed out or disconnected are not processed
+        return [entry for entry in batch if not entry[1].done()]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self.taken = []
+            batch = await self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for _, _, queued in batch:
+                self.wait_ms.observe((started - queued) * 1000)
+            self.batch_sizes.observe(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, [item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"process returned {len(results)} results for {len(batch)} items")
+            except Exception as err:
+                logger.error(f"Batch of {len(batch)} failed: {err}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(err)
+                continue
+            finally:
+                self.process_ms.observe((time.perf_counter() - started) * 1000)
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
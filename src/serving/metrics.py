@@ -0,0 +1,54 @@
+import bisect
+import threading
+from typing import (
+        Dict,
+        Sequence
+        )
+
+# upper bounds of the latency buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram
+
+    Quantiles are reported as the upper bound of the bucket they fall
+    in, which is what a Prometheus-style histogram would report too.
+    """
+    def __init__(self, buckets_ms: Sequence[float] = LATENCY_BUCKETS_MS) -> None:
+        self.bounds = list(buckets_ms)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, latency_ms: float) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, latency_ms)] += 1
+            self.total += 1
+            self.sum_ms += latency_ms
+
+    def quantile(self, q: float) -> float:
+        with self.lock:
+            if not self.total:
+                return 0.0
+            rank = q * self.total
+            seen = 0
+            for bound, count in zip(self.bounds + [float("inf")], self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, object]:
+        with self.lock:
+            buckets = {str(bound): count for bound, count in zip(self.bounds + ["+Inf"], self.counts)}
+            total, sum_ms = self.total, self.sum_ms
+        return {
+                "count": total,
+                "mean_ms": round(sum_ms / total, 3) if total else 0.0,
+                "p50_ms": self.quantile(0.5),
+                "p90_ms": self.quantile(0.9),
+                "p99_ms": self.quantile(0.99),
+                "buckets": buckets,
+                }
@@ -0,0 +1,19 @@
+import pytest
+
+async_search = pytest.importorskip("database.async_search")
+
+
+def test_to_positional_numbers_names_in_order():
+    sql, params = async_search.to_positional(
+            "SELECT * FROM t WHERE a = %(a)s AND b = ANY(%(b)s)",
+            {"b": [1, 2], "a": "x", "unused": 0}
+            )
+    assert sql == "SELECT * FROM t WHERE a = $1 AND b = ANY($2)"
+    assert params == ["x", [1, 2]]
+
+
+def test_to_positional_reuses_repeated_names():
+    sql, params = async_search.to_positional("%(q)s <#> e LIMIT %(k)s OFFSET %(q)s", {"q": "v", "k": 10})
+    assert sql == "$1 <#> e LIMIT $2 OFFSET $1"
+    assert params == ["v", 10]
+
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from serving.batcher import (
+        MicroBatcher,
+        Overloaded,
+        Stopped
+        )
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_concurrent_items_share_a_batch():
+    batches = []
+
+    def process(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=50)
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(6)))
+        finally:
+            await batcher.stop()
+
+    assert _run(scenario()) == [0, 2, 4, 6, 8, 10]
+    assert [len(batch) for batch in batches] == [4, 2]
+    assert sum(batches, []) == list(range(6))
+
+
+def test_first_item_waits_at_most_max_wait():
+    async def scenario():
+        batcher = MicroBatcher(lambda items: items, max_batch_size=8, max_wait_ms=50)
+        batcher.start()
+        try:
+            started = time.perf_counter()
+            result = await batcher.submit("q")
+            return result, time.perf_counter() - started
+        finally:
+            await batcher.stop()
+
+    result, elapsed = _run(scenario())
+    assert result == "q"
+    assert 0.04 <= elapsed < 1.0
+
+
+def test_late_item_joins_within_max_wait():
+    batches = []
+
+    def process(items):
+        batches.append(list(items))
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=8, max_wait_ms=200)
+        batcher.start()
+        try:
+            first = asyncio.ensure_future(batcher.submit("a"))
+            await asyncio.sleep(0.02)
+            second = asyncio.ensure_future(batcher.submit("b"))
+            return await asyncio.gather(first, second)
+        finally:
+            await batcher.stop()
+
+    assert _run(scenario()) == ["a", "b"]
+    assert batches == [["a", "b"]]
+
+
+def test_full_queue_is_rejected():
+    release = threading.Event()
+
+    def process(items):
+        release.wait(5)
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=1, max_wait_ms=0, max_queue=2)
+        batcher.start()
+        try:
+            # the first item blocks the worker, the next two fill the queue
+            pending = [asyncio.ensure_future(batcher.submit(0))]
+            await asyncio.sleep(0.05)
+            pending += [asyncio.ensure_future(batcher.submit(i)) for i in (1, 2)]
+            await asyncio.sleep(0.05)
+            with pytest.raises(Overloaded):
+                await batcher.submit(3)
+            release.set()
+            return await asyncio.gather(*pending)
+        finally:
+            release.set()
+            await batcher.stop()
+
+    assert _run(scenario()) == [0, 1, 2]
+
+
+def test_failed_batch_fails_its_items():
+    def process(items):
+        raise RuntimeError("encoder down")
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=10)
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(2)), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    results = _run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_short_result_list_fails_the_batch():
+    async def scenario():
+        batcher = MicroBatcher(lambda items: items[:1], max_batch_size=4, max_wait_ms=50)
+        batcher.start()
+        try:
+            return await asyncio.wait_for(
+                    asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True), 5)
+        finally:
+            await batcher.stop()
+
+    results = _run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_stop_fails_queued_and_in_flight_items():
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(items):
+        started.set()
+        release.wait(5)
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=1, max_wait_ms=0)
+        batcher.start()
+        try:
+            in_flight = asyncio.ensure_future(batcher.submit(0))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            queued = asyncio.ensure_future(batcher.submit(1))
+            await asyncio.sleep(0.01)
+            assert batcher.busy
+            await batcher.stop()
+            results = await asyncio.wait_for(asyncio.gather(in_flight, queued, return_exceptions=True), 5)
+            with pytest.raises(Stopped):
+                await batcher.submit(2)
+            return results
+        finally:
+            release.set()
+
+    results = _run(scenario())
+    assert all(isinstance(result, Stopped) for result in results)
@@ -0,0 +1,103 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+checkpoint = pytest.importorskip("database.checkpoint")
+writers = pytest.importorskip("database.writers")
+
+from database.checkpoint import (
+        CheckpointHook,
+        OffsetTracker
+        )
+
+
+class TransactionCursor:
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    def execute(self, sql, params=None):
+        self.connection.statements.append((" ".join(sql.split()), params))
+
+    def copy_expert(self, sql, buffer):
+        self.connection.statements.append((" ".join(sql.split()), len(buffer.read())))
+
+    def close(self):
+        pass
+
+
+class TransactionConnection:
+    """Records the statements of every committed transaction"""
+    def __init__(self) -> None:
+        self.cursor_ = TransactionCursor(self)
+        self.statements = []
+        self.transactions = []
+
+    def cursor(self):
+        return self.cursor_
+
+    def commit(self):
+        self.transactions.append(self.statements)
+        self.statements = []
+
+
+def make_hook(tracker: OffsetTracker, seek_point=None) -> CheckpointHook:
+    return CheckpointHook(tracker, tb_name="t", shard_index=0, num_shards=1, fingerprint="f",
+                          seek_point=seek_point)
+
+
+def checkpoint_offsets(statements) -> list:
+    return [params[4] for sql, params in statements if checkpoint.TB_CHECKPOINT in sql]
+
+
+def test_watermark_waits_for_out_of_order_ranges():
+    tracker = OffsetTracker()
+    assert tracker.complete([(10, 20)]) == 0
+    assert tracker.complete([(20, 30)]) == 0
+    assert tracker.complete([(0, 10)]) == 30
+    assert tracker.watermark == 30
+    assert tracker.committed == {}
+
+
+def test_watermark_starts_at_the_resume_offset():
+    tracker = OffsetTracker(100)
+    assert tracker.complete([(100, 150), (150, 160)]) == 160
+    assert tracker.complete([(200, 250)]) == 160
+
+
+def test_watermark_with_does_not_complete_the_ranges():
+    tracker = OffsetTracker()
+    tracker.complete([(10, 20)])
+    assert tracker.watermark_with([(0, 10)]) == 20
+    assert tracker.watermark == 0
+    assert tracker.complete([(20, 30)]) == 0
+
+
+def test_checkpoint_is_written_in_the_transaction_of_its_rows():
+    connection = TransactionConnection()
+    tracker = OffsetTracker()
+    hook = make_hook(tracker)
+    writer = writers.CopyWriter(connection, "t", ("title", "content", "source_id"),
+                                commit_rows=2, idempotent=False, hook=hook)
+    hook.add(0, 2)
+    writer.write([("a", "b", "0"), ("c", "d", "1")], np.ones((2, 4), dtype=np.float32))
+
+    rows_transaction = connection.transactions[-1]
+    assert any(sql.startswith("COPY t ") for sql, _ in rows_transaction)
+    assert checkpoint_offsets(rows_transaction) == [2]
+    assert tracker.watermark == 2
+    assert not hook.has_pending
+
+
+def test_checkpoint_stays_at_the_gap_of_another_writer():
+    connection = TransactionConnection()
+    tracker = OffsetTracker()
+    # this writer commits rows 10-20 while another one still holds 0-10
+    hook = make_hook(tracker, seek_point=lambda offset: (offset, offset * 100))
+    writer = writers.CopyWriter(connection, "t", ("title", "content", "source_id"),
+                                commit_rows=1, idempotent=False, hook=hook)
+    hook.add(10, 20)
+    writer.write([("a", "b", "10")], np.ones((1, 4), dtype=np.float32))
+
+    assert checkpoint_offsets(connection.transactions[-1]) == [0]
+    assert tracker.watermark == 0
+    tracker.complete([(0, 10)])
+    assert tracker.watermark == 20
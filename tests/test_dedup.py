@@ -0,0 +1,95 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+dedup = pytest.importorskip("data.dedup")
+
+from data.dedup import (
+        Deduplicator,
+        make_deduplicator
+        )
+
+PASSAGE = " ".join(f"w{i}" for i in range(60))
+# one word changed: 3 of the 58 shingles differ
+NEAR = PASSAGE.replace("w10 ", "x10 ")
+OTHER = " ".join(f"v{i}" for i in range(60))
+
+
+def similarity(a: str, b: str) -> float:
+    reference = Deduplicator()
+    return float(np.mean(reference.signature(a) == reference.signature(b)))
+
+
+def test_exact_duplicates_ignore_case_and_whitespace():
+    deduplicator = Deduplicator(threshold=1.0)
+    assert deduplicator.check("Hello  world\n", "a") is None
+    assert deduplicator.check("hello world", "b") == ("a", 1.0)
+    assert deduplicator.check("hello there", "c") is None
+    assert not deduplicator.signatures
+
+    stats = deduplicator.stats()
+    assert (stats["rows"], stats["exact"], stats["near"]) == (3, 1, 0)
+    assert stats["encoder_calls_saved"] == 1
+
+
+def test_near_duplicate_at_the_threshold():
+    expected = similarity(PASSAGE, NEAR)
+    deduplicator = Deduplicator(threshold=expected)
+    assert deduplicator.check(PASSAGE, "a") is None
+    assert deduplicator.check(NEAR, "b") == ("a", expected)
+    assert deduplicator.stats()["near"] == 1
+
+
+def test_near_duplicate_below_the_threshold_is_kept():
+    expected = similarity(PASSAGE, NEAR)
+    at = Deduplicator(threshold=expected)
+    above = Deduplicator(threshold=expected + 1 / 64)
+    # same bands, the pair is an LSH candidate of both
+    assert (above.bands, above.rows) == (at.bands, at.rows)
+
+    assert above.check(PASSAGE, "a") is None
+    assert above.check(NEAR, "b") is None
+    assert above.check(NEAR, "c") == ("b", 1.0)
+
+
+def test_eviction_removes_the_buckets_of_the_evicted_passage_only():
+    deduplicator = Deduplicator(threshold=0.8, max_entries=2)
+    deduplicator.check(PASSAGE, "a")
+    deduplicator.check(OTHER, "b")
+    deduplicator.check("a third passage with words of its own", "c")
+
+    assert list(deduplicator.signatures) == ["b", "c"]
+    assert list(deduplicator.exact.values()) == ["b", "c"]
+    owners = sorted(owner for bucket in deduplicator.buckets for owner in bucket.values())
+    assert owners == ["b"] * deduplicator.bands + ["c"] * deduplicator.bands
+
+    # the remembered passages still match through their buckets, the
+    # evicted one is forgotten
+    assert deduplicator.check(OTHER.replace("v20 ", "y20 "), "d")[0] == "b"
+    assert deduplicator.check(NEAR, "e") is None
+
+
+def test_filter_links_duplicates_to_their_canonical_passage():
+    deduplicator = make_deduplicator("link", threshold=0.8)
+    rows = [
+            ("t", PASSAGE, "a"),
+            ("t", PASSAGE.upper(), "b"),
+            ("t", NEAR, "c"),
+            ("t", OTHER, "d"),
+            ]
+    kept, links = deduplicator.filter(rows, content_index=1, id_index=2)
+
+    assert [row[2] for row in kept] == ["a", "d"]
+    assert links == [("b", "a", 1.0), ("c", "a", round(similarity(PASSAGE, NEAR), 4))]
+
+
+def test_skip_mode_returns_no_links():
+    deduplicator = make_deduplicator("skip")
+    kept, links = deduplicator.filter([("t", "x", "a"), ("t", "x", "b")], content_index=1, id_index=2)
+    assert [row[2] for row in kept] == ["a"]
+    assert links == []
+
+
+def test_make_deduplicator_modes():
+    assert make_deduplicator("none") is None
+    with pytest.raises(ValueError):
+        make_deduplicator("drop")
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+numpy_store = pytest.importorskip("database.numpy_store")
+
+COLUMNS = ("title", "content", "source_id")
+DIM = 32
+CLUSTERS = 16
+
+
+def clustered(rng, rows: int, noise: float = 0.1):
+    """Rows scattered around `CLUSTERS` random centers"""
+    centers = rng.standard_normal((CLUSTERS, DIM)).astype(np.float32)
+    labels = rng.integers(0, CLUSTERS, rows)
+    return (centers[labels] + noise * rng.standard_normal((rows, DIM))).astype(np.float32)
+
+
+def text_rows(first: int, count: int):
+    return [(f"title {i}", f"content {i}", str(i)) for i in range(first, first + count)]
+
+
+def load(store, vectors, first: int = 0):
+    writer = store.open_writer("t", COLUMNS)
+    writer.write(text_rows(first, len(vectors)), vectors)
+    writer.close()
+
+
+def test_ivf_search_matches_exact_scan(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = clustered(rng, 2000)
+    queries = vectors[rng.choice(len(vectors), 20, replace=False)] + 0.01
+    store = numpy_store.NumpyStore(str(tmp_path))
+    load(store, vectors)
+    store.create_index("t", lists=CLUSTERS, seed=0)
+    exact, _ = numpy_store.exact_scan(vectors, queries, 10)
+
+    # probing every list scans every row
+    result = store.search(queries, "t", k=10, probes=CLUSTERS)
+    assert [set(row) for row in result.ids - 1] == [set(row) for row in exact]
+
+    result = store.search(queries, "t", k=10, probes=4)
+    recall = np.mean([len(set(found) & set(truth)) / 10 for found, truth in zip(result.ids - 1, exact)])
+    assert recall >= 0.9
+
+
+def test_pq_scores_are_inner_products_with_decoded_vectors():
+    rng = np.random.default_rng(1)
+    vectors = clustered(rng, 1000)
+    queries = rng.standard_normal((5, DIM)).astype(np.float32)
+    codebooks = numpy_store.train_pq(vectors, 4, seed=0)
+    codes = numpy_store.pq_encode(vectors, codebooks)
+    assert codes.shape == (1000, 4) and codes.dtype == np.uint8
+
+    decoded = np.concatenate([codebooks[j][codes[:, j]] for j in range(4)], axis=1)
+    tables = numpy_store.pq_tables(queries, codebooks)
+    scores = tables[:, np.arange(4), codes].sum(axis=2)
+    np.testing.assert_allclose(scores, queries @ decoded.T, rtol=1e-4, atol=1e-4)
+    # the codes approximate the vectors
+    assert np.abs(decoded - vectors).mean() < np.abs(vectors).mean()
+
+
+def test_pq_search_reranks_on_float_vectors(tmp_path):
+    rng = np.random.default_rng(2)
+    vectors = clustered(rng, 2000)
+    queries = vectors[:5] + 0.01
+    store = numpy_store.NumpyStore(str(tmp_path))
+    load(store, vectors)
+    store.create_index("t", lists=CLUSTERS, pq_subvectors=4, seed=0)
+
+    result = store.search(queries, "t", k=10, probes=CLUSTERS)
+    assert (result.ids > 0).all()
+    expected = np.einsum("qkd,qd->qk", vectors[result.ids - 1], queries)
+    np.testing.assert_allclose(result.scores, expected, rtol=1e-4, atol=1e-4)
+    assert (np.diff(result.scores, axis=1) <= 0).all()
+
+
+def test_reload_ignores_leftovers_of_an_interrupted_commit(tmp_path):
+    rng = np.random.default_rng(3)
+    vectors = rng.standard_normal((100, DIM)).astype(np.float32)
+    load(numpy_store.NumpyStore(str(tmp_path)), vectors)
+
+    # a commit interrupted before `table.json` was replaced
+    table_dir = os.path.join(str(tmp_path), "t")
+    with open(os.path.join(table_dir, "vectors.f32"), "ab") as f:
+        f.write(rng.standard_normal((7, DIM)).astype(np.float32).tobytes())
+    leftover = pd.DataFrame(text_rows(1000, 7), columns=list(COLUMNS))
+    leftover.insert(0, "id", np.arange(101, 108, dtype=np.int64))
+    leftover.to_parquet(os.path.join(table_dir, f"columns-{101:012d}.parquet"), index=False)
+
+    store = numpy_store.NumpyStore(str(tmp_path))
+    assert store.count("t") == 100
+    assert store.table("t").vectors().shape == (100, DIM)
+    assert len(store.table("t").frame()) == 100
+    assert store.fetch("t", [101]) == {}
+
+    # the next commit overwrites the leftovers, a replayed row is skipped
+    more = rng.standard_normal((3, DIM)).astype(np.float32)
+    writer = store.open_writer("t", COLUMNS)
+    writer.write(text_rows(99, 3), more)
+    writer.close()
+
+    store = numpy_store.NumpyStore(str(tmp_path))
+    assert store.count("t") == 102
+    np.testing.assert_array_equal(store.table("t").vectors()[100:], more[1:])
+    frame = store.table("t").frame()
+    assert sorted(frame.index) == list(range(1, 103))
+    assert frame.loc[101, "source_id"] == "100"
+    assert store.fetch("t", [102, 103]) == {102: {"title": "title 101", "content": "content 101"}}
@@ -0,0 +1,117 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+query_cache = pytest.importorskip("database.query_cache")
+
+from database.query_cache import (
+        LRUCache,
+        QueryCache
+        )
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(query_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_lru_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_entries=2, max_bytes=2 ** 30)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evicted"] == 1
+
+
+def test_lru_expires_entries_after_the_ttl(clock):
+    cache = LRUCache(max_entries=10, max_bytes=2 ** 30, ttl=5)
+    cache.put("a", 1)
+    clock.now += 4
+    assert cache.get("a") == 1
+    clock.now += 2
+    assert cache.get("a") is None
+
+    stats = cache.stats()
+    assert (stats["expired"], stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1, 0)
+
+
+def test_lru_keeps_its_bytes_under_the_bound():
+    cache = LRUCache(max_entries=100, max_bytes=250, sizeof=len)
+    cache.put("a", "x" * 100)
+    cache.put("b", "x" * 100)
+    cache.put("c", "x" * 100)
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.bytes == 200
+
+    # replacing an entry releases its old size
+    cache.put("b", "x" * 10)
+    assert cache.bytes == 110
+    # an entry larger than the bound is not kept
+    cache.put("d", "x" * 300)
+    assert cache.bytes == 0 and not cache.entries
+
+
+def test_results_are_cached_per_table_and_settings():
+    cache = QueryCache()
+    embeddings = np.eye(2, 4, dtype=np.float32)
+    keys, cached, generation = cache.lookup_results(embeddings, "t", k=2)
+    assert cached == [None, None]
+    ids, scores = np.array([[1, 2], [3, 4]]), np.array([[0.9, 0.8], [0.7, 0.6]], dtype=np.float32)
+    cache.store_results(keys, cached, ids, scores, generation)
+
+    _, cached, _ = cache.lookup_results(embeddings, "t", k=2)
+    assert [hit[0].tolist() for hit in cached] == [[1, 2], [3, 4]]
+    _, cached, _ = cache.lookup_results(embeddings, "t", k=2, probes=10)
+    assert cached == [None, None]
+
+
+@pytest.mark.parametrize("invalidated", ["t", None])
+def test_result_computed_across_an_invalidation_is_not_stored(invalidated):
+    cache = QueryCache()
+    embeddings = np.ones((1, 4), dtype=np.float32)
+    keys, cached, generation = cache.lookup_results(embeddings, "t", k=1)
+    # the table changes while the query runs
+    cache.invalidate(invalidated)
+    ids, scores = cache.store_results(keys, cached, np.array([[7]]), np.array([[0.5]]), generation)
+
+    assert ids.tolist() == [[7]]
+    assert cache.lookup_results(embeddings, "t", k=1)[1] == [None]
+
+
+def test_invalidate_drops_the_results_of_its_table_only():
+    cache = QueryCache()
+    embeddings = np.ones((1, 4), dtype=np.float32)
+    for tb_name in ("t", "u"):
+        keys, cached, generation = cache.lookup_results(embeddings, tb_name, k=1)
+        cache.store_results(keys, cached, np.array([[1]]), np.array([[0.5]]), generation)
+    cache.invalidate("t")
+
+    assert cache.lookup_results(embeddings, "t", k=1)[1] == [None]
+    assert cache.lookup_results(embeddings, "u", k=1)[1] != [None]
+
+
+def test_embed_encodes_the_uncached_queries_once():
+    cache = QueryCache(lowercase=True)
+    calls = []
+
+    def encode(queries):
+        calls.append(list(queries))
+        return np.ones((len(queries), 4), dtype=np.float32)
+
+    cache.embed(["What is  it", "other"], encode)
+    embeddings = cache.embed(["what is it", "new"], encode)
+    assert calls == [["What is  it", "other"], ["new"]]
+    assert embeddings.shape == (2, 4)
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("aiohttp")
+run_server = pytest.importorskip("run_server")
+
+from aiohttp.test_utils import (
+        TestClient,
+        TestServer
+        )
+
+from configs.arguments import Arguments
+from database.search import SearchResult
+
+
+class FakeEncoder:
+    """Question encoder embedding a query as its length"""
+    def __init__(self, model_name_or_path: str = "") -> None:
+        self.question_tokenizer = None
+
+    def encode(self, queries):
+        return np.array([[float(len(query)), 1.0] for query in queries], dtype=np.float32)
+
+
+class FakeConnection:
+    async def fetchval(self, sql):
+        return 1
+
+    async def fetch(self, sql, ids):
+        return [{"id": i, "title": f"title {i}", "content": f"content {i}"} for i in ids]
+
+
+class FakeAcquire:
+    async def __aenter__(self):
+        return FakeConnection()
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakePool:
+    def acquire(self, timeout=None):
+        return FakeAcquire()
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    searches = []
+
+    async def create_async_pool(config):
+        return FakePool()
+
+    async def fetch_active_versions(pool, tables):
+        return {}
+
+    async def search_embeddings_async(pool, embeddings, tb_name, k, **options):
+        searches.append((tb_name, len(embeddings), k))
+        ids = np.full((len(embeddings), k), -1, dtype=np.int64)
+        scores = np.full((len(embeddings), k), -np.inf, dtype=np.float32)
+        # one hit per query, its id the query's embedded length
+        ids[:, 0] = embeddings[:, 0]
+        scores[:, 0] = 0.5
+        return SearchResult(ids, scores)
+
+    monkeypatch.setattr(run_server, "QuestionEncoder", FakeEncoder)
+    monkeypatch.setattr(run_server, "create_async_pool", create_async_pool)
+    monkeypatch.setattr(run_server, "fetch_active_versions", fetch_active_versions)
+    monkeypatch.setattr(run_server, "search_embeddings_async", search_embeddings_async)
+    args = Arguments().parser.parse_args(["--query_cache_entries", "0", "--max_wait_ms", "1"])
+    return run_server.RetrievalServer(args), searches
+
+
+def _post(server, payload):
+    async def scenario():
+        async with TestClient(TestServer(server.make_app())) as client:
+            response = await client.post("/search", json=payload)
+            return response.status, await response.json()
+
+    return asyncio.run(scenario())
+
+
+def test_search_returns_hits_per_query(server):
+    retrieval, searches = server
+    status, body = _post(retrieval, {"queries": ["abc", "abcdef"], "k": 3, "table": "client_tb"})
+    assert status == 200
+    assert body["results"] == [[{"id": 3, "score": 0.5}], [{"id": 6, "score": 0.5}]]
+    assert searches == [("client_tb", 2, 3)]
+
+
+def test_search_with_content(server):
+    retrieval, _ = server
+    status, body = _post(retrieval, {"query": "abcd", "with_content": True})
+    assert status == 200
+    assert body["results"] == [[{"id": 4, "score": 0.5, "title": "title 4", "content": "content 4"}]]
+
+
+@pytest.mark.parametrize("payload", [
+        {"queries": []},
+        {"query": "a", "k": 0},
+        {"query": "a", "table": "missing_tb"},
+        {"query": "a", "federated": True, "hybrid": True},
+        ])
+def test_search_rejects_bad_requests(server, payload):
+    retrieval, searches = server
+    status, body = _post(retrieval, payload)
+    assert status == 400
+    assert "error" in body
+    assert searches == []
@@ -0,0 +1,63 @@
+import pytest
+
+writers = pytest.importorskip("database.writers")
+
+from database.checkpoint import (
+        CheckpointHook,
+        OffsetTracker
+        )
+
+
+class FakeCursor:
+    def __init__(self) -> None:
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((" ".join(sql.split()), params))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.cursor_ = FakeCursor()
+        self.commits = 0
+
+    def cursor(self):
+        return self.cursor_
+
+    def commit(self):
+        self.commits += 1
+
+
+def make_hook(tracker: OffsetTracker) -> CheckpointHook:
+    return CheckpointHook(tracker, tb_name="t", shard_index=0, num_shards=1, fingerprint="f")
+
+
+@pytest.mark.parametrize("bulk_load", [False, True])
+def test_close_commits_checkpoint_of_all_duplicate_batches(bulk_load):
+    connection = FakeConnection()
+    tracker = OffsetTracker()
+    hook = make_hook(tracker)
+    writer = writers.make_writer(connection, "t", ("title", "content"), bulk_load=bulk_load,
+                                 idempotent=False, hook=hook)
+    commits = connection.commits
+    # every row of the batch was a duplicate, nothing reaches the writer
+    hook.add(0, 100)
+    writer.close()
+
+    assert connection.commits == commits + 1
+    assert tracker.watermark == 100
+    checkpoint = connection.cursor_.statements[-1]
+    assert "source_offset" in checkpoint[0] and 100 in checkpoint[1]
+    assert not any("pg_notify" in sql for sql, _ in connection.cursor_.statements)
+
+
+def test_flush_without_pending_state_does_not_commit():
+    connection = FakeConnection()
+    writer = writers.make_writer(connection, "t", ("title", "content"), bulk_load=True,
+                                 idempotent=False, hook=make_hook(OffsetTracker()))
+    commits = connection.commits
+    writer.flush()
+    assert connection.commits == commits